@@ -0,0 +1,157 @@
+"""Peak memory of building vectorstore documents for the whole site at once versus the ingest pipeline.
+
+Runs against a synthetic site, no Moodle instance or embedding model is needed:
+
+    python -m benchmarks.ingest_memory --courses 200 --sections 8 --modules 6 --text-kb 8
+
+The pipeline run is IngestPipeline.run as the ingest uses it, with all four
+stages and their queues, against a collection that only counts what it gets
+and an embedding that returns zero vectors of --dimensions. Near-duplicate
+collapsing is off, the synthetic pages would all collapse into one. Both runs
+build the same documents, the pipeline's course and site digests included, so
+their document counts match.
+"""
+import argparse
+import gc
+import os
+import tempfile
+import tracemalloc
+
+from src.scrape_moodle import (
+    MoodleCourse,
+    MoodleCourseSection,
+    MoodleModule,
+    MoodleModuleContent,
+    MoodleSiteInfo,
+    iter_course_nodes,
+)
+from src.digests import catalogue_entry, iter_course_digests, site_digests
+from src.ingest import CHECKPOINT_FILENAME, IngestPipeline, to_document
+
+
+def synthetic_site(courses: int) -> MoodleSiteInfo:
+    return MoodleSiteInfo(
+        name="Benchmark Site",
+        url="https://moodle.example.org",
+        summary="Synthetic site",
+        courses=[MoodleCourse(id=i, name=f"Kurs {i}", summary=f"Zusammenfassung {i}") for i in range(1, courses + 1)],
+    )
+
+
+def synthetic_sections(sections: int, modules: int, text_kb: int):
+    def get_sections(course_id):
+        return [
+            MoodleCourseSection(
+                name="Allgemeines" if s == 0 else f"Woche {s}",
+                course_id=course_id,
+                description=f"Abschnitt {s}",
+                modules=[
+                    MoodleModule(
+                        id=course_id * 10000 + s * 100 + m,
+                        name=f"Modul {m}",
+                        modname="page",
+                        url=f"https://moodle.example.org/mod/page/view.php?id={m}",
+                        course_id=course_id,
+                        contents=[
+                            MoodleModuleContent(
+                                type="file",
+                                course_id=course_id,
+                                filename="index.html",
+                                text=f"<p>Kurs {course_id} Modul {m}</p>" + "x" * (text_kb * 1024),
+                            )
+                        ],
+                    )
+                    for m in range(modules)
+                ],
+            )
+            for s in range(sections)
+        ]
+
+    return get_sections
+
+
+def measure(fn):
+    gc.collect()
+    tracemalloc.start()
+    count = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return count, peak
+
+
+def whole_site(site, get_sections):
+    # The previous ingest: scrape everything, then convert everything.
+    for course in site.courses:
+        course.sections = get_sections(course.id)
+    documents = [to_document(site)]
+    for course in site.courses:
+        documents.extend(to_document(node) for node in iter_course_nodes(course))
+        documents.extend(to_document(node) for node in iter_course_digests(course))
+    documents.extend(to_document(node) for node in site_digests(site, [catalogue_entry(course) for course in site.courses]))
+    count = len(documents)
+    for course in site.courses:
+        course.sections = []
+    return count
+
+
+class CountingCollection:
+    def __init__(self):
+        self.documents = 0
+
+    def count(self):
+        return self.documents
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        self.documents += len(ids)
+
+    def update(self, ids, metadatas):
+        pass
+
+    def delete(self, where):
+        pass
+
+
+class ZeroEmbeddings:
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts):
+        return [[0.0] * self.dimensions for _ in texts]
+
+
+def pipeline(site, get_sections, dimensions: int):
+    collection = CountingCollection()
+    with tempfile.TemporaryDirectory() as directory:
+        IngestPipeline(
+            collection,
+            ZeroEmbeddings(dimensions),
+            os.path.join(directory, CHECKPOINT_FILENAME),
+            get_sections=get_sections,
+        ).run(site)
+    return collection.documents
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--courses", type=int, default=200)
+    parser.add_argument("--sections", type=int, default=8)
+    parser.add_argument("--modules", type=int, default=6)
+    parser.add_argument("--text-kb", type=int, default=8)
+    parser.add_argument("--dimensions", type=int, default=768, help="embedding size, 768 for instructor-large")
+    args = parser.parse_args()
+
+    get_sections = synthetic_sections(args.sections, args.modules, args.text_kb)
+    site = synthetic_site(args.courses)
+
+    print(f"{'mode':<12}{'documents':>12}{'peak MiB':>12}")
+    runs = (
+        ("whole-site", lambda: whole_site(site, get_sections)),
+        ("pipeline", lambda: pipeline(site, get_sections, args.dimensions)),
+    )
+    for name, fn in runs:
+        count, peak = measure(fn)
+        print(f"{name:<12}{count:>12}{peak / 2**20:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Prompt tokens an LLM server can serve from its prefix cache, old versus new prompt layout.
+
+Starts a stub OpenAI-compatible server that keeps the token sequences of its last
+prompts, like the prefix cache of llama.cpp or vLLM, and counts how many leading
+tokens of every new prompt it has already seen. No model, vectorstore or Moodle
+instance is needed:
+
+    python -m benchmarks.prefix_cache --requests 500 --courses 20 --cache-slots 8
+"""
+import argparse
+import json
+import random
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from langchain.docstore.document import Document
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from src.prompting import build_answer_messages
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]|\s+")
+
+USER_CONTEXTS = [
+    "Dashboard",
+    "The user is logged in as a student. The user currently views the course overview.",
+    "The user is logged in as a teacher. The user currently views the course overview.",
+    "The user visits the site as a guest. The user currently views the homepage of the site.",
+]
+QUESTIONS = [
+    "Worum geht es in diesem Kurs?",
+    "Welche Module gibt es in Woche {n}?",
+    "Was muss ich bis Woche {n} erledigen?",
+    "Gibt es ein Quiz zu Abschnitt {n}?",
+    "Wo finde ich die Folien zu Thema {n}?",
+]
+
+
+def legacy_messages(documents, query, usercontext):
+    # The layout the answer prompt had before src.prompting.
+    return [
+        SystemMessage(
+            content="Du bist ein hilfreicher Assistent der dabei unterstützt, passende Kurse auf der Kursplattform FututreLearnLab zu finden und über die verfügbaren Lerninhalte zu informieren."
+        ),
+        HumanMessage(
+            content=(
+                "Nutze den folgenden Kontext, um die nachfolgende Nutzeranfrage zu beantworten\n"
+                "\n"
+                f"Der Nutzer befindet sich momentan auf der Kursplatform in folgendem Kontext: {usercontext}\n"
+                "Bei Fragen zu bestimmten Kursinhalten oder verfügbaren Kursen, nutze auschließlich Infromationen aus dem nachgehenden Kontext, der auf Basis der Nutzeranfrage zusammengestellt wurde. Nicht alle Informationen sind relevant, entscheide also selbst, welche Informationen du teilen möchtest.\n"
+                f"{documents}\n"
+                "\n"
+                "Kontext Ende"
+                "\n"
+                f"Der Nutzer hat folgende Nachricht geschrieben: {query}"
+                "\n"
+                "Antworte auf die Nutzeranfrage unter Berücksichtigung des Kontexts und der Nutzeranfrage. Wenn der Kontext keine relevanten Informationen enthält, antworte mit 'Ich habe keine Informationen zu diesem Thema'."
+            )
+        ),
+    ]
+
+
+class PrefixCache:
+    """Token sequences of the last `slots` prompts; a hit is the longest shared prefix."""
+
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.prompts = OrderedDict()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self._lock = threading.Lock()
+
+    def observe(self, tokens):
+        with self._lock:
+            tokens = tuple(tokens)
+            best, best_key = 0, None
+            for cached in self.prompts:
+                shared = 0
+                for a, b in zip(tokens, cached):
+                    if a != b:
+                        break
+                    shared += 1
+                if shared > best:
+                    best, best_key = shared, cached
+            if best_key is not None:
+                self.prompts.move_to_end(best_key)
+            self.prompts[tokens] = None
+            self.prompts.move_to_end(tokens)
+            while len(self.prompts) > self.slots:
+                self.prompts.popitem(last=False)
+            self.prompt_tokens += len(tokens)
+            self.cached_tokens += best
+            return best
+
+    def reset(self):
+        with self._lock:
+            self.prompts.clear()
+            self.prompt_tokens = 0
+            self.cached_tokens = 0
+
+
+def render(messages):
+    # A chat template in the style of ChatML; only the order of the parts matters here.
+    return "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages) + "<|im_start|>assistant\n"
+
+
+def stub_server(cache: PrefixCache):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            tokens = TOKEN_PATTERN.findall(render(body["messages"]))
+            cached = cache.observe(tokens)
+            payload = json.dumps({
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(tokens), "completion_tokens": 1, "prompt_tokens_details": {"cached_tokens": cached}},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def synthetic_courses(courses: int, documents: int, rng: random.Random):
+    corpus = {}
+    for course_id in range(1, courses + 1):
+        docs = [Document(
+            page_content=f"\n        Course Kurs {course_id}\n        URL: https://moodle.example.org/course/view.php?id={course_id}\n        Summary: {'Lorem ipsum dolor sit amet. ' * 20}\n        ",
+            metadata={"doc_type": "course", "course_id": str(course_id), "name": f"Kurs {course_id}"},
+        )]
+        for m in range(documents - 1):
+            docs.append(Document(
+                page_content=f"\n        Course Module Modul {m}\n        Type: page\n        Description: {f'Inhalt {m} von Kurs {course_id}. ' * rng.randint(10, 40)}\n        ",
+                metadata={"doc_type": "module", "course_id": str(course_id), "name": f"Modul {m}"},
+            ))
+        corpus[course_id] = docs
+    return corpus
+
+
+def workload(corpus, count: int, k: int, rng: random.Random):
+    # Popular courses get most of the traffic; retrieval order follows per-query scores.
+    course_ids = list(corpus)
+    weights = [1 / rank for rank in range(1, len(course_ids) + 1)]
+    for _ in range(count):
+        course_id = rng.choices(course_ids, weights)[0]
+        query = rng.choice(QUESTIONS).format(n=rng.randint(1, 8))
+        scores = [rng.random() + (0.5 if doc.metadata["doc_type"] == "course" else 0) for doc in corpus[course_id]]
+        ranked = [doc for _, doc in sorted(zip(scores, corpus[course_id]), key=lambda pair: -pair[0])]
+        yield ranked[:k], query, rng.choice(USER_CONTEXTS)
+
+
+def as_openai(messages):
+    roles = {"system": "system", "human": "user", "ai": "assistant"}
+    return [{"role": roles[m.type], "content": m.content} for m in messages]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--courses", type=int, default=20)
+    parser.add_argument("--documents", type=int, default=12, help="documents per course")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--cache-slots", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cache = PrefixCache(args.cache_slots)
+    server = stub_server(cache)
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    session = requests.Session()
+    corpus = synthetic_courses(args.courses, args.documents, random.Random(args.seed))
+
+    print(f"{'layout':<10}{'prompt tokens':>16}{'cached tokens':>16}{'reuse':>9}")
+    for name, build in (("legacy", legacy_messages), ("prefix", build_answer_messages)):
+        cache.reset()
+        # Same requests in the same order for both layouts.
+        for documents, query, usercontext in workload(corpus, args.requests, args.k, random.Random(args.seed)):
+            response = session.post(url, json={"model": "stub", "messages": as_openai(build(documents, query, usercontext))})
+            response.raise_for_status()
+        print(f"{name:<10}{cache.prompt_tokens:>16}{cache.cached_tokens:>16}{cache.cached_tokens / cache.prompt_tokens:>9.1%}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
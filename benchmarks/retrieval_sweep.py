@@ -0,0 +1,367 @@
+"""Retrieval quality versus search latency across k, HNSW parameters, filters and backends.
+
+Runs a labelled query set against every configuration and prints one table row
+per configuration with recall@k, MRR and p50/p99 search latency (one query
+vector per search, as in /chat):
+
+    python -m benchmarks.retrieval_sweep --documents 50000 --k 3,5,10 --hnsw-ef 16,64,256
+    python -m benchmarks.retrieval_sweep --snapshot /snapshots/ --labels labels.jsonl --backends numpy,hnsw
+    python -m benchmarks.retrieval_sweep --store data/stores/instructor --store data/stores/e5 --labels labels.jsonl
+
+Without --snapshot or --store the index and queries are synthetic (see
+benchmarks.vectorstores): every query lies near one document and is labelled
+with that document and its course. With a snapshot (see src.index_snapshot) or
+a store directory, the vectors of its current generation are copied into every
+backend, and the queries of a labels file are embedded with the embedding model
+the index was built with (from its manifest). One JSON object per line:
+
+    {"query": "Wann ist die Klausur?", "course_id": "12", "context": "Course-Context",
+     "courses": ["12"], "modules": ["345"]}
+
+--snapshot and --store can be repeated to compare indexes built with different
+embedding models against the same labels. Every row is tagged with its source
+and embedding_model. PATH=MODEL names the model of an index whose manifest does
+not, e.g. one built through an embedding service running another model.
+
+course_id and context are those of the request (context defaults to
+Course-Context with a course_id, Site-Context without). A hit counts for a
+course label if it belongs to the course (directly or as a collapsed
+duplicate), and for a module label if it is the module's document
+(module_id in its metadata).
+
+    recall@k  share of a query's labels found in its top k hits
+    MRR       1 / rank of the first hit matching any label, 0 if none is in the top k
+
+Filter strategies:
+
+    route  the filter /chat uses for the query's context, applied by the store
+    post   an unfiltered search for k * --post-overfetch hits, filtered afterwards
+    none   no filter
+
+--hnsw-m and --hnsw-ef apply to the hnsw backend and to Chroma's own HNSW index
+(hnsw:M, hnsw:search_ef); Chroma fixes both when the collection is created, so
+it is rebuilt for every pair. numpy searches exactly and ignores them.
+
+The hnsw backend searches filters matching at most --hnsw-exact-max-rows
+documents exactly. The default 0 sends every search through the graph, so a
+course filter measures ef; pass the service's HNSW_EXACT_MAX_ROWS (2000) to
+measure what /chat does. The exact column is the share of searches that were
+answered exactly (numpy always, - for Chroma).
+"""
+import argparse
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List
+
+import numpy as np
+
+from benchmarks.vectorstores import percentile, synthetic
+from src.vectorstores.filters import matches
+
+UPSERT_BATCH = 5000
+
+
+def synthetic_labelled(documents: int, dim: int, courses: int, queries: int, noise: float = 1.0, seed: int = 1):
+    """A synthetic corpus and queries labelled with the document they were drawn around."""
+    ids, vectors, metadatas = synthetic(documents, dim, courses)
+    for row, metadata in enumerate(metadatas):
+        metadata["module_id"] = str(row)
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, documents, size=queries)
+    query_vectors = vectors[picks] + rng.normal(scale=noise, size=(queries, dim)).astype(np.float32)
+    labels = []
+    for pick in picks:
+        metadata = metadatas[pick]
+        # A context whose route filter admits the document, so every label is reachable
+        if metadata["doc_type"] in ("course", "course_digest"):
+            context, course_id = "Site-Context", None
+        elif metadata["doc_type"] in ("module", "section_digest"):
+            context, course_id = "Course-Context", metadata["course_id"]
+        else:
+            context, course_id = "User-Context", None
+        labels.append({"context": context, "course_id": course_id, "courses": [metadata["course_id"]], "modules": [metadata["module_id"]]})
+    corpus = SimpleNamespace(ids=ids, vectors=vectors, metadatas=metadatas, texts=[f"Dokument {i}" for i in range(documents)])
+    return corpus, query_vectors, labels
+
+
+def load_corpus(path: str) -> SimpleNamespace:
+    """ids, vectors, metadatas and texts of a store directory's current generation."""
+    from src.generations import current_generation, generation_path
+    from src.vectorstores import stored_backend
+
+    generation = current_generation(path)
+    if generation is None:
+        raise SystemExit(f"{path} holds no index")
+    directory = generation_path(path, generation)
+    if stored_backend(directory) == "chroma":
+        import chromadb
+        from chromadb.config import Settings
+
+        client = chromadb.PersistentClient(directory, settings=Settings(anonymized_telemetry=False))
+        collection = client.list_collections()[0]
+        data = collection.get(include=["embeddings", "metadatas", "documents"])
+        return SimpleNamespace(
+            ids=data["ids"],
+            vectors=np.asarray(data["embeddings"], dtype=np.float32),
+            metadatas=[metadata or {} for metadata in data["metadatas"]],
+            texts=data["documents"],
+        )
+    from src.vectorstores.memmap import MemmapVectorStore
+
+    store = MemmapVectorStore(directory, None)
+    rows = [row for row, id in enumerate(store._ids) if id is not None]
+    return SimpleNamespace(
+        ids=[store._ids[row] for row in rows],
+        vectors=np.asarray(store.matrix()[rows], dtype=np.float32),
+        metadatas=[store._metadatas[row] for row in rows],
+        texts=[store._texts[row] for row in rows],
+    )
+
+
+def read_labels(path: str) -> List[Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        labels = [json.loads(line) for line in f if line.strip()]
+    for label in labels:
+        label.setdefault("context", "Course-Context" if label.get("course_id") else "Site-Context")
+    return labels
+
+
+def unpack_snapshot(path: str, root: str):
+    """Import a snapshot into a store directory of its own; returns the directory and its embedding model."""
+    from src.index_snapshot import import_snapshot, latest_snapshot, read_snapshot_manifest
+
+    path = latest_snapshot(path)
+    with tarfile.open(path, "r:*") as tar:
+        model = read_snapshot_manifest(tar).get("embedding_model")
+    import_snapshot(root, path, model)
+    return root, model
+
+
+def store_embedding_model(root: str) -> str:
+    from src.generations import current_generation, read_manifest
+    from src.setup import EMBEDDING_MODEL_NAME
+
+    generation = current_generation(root)
+    # Generations built before manifests recorded it used the default model
+    return (read_manifest(root, generation) if generation else {}).get("embedding_model") or EMBEDDING_MODEL_NAME
+
+
+def load_embedding(model: str):
+    from src.setup import EMBEDDING_MODEL_NAME, load_embedding_function, load_local_embedding_function
+
+    if model == EMBEDDING_MODEL_NAME:
+        # The configured one, possibly the embedding service
+        return load_embedding_function()
+    if "instructor" in model:
+        return load_local_embedding_function(model)
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(model_name=model)
+
+
+def embed_labels(labels: List[Dict], model: str) -> np.ndarray:
+    from src.retrieval import embed_queries
+
+    embedding = load_embedding(model)
+    started = time.perf_counter()
+    vectors = embed_queries(embedding, [label["query"] for label in labels])
+    print(f"Embedded {len(labels)} queries with {model} in {time.perf_counter() - started:.1f}s")
+    return np.asarray(vectors, dtype=np.float32)
+
+
+def open_store(backend: str, directory: str, m: int, ef: int, ef_construction: int, exact_max_rows: int = 0):
+    if backend == "chroma":
+        import chromadb
+        from chromadb.config import Settings
+
+        client = chromadb.PersistentClient(directory, settings=Settings(anonymized_telemetry=False))
+        collection = client.get_or_create_collection(
+            "sweep",
+            metadata={"hnsw:space": "cosine", "hnsw:M": m, "hnsw:construction_ef": ef_construction, "hnsw:search_ef": ef},
+        )
+        return collection, SimpleNamespace(_collection=collection)
+    if backend.startswith("numpy"):
+        from src.vectorstores.memmap import MemmapVectorStore
+
+        store = MemmapVectorStore(directory, None, dtype="float16" if backend == "numpy-f16" else "float32")
+        return store, store
+    from src.vectorstores.hnsw import HnswVectorStore
+
+    store = HnswVectorStore(directory, None, m=m, ef_construction=ef_construction, ef_search=ef, exact_max_rows=exact_max_rows)
+    count_exact_searches(store)
+    return store, store
+
+
+def count_exact_searches(store):
+    """Count the searches the hnsw store answers exactly instead of through the graph."""
+    exact_search = store.exact_search
+
+    def counted(*args, **kwargs):
+        store.exact_searches += 1
+        return exact_search(*args, **kwargs)
+
+    store.exact_searches = 0
+    store.exact_search = counted
+
+
+def build(backend: str, directory: str, corpus, m: int, ef: int, ef_construction: int, exact_max_rows: int = 0):
+    collection, store = open_store(backend, directory, m, ef, ef_construction, exact_max_rows)
+    for start in range(0, len(corpus.ids), UPSERT_BATCH):
+        end = start + UPSERT_BATCH
+        collection.upsert(
+            ids=corpus.ids[start:end],
+            embeddings=corpus.vectors[start:end].tolist(),
+            metadatas=corpus.metadatas[start:end],
+            documents=corpus.texts[start:end],
+        )
+    if hasattr(store, "finalize"):
+        store.finalize()
+    return store
+
+
+def route_filter(label: Dict):
+    from src.routes.main_router import get_search_filter
+
+    return get_search_filter(label["context"], label.get("course_id"))
+
+
+def relevant(metadata: Dict, label: Dict) -> set:
+    """The labels a hit matches."""
+    found = {("module", module) for module in label.get("modules", ()) if metadata.get("module_id") == module}
+    found.update(
+        ("course", course) for course in label.get("courses", ())
+        if metadata.get("course_id") == course or metadata.get(f"in_course_{course}")
+    )
+    return found
+
+
+def search(store, vector, filter, strategy: str, k: int, overfetch: int):
+    from src.retrieval import _search_vectors
+
+    if strategy == "route":
+        return _search_vectors(store, [vector], filter, k)[0]
+    if strategy == "none" or filter is None:
+        return _search_vectors(store, [vector], None, k)[0]
+    hits = _search_vectors(store, [vector], None, k * overfetch)[0]
+    return [hit for hit in hits if matches(hit.document.metadata, filter)][:k]
+
+
+def evaluate(store, query_vectors, labels, filters, strategy: str, k: int, overfetch: int) -> Dict:
+    latencies, recalls, reciprocal_ranks = [], [], []
+    exact_searches = getattr(store, "exact_searches", None)
+    for vector, label, filter in zip(query_vectors, labels, filters):
+        started = time.perf_counter()
+        hits = search(store, vector.tolist(), filter, strategy, k, overfetch)
+        latencies.append(time.perf_counter() - started)
+        wanted = len(label.get("modules", ())) + len(label.get("courses", ()))
+        found, rank = set(), 0
+        for position, hit in enumerate(hits, 1):
+            matched = relevant(hit.document.metadata, label)
+            if matched and not rank:
+                rank = position
+            found |= matched
+        recalls.append(len(found) / wanted if wanted else 0.0)
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+    if exact_searches is not None:
+        exact = (store.exact_searches - exact_searches) / len(labels) if labels else 0.0
+    else:
+        exact = 1.0 if hasattr(store, "exact_search") else None
+    return {
+        "exact": exact,
+        "recall": float(np.mean(recalls)),
+        "mrr": float(np.mean(reciprocal_ranks)),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def integers(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part]
+
+
+def sweep(corpus, query_vectors, labels, args, workdir: str, tags: Dict, output):
+    """Evaluate every configuration on one corpus; tags are added to each row."""
+    filters = [route_filter(label) for label in labels]
+    print(f"{len(corpus.ids)} documents, dim {corpus.vectors.shape[1]}, {len(labels)} labelled queries")
+    print(f"{'backend':<10} {'M':>4} {'ef':>5} {'filter':<6} {'k':>3} {'exact':>6} {'recall':>7} {'MRR':>6} {'p50 ms':>7} {'p99 ms':>7}")
+    for backend in args.backends.split(","):
+        tuned = backend in ("chroma", "hnsw")
+        for m in args.hnsw_m if tuned else [None]:
+            store = None
+            for ef in args.hnsw_ef if tuned else [None]:
+                if store is None or backend == "chroma":
+                    directory = tempfile.mkdtemp(prefix=f"{backend}-", dir=workdir)
+                    store = build(backend, directory, corpus, m or 16, ef or 64, args.hnsw_ef_construction, args.hnsw_exact_max_rows)
+                if backend == "hnsw":
+                    store.ef_search = ef
+                for strategy in args.filters.split(","):
+                    for k in args.k:
+                        row = dict(tags, backend=backend, m=m, ef=ef, filter=strategy, k=k)
+                        row.update(evaluate(store, query_vectors, labels, filters, strategy, k, args.post_overfetch))
+                        exact = f"{row['exact']:.2f}" if row["exact"] is not None else "-"
+                        print(
+                            f"{backend:<10} {m or '-':>4} {ef or '-':>5} {strategy:<6} {k:>3} {exact:>6} {row['recall']:>7.3f} "
+                            f"{row['mrr']:>6.3f} {row['p50_ms']:>7.2f} {row['p99_ms']:>7.2f}"
+                        )
+                        if output is not None:
+                            output.write(json.dumps(row) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--snapshot", action="append", default=[], metavar="PATH[=MODEL]", help="index snapshot file or directory to evaluate (repeatable)")
+    parser.add_argument("--store", action="append", default=[], metavar="PATH[=MODEL]", help="store directory whose current generation is evaluated (repeatable)")
+    parser.add_argument("--labels", help="labelled queries (JSONL), required with --snapshot/--store")
+    parser.add_argument("--backends", default="chroma,numpy,hnsw")
+    parser.add_argument("--k", type=integers, default="1,3,5,10")
+    parser.add_argument("--hnsw-m", type=integers, default="16,32")
+    parser.add_argument("--hnsw-ef", type=integers, default="16,64,128")
+    parser.add_argument("--hnsw-ef-construction", type=int, default=200)
+    parser.add_argument("--hnsw-exact-max-rows", type=int, default=0, help="hnsw filters matching at most this many documents are searched exactly")
+    parser.add_argument("--filters", default="route,post,none")
+    parser.add_argument("--post-overfetch", type=int, default=4, help="hits fetched per result for post filtering")
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--courses", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--query-noise", type=float, default=1.0, help="distance of synthetic queries from their document")
+    parser.add_argument("--output", help="JSONL file for the result rows")
+    args = parser.parse_args()
+    if (args.snapshot or args.store) and not args.labels:
+        parser.error("--labels is required with --snapshot or --store")
+
+    workdir = tempfile.mkdtemp(prefix="retrieval-sweep-")
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    try:
+        if not (args.snapshot or args.store):
+            corpus, query_vectors, labels = synthetic_labelled(args.documents, args.dim, args.courses, args.queries, args.query_noise)
+            sweep(corpus, query_vectors, labels, args, workdir, {"source": "synthetic", "embedding_model": None}, output)
+            return
+        labels = read_labels(args.labels)
+        # Sources built with the same model share the query embeddings
+        query_vectors = {}
+        sources = [("snapshot", path) for path in args.snapshot] + [("store", path) for path in args.store]
+        for number, (kind, path) in enumerate(sources):
+            path, _, model = path.rpartition("=") if "=" in path else (path, "", None)
+            if kind == "snapshot":
+                root, stored_model = unpack_snapshot(path, os.path.join(workdir, f"snapshot-{number}"))
+            else:
+                root, stored_model = path, store_embedding_model(path)
+            model = model or stored_model
+            print(f"\n{kind} {path}, embedding model {model}")
+            if model not in query_vectors:
+                query_vectors[model] = embed_labels(labels, model)
+            sweep(load_corpus(root), query_vectors[model], labels, args, workdir, {"source": path, "embedding_model": model}, output)
+    finally:
+        if output is not None:
+            output.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""Latency, recall and memory of the vectorstore backends on a synthetic site.
+
+Every backend is built and then queried in fresh processes, so the memory
+numbers are those of a worker that only opened the store. Queries use the
+filters of the /chat routes (Site-Context, Course-Context, none); recall@k is
+measured against exact float32 search:
+
+    python -m benchmarks.vectorstores --documents 50000 --dim 768
+    python -m benchmarks.vectorstores --backends numpy,hnsw --hnsw-m 32 --hnsw-ef 128
+
+RSS is split into file-backed pages (the mapped vectors, shared between forked
+workers) and anonymous memory (private to every worker).
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from src.dedup import course_filter
+from src.vectorstores.filters import matches
+
+DOC_TYPES = ("module", "content", "section", "section_digest", "course", "course_digest")
+SITE_FILTER = {"doc_type": {"$in": ["site", "course", "course_digest"]}}
+
+
+def synthetic(documents: int, dim: int, courses: int, seed: int = 0):
+    """Clustered embeddings: documents of a course lie around its centroid."""
+    rng = np.random.default_rng(seed)
+    centroids = rng.normal(size=(courses, dim)).astype(np.float32)
+    course_ids = rng.integers(0, courses, size=documents)
+    vectors = centroids[course_ids] + rng.normal(scale=1.5, size=(documents, dim)).astype(np.float32)
+    metadatas = [{"course_id": str(c), f"in_course_{c}": True, "doc_type": DOC_TYPES[i % len(DOC_TYPES)]} for i, c in enumerate(course_ids)]
+    return [f"doc-{i}" for i in range(documents)], vectors, metadatas
+
+
+def synthetic_queries(vectors, metadatas, queries: int, courses: int, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(vectors), size=queries)
+    query_vectors = vectors[picks] + rng.normal(scale=1.0, size=(queries, vectors.shape[1])).astype(np.float32)
+    filters = []
+    for i, pick in enumerate(picks):
+        kind = i % 3
+        if kind == 0:
+            filters.append(SITE_FILTER)
+        elif kind == 1:
+            course_id = metadatas[pick]["course_id"]
+            filters.append({"$and": [course_filter(course_id), {"doc_type": {"$in": ["course", "course_digest", "section_digest", "module"]}}]})
+        else:
+            filters.append(None)
+    return query_vectors, filters
+
+
+def exact(ids, vectors, metadatas, query_vectors, filters, k):
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    truth = []
+    for query, filter in zip(query_vectors, filters):
+        rows = np.array([row for row, metadata in enumerate(metadatas) if matches(metadata, filter)])
+        scores = normalized[rows] @ (query / np.linalg.norm(query))
+        truth.append({ids[row] for row in rows[np.argsort(-scores)[:k]]})
+    return truth
+
+
+def memory():
+    values = {}
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("VmRSS", "RssAnon", "RssFile", "VmHWM"):
+                values[key] = int(value.split()[0]) * 1024
+    return values
+
+
+def open_store(backend: str, directory: str, options):
+    if backend == "chroma":
+        import chromadb
+        from chromadb.config import Settings
+
+        client = chromadb.PersistentClient(directory, settings=Settings(anonymized_telemetry=False))
+        collection = client.get_or_create_collection("benchmark", metadata={"hnsw:space": "cosine"})
+        # Searched through the same code path as the langchain wrapper
+        return collection, SimpleNamespace(_collection=collection)
+    if backend.startswith("numpy"):
+        from src.vectorstores.memmap import MemmapVectorStore
+
+        store = MemmapVectorStore(directory, None, dtype="float16" if backend == "numpy-f16" else "float32")
+        return store, store
+    from src.vectorstores.hnsw import HnswVectorStore
+
+    store = HnswVectorStore(directory, None, m=options.hnsw_m, ef_construction=options.hnsw_ef_construction, ef_search=options.hnsw_ef)
+    return store, store
+
+
+def build(backend, directory, options, results):
+    ids, vectors, metadatas = synthetic(options.documents, options.dim, options.courses)
+    started = time.perf_counter()
+    collection, store = open_store(backend, directory, options)
+    for start in range(0, len(ids), 5000):
+        end = start + 5000
+        collection.upsert(
+            ids=ids[start:end],
+            embeddings=vectors[start:end].tolist(),
+            metadatas=metadatas[start:end],
+            documents=[f"Dokument {i}" for i in range(start, min(end, len(ids)))],
+        )
+    if hasattr(store, "finalize"):
+        store.finalize()
+    results.put({"build_seconds": time.perf_counter() - started})
+
+
+def query(backend, directory, options, results):
+    from src.retrieval import _search_vectors
+
+    ids, vectors, metadatas = synthetic(options.documents, options.dim, options.courses)
+    query_vectors, filters = synthetic_queries(vectors, metadatas, options.queries, options.courses)
+    del ids, vectors, metadatas
+    before = memory()
+    started = time.perf_counter()
+    _, store = open_store(backend, directory, options)
+    _search_vectors(store, [query_vectors[0].tolist()], filters[0], options.k)
+    open_seconds = time.perf_counter() - started
+    latencies, found = [], []
+    for vector, filter in zip(query_vectors, filters):
+        started = time.perf_counter()
+        hits = _search_vectors(store, [vector.tolist()], filter, options.k)[0]
+        latencies.append(time.perf_counter() - started)
+        found.append([hit.id for hit in hits])
+    after = memory()
+    results.put({
+        "open_seconds": open_seconds,
+        "latencies": latencies,
+        "found": found,
+        "rss_file": after.get("RssFile", 0) - before.get("RssFile", 0),
+        "rss_anon": after.get("RssAnon", 0) - before.get("RssAnon", 0),
+    })
+
+
+def child(target, args, results):
+    try:
+        target(*args, results)
+    except Exception as e:
+        results.put({"error": f"{type(e).__name__}: {e}"})
+
+
+def run_child(target, *args):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=child, args=(target, args, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--backends", default="chroma,numpy,numpy-f16,hnsw")
+    parser.add_argument("--documents", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--courses", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--hnsw-m", type=int, default=16)
+    parser.add_argument("--hnsw-ef-construction", type=int, default=200)
+    parser.add_argument("--hnsw-ef", type=int, default=64)
+    args = parser.parse_args()
+
+    ids, vectors, metadatas = synthetic(args.documents, args.dim, args.courses)
+    query_vectors, filters = synthetic_queries(vectors, metadatas, args.queries, args.courses)
+    truth = exact(ids, vectors, metadatas, query_vectors, filters, args.k)
+    del vectors
+
+    print(f"{args.documents} documents, dim {args.dim}, {args.queries} queries, k={args.k}")
+    print(f"{'backend':<10} {'build s':>8} {'open s':>7} {'p50 ms':>7} {'p99 ms':>7} {'recall':>7} {'file MB':>8} {'anon MB':>8}")
+    for backend in args.backends.split(","):
+        directory = tempfile.mkdtemp(prefix=f"vectorstore-{backend}-")
+        try:
+            built = run_child(build, backend, directory, args)
+            queried = built if "error" in built else run_child(query, backend, directory, args)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        if "error" in queried:
+            print(f"{backend:<10} failed: {queried['error']}")
+            continue
+        recall = np.mean([len(set(found) & expected) / max(1, len(expected)) for found, expected in zip(queried["found"], truth)])
+        print(
+            f"{backend:<10} {built['build_seconds']:>8.1f} {queried['open_seconds']:>7.2f} "
+            f"{percentile(queried['latencies'], 0.5) * 1000:>7.2f} {percentile(queried['latencies'], 0.99) * 1000:>7.2f} "
+            f"{recall:>7.3f} {queried['rss_file'] / 2**20:>8.1f} {queried['rss_anon'] / 2**20:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""Startup time and per-process memory of the API under different launch modes.
+
+Starts the server, waits until /health answers and reads RSS, PSS and shared memory
+of the master and every worker from /proc (Linux only):
+
+    python -m benchmarks.worker_memory --mode gunicorn --workers 4
+    python -m benchmarks.worker_memory --mode uvicorn --workers 4
+
+The report names the vectorstore backend of the served index generation. Only
+the memory-mapped backends (numpy, hnsw) are shared by the gunicorn workers; a
+Chroma store is reopened in every worker after the fork, so with Chroma the
+shared pages are the embedding model's. To measure a shared index, build the
+store with VECTORSTORE_BACKEND=numpy or hnsw first.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import requests
+
+from src.generations import current_generation, generation_path
+from src.setup import PERSIST_DIRECTORY
+from src.vectorstores import stored_backend
+
+
+def read_smaps_rollup(pid: int):
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup", "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 3 and parts[2] == "kB":
+                values[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    return {
+        "rss": values.get("Rss", 0),
+        "pss": values.get("Pss", 0),
+        "shared": values.get("Shared_Clean", 0) + values.get("Shared_Dirty", 0),
+    }
+
+
+def children(pid: int):
+    with open(f"/proc/{pid}/task/{pid}/children", "r") as f:
+        return [int(child) for child in f.read().split()]
+
+
+def served_backend(root: str):
+    generation = current_generation(root)
+    return stored_backend(generation_path(root, generation)) if generation else None
+
+
+def command(mode: str, workers: int, port: int):
+    if mode == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "src.app:app"], {
+            "WEB_CONCURRENCY": str(workers),
+            "PORT": str(port),
+        }
+    return [
+        sys.executable, "-m", "uvicorn", "src.app:app",
+        "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers),
+    ], {}
+
+
+def wait_until_ready(url: str, process, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"{url} did not become ready within {timeout}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=("gunicorn", "uvicorn"), default="gunicorn")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=7690)
+    parser.add_argument("--timeout", type=float, default=900)
+    parser.add_argument("--root", default=PERSIST_DIRECTORY, help="store directory the server serves")
+    args = parser.parse_args()
+
+    cmd, env = command(args.mode, args.workers, args.port)
+    started = time.monotonic()
+    process = subprocess.Popen(cmd, env={**os.environ, **env})
+    try:
+        wait_until_ready(f"http://127.0.0.1:{args.port}/health", process, args.timeout)
+        startup = time.monotonic() - started
+        # Give all workers time to finish booting before sampling.
+        time.sleep(5)
+
+        processes = [("master", process.pid)] + [("worker", pid) for pid in children(process.pid)]
+        # Read after startup, which builds (or restores) the index of an empty store
+        print(f"mode={args.mode} workers={args.workers} vectorstore={served_backend(args.root)} startup={startup:.1f}s")
+        print(f"{'role':<8}{'pid':>8}{'RSS MiB':>10}{'PSS MiB':>10}{'shared MiB':>12}")
+        total_pss = 0
+        for role, pid in processes:
+            memory = read_smaps_rollup(pid)
+            total_pss += memory["pss"]
+            print(f"{role:<8}{pid:>8}{memory['rss'] / 2**20:>10.0f}{memory['pss'] / 2**20:>10.0f}{memory['shared'] / 2**20:>12.0f}")
+        print(f"total PSS: {total_pss / 2**20:.0f} MiB")
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
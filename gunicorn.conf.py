@@ -0,0 +1,32 @@
+"""Multi-worker serving: gunicorn -c gunicorn.conf.py src.app:app
+
+The app is imported once in the master (preload_app), which loads the embedding
+model and opens the current index generation before the workers are forked. The
+workers share those pages copy-on-write instead of each loading their own copy.
+"""
+import gc
+import os
+import tempfile
+
+# Metrics of all workers are aggregated through files in this directory. Set before
+# anything imports prometheus_client, which picks its value class on import.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", tempfile.mkdtemp(prefix="moodle-rag-metrics-"))
+
+from prometheus_client import multiprocess
+
+bind = f"0.0.0.0:{os.getenv('PORT', '7680')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+# Building an index on first start can take a while, do not kill the workers meanwhile.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+
+def pre_fork(server, worker):
+    # Objects allocated so far (model, index) are moved out of the garbage collector's
+    # reach, so collections in the workers do not write to and un-share their pages.
+    gc.freeze()
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,176 @@
+"""Admission control for the LLM backends.
+
+Each limiter lets at most `max_concurrency` calls through to its backend. Further
+requests wait in a priority queue for at most `max_wait` seconds. Once `max_queue`
+requests are waiting, new ones are rejected immediately with Overloaded, which the
+API turns into a 503 with a Retry-After estimate instead of piling more work onto
+an already saturated LLM box.
+
+Limits apply per process; with several workers the backend sees up to
+workers * max_concurrency concurrent calls.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+from .metrics import ADMISSION_ACTIVE, ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+from .profiling import span
+
+# Lower values are served first.
+PRIORITY_TEACHER = 0
+PRIORITY_COURSE = 1
+PRIORITY_DEFAULT = 2
+# Precomputed answers (/chat/batch) only get slots no interactive request is waiting for.
+PRIORITY_BATCH = 3
+# How long work done in background threads (session compaction, cache warm-up) waits for a slot
+BACKGROUND_MAX_WAIT = float(os.getenv("BACKGROUND_ADMISSION_MAX_WAIT_SECONDS", "300"))
+
+TEACHER_KEYWORDS = ("teacher", "lehrer", "lehrende", "dozent", "trainer", "manager", "admin")
+COURSE_KEYWORDS = ("course", "kurs")
+
+
+class Overloaded(Exception):
+    def __init__(self, limiter: str, reason: str, retry_after: int):
+        super().__init__(f"{limiter} overloaded ({reason})")
+        self.limiter = limiter
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def priority_for(request) -> int:
+    """Teachers first, then requests made from a course page, then everyone else."""
+    usercontext = (request.usercontext or "").lower()
+    if any(keyword in usercontext for keyword in TEACHER_KEYWORDS):
+        return PRIORITY_TEACHER
+    if request.course_id or any(keyword in usercontext for keyword in COURSE_KEYWORDS):
+        return PRIORITY_COURSE
+    return PRIORITY_DEFAULT
+
+
+class AdmissionController:
+    def __init__(self, name: str, max_concurrency: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._active = 0
+        self._waiting = 0
+        self._heap = []
+        self._sequence = itertools.count()
+        # Moving average of how long a call holds its slot, used for Retry-After.
+        self._hold_time = 1.0
+        # The event loop serving the requests; the limiter's state is only touched from it.
+        self._loop = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self._hold_time * (self._waiting + 1) / self.max_concurrency))
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_DEFAULT, max_wait: Optional[float] = None):
+        with span(f"admission.{self.name}", priority=priority, queue_depth=self._waiting):
+            await self.acquire(priority, max_wait)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._hold_time = 0.8 * self._hold_time + 0.2 * (time.perf_counter() - started)
+            self.release()
+
+    @contextmanager
+    def thread_slot(self, priority: int = PRIORITY_BATCH, max_wait: Optional[float] = BACKGROUND_MAX_WAIT):
+        """slot() for code running in a thread of its own, next to the event loop serving requests.
+
+        The slot is taken and given back on that loop. Before the loop is known
+        (see bind()) or once it is closed, there are no requests to compete with
+        and the call goes through without a slot.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            yield
+            return
+        asyncio.run_coroutine_threadsafe(self.acquire(priority, max_wait), loop).result()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._hold_time = 0.8 * self._hold_time + 0.2 * (time.perf_counter() - started)
+            loop.call_soon_threadsafe(self.release)
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Set the loop thread_slot() takes its slots on; acquire() sets it as well."""
+        self._loop = loop
+
+    async def acquire(self, priority: int = PRIORITY_DEFAULT, max_wait: Optional[float] = None):
+        started = time.perf_counter()
+        self._loop = asyncio.get_running_loop()
+        if self._active < self.max_concurrency and self._waiting == 0:
+            self._grant()
+            ADMISSION_WAIT_SECONDS.labels(self.name, str(priority)).observe(0.0)
+            return
+
+        if self._waiting >= self.max_queue:
+            ADMISSION_REJECTED.labels(self.name, "queue_full").inc()
+            raise Overloaded(self.name, "queue_full", self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._sequence), future))
+        self._set_waiting(self._waiting + 1)
+        try:
+            await asyncio.wait_for(future, self.max_wait if max_wait is None else max_wait)
+        except asyncio.TimeoutError:
+            if not (future.done() and not future.cancelled()):
+                self._set_waiting(self._waiting - 1)
+                ADMISSION_REJECTED.labels(self.name, "timeout").inc()
+                raise Overloaded(self.name, "timeout", self.retry_after())
+            # The slot was granted just as the deadline passed; take it.
+        except asyncio.CancelledError:
+            # The client went away. Give the slot back if it was granted meanwhile.
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self._set_waiting(self._waiting - 1)
+            raise
+        ADMISSION_WAIT_SECONDS.labels(self.name, str(priority)).observe(time.perf_counter() - started)
+
+    def release(self):
+        self._active -= 1
+        ADMISSION_ACTIVE.labels(self.name).set(self._active)
+        # Hand the slot to the highest-priority waiter that is still waiting.
+        while self._heap and self._active < self.max_concurrency:
+            _, _, future = heapq.heappop(self._heap)
+            if future.done():
+                continue
+            self._set_waiting(self._waiting - 1)
+            self._grant()
+            future.set_result(None)
+
+    def _grant(self):
+        self._active += 1
+        ADMISSION_ACTIVE.labels(self.name).set(self._active)
+
+    def _set_waiting(self, waiting: int):
+        self._waiting = waiting
+        ADMISSION_QUEUE_DEPTH.labels(self.name).set(waiting)
+
+
+ROUTING_LIMITER = AdmissionController(
+    "routing",
+    max_concurrency=int(os.getenv("ROUTING_LLM_MAX_CONCURRENCY", "4")),
+    max_queue=int(os.getenv("ROUTING_LLM_MAX_QUEUE", "64")),
+    max_wait=float(os.getenv("LLM_ADMISSION_MAX_WAIT_SECONDS", "15")),
+)
+ANSWER_LIMITER = AdmissionController(
+    "answer",
+    max_concurrency=int(os.getenv("ANSWER_LLM_MAX_CONCURRENCY", "2")),
+    max_queue=int(os.getenv("ANSWER_LLM_MAX_QUEUE", "32")),
+    max_wait=float(os.getenv("LLM_ADMISSION_MAX_WAIT_SECONDS", "15")),
+)
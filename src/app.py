@@ -1,13 +1,27 @@
 import uvicorn
+from dotenv import load_dotenv
+
+# Loaded before the app modules, some of them read their configuration on import
+load_dotenv()
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from src.routes.batch_router import router as batch_router
 from src.routes.main_router import router as main_router
-from src.setup import load_embedding_function, load_vectorstore
+from src.setup import INGEST_MODE, IndexHandle, load_embedding_function, refresh_vectorstore
+from src.tenants import load_tenants
+from src.log import configure_logging
+from src.profiling import profiling_middleware
+from src.warmup import warm_caches_in_background
+from src.models.pool import ANSWER_POOL, ROUTING_POOL
+from src.admission import ANSWER_LIMITER, ROUTING_LIMITER
 from apscheduler.schedulers.background import BackgroundScheduler
-from dotenv import load_dotenv
+from functools import partial
+import asyncio
+import logging
 import os
 
-load_dotenv()
+configure_logging()
 
 # Initialize app
 app = FastAPI( )  
@@ -21,18 +35,60 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in per-request profiling (X-Profile header or PROFILE_SAMPLE_RATE)
+app.middleware("http")(profiling_middleware)
+
 # Store resources in app's state so they can be accessed in views
 app.state.EMBEDDINGFUNTION = load_embedding_function()
 
+# One index per Moodle site (TENANTS_FILE), all served with the same embedding model and LLM pools
+app.state.TENANTS = load_tenants()
+for tenant in app.state.TENANTS:
+    # Loaded before the server forks its workers (gunicorn --preload), so they share it
+    tenant.index = IndexHandle(app.state.EMBEDDINGFUNTION, tenant.persist_directory, tenant=tenant)
+    tenant.index.get()
+    # Not before the fork: workers warm the caches of the generations they open themselves
+    tenant.index.on_open = partial(warm_caches_in_background, tenant=tenant, default=tenant is app.state.TENANTS.default)
+app.state.INDEX = app.state.TENANTS.default.index
+
 def update_vectorstore():
-    app.state.VECTORSTORE = load_vectorstore(app.state.EMBEDDINGFUNTION)
+    # Every worker checks, only the one holding a tenant's refresh lock rebuilds it.
+    # Tenants are refreshed one after the other, so at most one ingest runs per process.
+    for tenant in app.state.TENANTS:
+        try:
+            if refresh_vectorstore(app.state.EMBEDDINGFUNTION, tenant.persist_directory, tenant.refresh_interval, tenant):
+                tenant.index.get(force=True)
+        except Exception:
+            logging.getLogger(__name__).exception("Refreshing the index of tenant %s failed", tenant.key)
+
+def follow_generations():
+    # With INGEST_MODE=worker, src.ingest_worker builds the indexes. Opening its new
+    # generations here rather than on the next request keeps that request fast.
+    for tenant in app.state.TENANTS:
+        try:
+            tenant.index.get()
+        except Exception:
+            logging.getLogger(__name__).exception("Opening the index of tenant %s failed", tenant.key)
 
-update_vectorstore()
 scheduler = BackgroundScheduler()
-scheduler.add_job(update_vectorstore, 'interval', days=1)
+if INGEST_MODE == "worker":
+    scheduler.add_job(follow_generations, 'interval', seconds=float(os.getenv("INDEX_CHECK_INTERVAL", "10")))
+else:
+    scheduler.add_job(update_vectorstore, 'interval', minutes=int(os.getenv("INDEX_REFRESH_CHECK_MINUTES", "60")))
+
+@app.on_event("startup")
+def start_background_threads():
+    # Runs in every worker after the fork, threads of the parent process do not survive it
+    scheduler.start()
+    ROUTING_POOL.start_health_checks()
+    ANSWER_POOL.start_health_checks()
+    # Session compaction and cache warm-up run in threads and take their LLM slots on this loop
+    ROUTING_LIMITER.bind(asyncio.get_running_loop())
+    ANSWER_LIMITER.bind(asyncio.get_running_loop())
 
 # Register routes
 app.include_router(main_router)
+app.include_router(batch_router)
 
 
 if __name__ == "__main__":
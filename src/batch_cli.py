@@ -0,0 +1,88 @@
+"""Pre-generate answers for a list of questions through /chat/batch.
+
+The input is either JSONL with one Query object per line or plain text with one
+question per line:
+
+    python -m src.batch_cli faq.txt --course-id 12 --output faq_answers.jsonl
+    python -m src.batch_cli onboarding.jsonl --url http://localhost:7680
+
+Results are written as JSONL in the order they complete; a summary with error
+count and latency percentiles goes to stderr.
+"""
+import argparse
+import json
+import sys
+from typing import Dict, Iterator, List
+
+import requests
+
+
+def read_items(path: str, course_id=None, usercontext=None) -> List[Dict]:
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line) if line.startswith("{") else {"message": line}
+            if course_id is not None:
+                item.setdefault("course_id", course_id)
+            if usercontext is not None:
+                item.setdefault("usercontext", usercontext)
+            items.append(item)
+    return items
+
+
+def run_batch(url: str, items: List[Dict], concurrency=None, timeout: float = 3600) -> Iterator[Dict]:
+    body = {"items": items}
+    if concurrency:
+        body["concurrency"] = concurrency
+    with requests.post(f"{url.rstrip('/')}/chat/batch", json=body, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-generate answers for a list of questions.")
+    parser.add_argument("input", help="JSONL file with Query objects or a text file with one question per line")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--output", help="JSONL output file (default: stdout)")
+    parser.add_argument("--course-id", help="course_id for items that do not set one")
+    parser.add_argument("--usercontext", help="usercontext for items that do not set one")
+    parser.add_argument("--batch-size", type=int, default=100, help="items per /chat/batch request")
+    parser.add_argument("--concurrency", type=int, help="concurrent LLM calls, capped by the server")
+    args = parser.parse_args()
+
+    items = read_items(args.input, args.course_id, args.usercontext)
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    errors = 0
+    totals = []
+    try:
+        for offset in range(0, len(items), args.batch_size):
+            for result in run_batch(args.url, items[offset:offset + args.batch_size], args.concurrency):
+                # Indices refer to the input file, not to the chunk that was sent.
+                result["index"] += offset
+                errors += result["error"] is not None
+                totals.append(result["timings"].get("total", 0.0))
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(
+        f"{len(totals)} answered, {errors} errors, "
+        f"p50 {percentile(totals, 0.5):.1f}s, p99 {percentile(totals, 0.99):.1f}s after batch start",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Single-flight coalescing of identical concurrent requests.
+
+The first request for a key starts the computation (the leader); requests with
+the same key that arrive while it runs join it (followers) and receive the same
+result. Chunks pushed during the computation are buffered, so a follower that
+joins late still replays the whole stream from the start.
+
+The computation runs in its own task: a leader that disconnects does not take
+the answer away from its followers. Coalescing is per process.
+"""
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+from .log import log_event
+from .metrics import COALESCED_FLIGHT_SIZE, COALESCED_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+def normalize(text: Optional[str]) -> str:
+    return " ".join((text or "").lower().split())
+
+
+def coalesce_key(*parts: Optional[str]) -> tuple:
+    return tuple(normalize(None if part is None else str(part)) for part in parts)
+
+
+class Flight:
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.chunks: List[str] = []
+        self.requests = 1
+        self.result = None
+        self.error: Optional[BaseException] = None
+        # Details the computation wants to share with every request, e.g. the routed context
+        self.info: Dict = {}
+        self._changed = asyncio.Event()
+        self._done = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def push(self, chunk: str):
+        if not chunk or self.done:
+            return
+        self.chunks.append(chunk)
+        self._notify()
+
+    def update_info(self, **info):
+        self.info.update(info)
+        self._notify()
+
+    def finish(self, result=None, error: Optional[BaseException] = None):
+        # A result that was not streamed is replayed as a single chunk.
+        if error is None and not self.chunks and isinstance(result, str):
+            self.chunks.append(result)
+        self.result = result
+        self.error = error
+        self._done.set()
+        self._notify()
+
+    def _notify(self):
+        # Wake everyone waiting on the current event and hand out a fresh one.
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        """The final result; raises the error of the computation."""
+        await self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    async def wait_for_info(self, key: str):
+        """Wait until the computation has shared `key` in info, or has ended without it."""
+        while key not in self.info and not self.done:
+            await self._changed.wait()
+
+    async def started(self):
+        """Wait until there is output to stream; raises if the computation failed before any."""
+        while not self.chunks and not self.done:
+            await self._changed.wait()
+        if not self.chunks and self.error is not None:
+            raise self.error
+
+    async def stream(self) -> AsyncIterator[str]:
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.chunks):
+                yield self.chunks[sent]
+                sent += 1
+            if self.done:
+                break
+            await changed.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Hashable, Flight] = {}
+        self._tasks = set()
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key: Hashable, compute: Callable[[Flight], Awaitable]) -> Flight:
+        """Attach to the flight for `key`, starting `compute(flight)` if there is none."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.requests += 1
+            self.followers += 1
+            COALESCED_REQUESTS.labels(self.name, "follower").inc()
+            return flight
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.leaders += 1
+        COALESCED_REQUESTS.labels(self.name, "leader").inc()
+        task = asyncio.create_task(self._lead(flight, compute))
+        # Keep a reference, the event loop only holds weak ones.
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return flight
+
+    async def _lead(self, flight: Flight, compute: Callable[[Flight], Awaitable]):
+        try:
+            result = await compute(flight)
+        except BaseException as e:
+            flight.finish(error=e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        else:
+            flight.finish(result)
+        finally:
+            del self._flights[flight.key]
+            COALESCED_FLIGHT_SIZE.labels(self.name).observe(flight.requests)
+            if flight.requests > 1:
+                log_event(logger, logging.INFO, "coalesce.flight", flight=self.name, requests=flight.requests)
+
+    def stats(self) -> Dict:
+        total = self.leaders + self.followers
+        return {
+            "in_flight": len(self._flights),
+            "requests": total,
+            "computations": self.leaders,
+            "coalesced": self.followers,
+            # Share of requests that were answered without a computation of their own.
+            "coalescing_ratio": round(self.followers / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,100 @@
+"""Latency budget of a /chat request and the fallbacks of its stages.
+
+The deadline starts when the request arrives (CHAT_DEADLINE_SECONDS, 0 for
+none) and is kept in a context variable, so the flight task and the stage
+threads see it. Each stage may take its own budget, capped by whatever is left
+of the deadline; when it runs over, the request continues with a fallback:
+
+    routing       ROUTING_BUDGET_SECONDS    Course-Context for requests with a course_id,
+                                            CHAT_FALLBACK_CONTEXT for the others
+    retrieval     RETRIEVAL_BUDGET_SECONDS  the documents last retrieved for the same
+                                            query, or none
+    user_profile  RETRIEVAL_BUDGET_SECONDS  no profile of the user (see src.user_profile)
+    generation    the rest of the deadline  the answer generated so far, marked as cut
+                                            short, or a list of the retrieved sources
+
+A request whose deadline runs out while it waits for its tenant's chat slot
+(see src.tenants) has nothing to fall back on and is answered with 504.
+
+A stage that runs over is abandoned, not interrupted: its thread finishes in
+the background. A late retrieval or profile still fills its cache, and a
+generation stops at its next token. Every fallback is counted in
+moodle_rag_degradations_total.
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional
+
+from .log import log_event
+from .metrics import DEGRADATIONS
+
+logger = logging.getLogger(__name__)
+
+CHAT_DEADLINE = float(os.getenv("CHAT_DEADLINE_SECONDS", "60"))
+ROUTING_BUDGET = float(os.getenv("ROUTING_BUDGET_SECONDS", "8"))
+RETRIEVAL_BUDGET = float(os.getenv("RETRIEVAL_BUDGET_SECONDS", "5"))
+
+# Stage calls run here rather than in the server's thread pool, whose tasks cannot
+# be abandoned. Threads are started on demand, i.e. in the workers after the fork.
+STAGE_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("CHAT_STAGE_THREADS", "64")), thread_name_prefix="chat-stage")
+
+_DEADLINE: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str):
+        super().__init__(f"{stage} ran over the request deadline")
+        self.stage = stage
+
+
+@contextmanager
+def deadline(seconds: float = CHAT_DEADLINE):
+    """Set the deadline for this context and the tasks and stage threads started from it."""
+    reset = _DEADLINE.set(time.monotonic() + seconds if seconds > 0 else None)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(reset)
+
+
+def remaining() -> Optional[float]:
+    """Seconds until the deadline, None without one."""
+    expires = _DEADLINE.get()
+    return None if expires is None else expires - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def budget(stage_budget: Optional[float] = None) -> Optional[float]:
+    """Seconds a stage may take: its own budget capped by the deadline, None for no limit."""
+    left = remaining()
+    if not stage_budget or stage_budget <= 0:
+        return left
+    return stage_budget if left is None else min(stage_budget, left)
+
+
+async def run_stage(stage: str, fn, *args, stage_budget: Optional[float] = None):
+    """fn(*args) in a stage thread, raising DeadlineExceeded once the budget is used up."""
+    timeout = budget(stage_budget)
+    if timeout is not None and timeout <= 0:
+        raise DeadlineExceeded(stage)
+    context = contextvars.copy_context()
+    future = asyncio.get_running_loop().run_in_executor(STAGE_EXECUTOR, functools.partial(context.run, fn, *args))
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded(stage)
+
+
+def degraded(stage: str, fallback: str, **fields):
+    DEGRADATIONS.labels(stage, fallback).inc()
+    log_event(logger, logging.WARNING, "chat.degraded", stage=stage, fallback=fallback, **fields)
@@ -0,0 +1,203 @@
+"""Near-duplicate detection for ingest.
+
+Copied courses and boilerplate sections ("Allgemeines", "Ankündigungen") produce
+many almost identical documents. Every document gets a MinHash signature over
+its word 3-grams; locality-sensitive hashing over bands of the signature finds
+candidates, and a candidate whose estimated Jaccard similarity reaches the
+threshold is treated as a duplicate.
+
+Duplicates are not embedded. Their first occurrence stays as the canonical
+document and is tagged with `in_course_<id>` for every course that contains a
+copy, so course filters can still find it (see course_filter). It also records
+where the dropped copies were: `duplicates` counts them, and duplicate_course_ids,
+duplicate_module_ids, duplicate_names and duplicate_urls list their values one
+per line (Chroma metadata must be scalar), at most INGEST_DEDUP_MAX_REFERENCES (20) each.
+
+The detector keeps the signature, the band keys and the metadata of every
+canonical document until the run ends, about 3 KB per document with the default
+64 permutations and 16 bands. That is the memory floor of a deduplicating ingest
+(roughly 300 MB for 100k documents); INGEST_DEDUP=false avoids it.
+
+A resumed ingest gets the detector's state back from the ingest checkpoint:
+every completed item records its canonical documents with their signatures
+(checkpoint()) and the metadata it gave canonical documents of earlier items,
+and restore() replays them before the first new item is collapsed.
+"""
+import os
+import re
+import zlib
+from array import array
+from collections import Counter
+from random import Random
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .metrics import INGEST_DUPLICATES
+
+DEDUP_DOC_TYPES = ("section", "module", "content")
+DEDUP_MAX_REFERENCES = int(os.getenv("INGEST_DEDUP_MAX_REFERENCES", "20"))
+# Lists kept in the canonical document, and the fields of a duplicate they collect (the first one set)
+REFERENCE_FIELDS = (
+    ("duplicate_course_ids", ("course_id",)),
+    ("duplicate_module_ids", ("module_id",)),
+    ("duplicate_names", ("name", "filename")),
+    ("duplicate_urls", ("url",)),
+)
+
+_MERSENNE = (1 << 61) - 1
+_WORD = re.compile(r"\w+")
+
+
+def course_flag(course_id) -> str:
+    return f"in_course_{course_id}"
+
+
+def course_filter(course_id) -> dict:
+    """Matches documents of a course, including canonical copies shared with other courses."""
+    return {"$or": [{"course_id": {"$eq": course_id}}, {course_flag(course_id): {"$eq": True}}]}
+
+
+def add_reference(metadata: dict, key: str, value, limit: int = DEDUP_MAX_REFERENCES):
+    """Add value to the newline-separated list metadata[key], unless it is there or the list is full."""
+    if value is None or value == "":
+        return
+    values = metadata[key].split("\n") if metadata.get(key) else []
+    if str(value) in values or len(values) >= limit:
+        return
+    metadata[key] = "\n".join(values + [str(value)])
+
+
+def shingles(text: str, size: int = 3) -> set:
+    words = _WORD.findall(text.lower())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        rng = Random(seed)
+        self.num_perm = num_perm
+        self._permutations = [(rng.randrange(1, _MERSENNE), rng.randrange(0, _MERSENNE)) for _ in range(num_perm)]
+
+    def signature(self, text: str) -> array:
+        hashes = [zlib.crc32(shingle.encode("utf-8")) for shingle in shingles(text)]
+        # 32-bit values keep the signatures of a large site small.
+        return array("I", (min((a * h + b) % _MERSENNE for h in hashes) & 0xFFFFFFFF for a, b in self._permutations))
+
+
+def similarity(a: array, b: array) -> float:
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+class Deduplicator:
+    """Collapses near-duplicate documents across all items of one ingest run."""
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 16, doc_types: Sequence[str] = DEDUP_DOC_TYPES):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.doc_types = set(doc_types)
+        self.hasher = MinHasher(num_perm)
+        self._buckets: Dict[int, List[str]] = {}
+        self._signatures: Dict[str, array] = {}
+        # Metadata of every canonical document as written to the collection, with its course flags.
+        self._metadata: Dict[str, dict] = {}
+        self.documents = 0
+        self.duplicates = Counter()
+        self.saved_characters = 0
+
+    def collapse(self, ids: List[str], documents: List) -> Tuple[List[str], List, Dict[str, dict]]:
+        """Drop the duplicates from one item's documents.
+
+        Returns the remaining ids and documents and the metadata updates for
+        canonical documents of earlier items that gained a course.
+        """
+        kept_ids, kept_documents, updates = [], [], {}
+        current = {}
+        for id, document in zip(ids, documents):
+            self.documents += 1
+            doc_type = document.metadata.get("doc_type")
+            if doc_type not in self.doc_types:
+                kept_ids.append(id)
+                kept_documents.append(document)
+                continue
+
+            signature = self.hasher.signature(document.page_content)
+            canonical = self._find(doc_type, signature)
+            course_id = document.metadata.get("course_id")
+            if canonical is None:
+                if course_id is not None:
+                    document.metadata[course_flag(course_id)] = True
+                self._add(id, doc_type, signature, document.metadata)
+                current[id] = document
+                kept_ids.append(id)
+                kept_documents.append(document)
+                continue
+
+            self.duplicates[doc_type] += 1
+            INGEST_DUPLICATES.labels(doc_type).inc()
+            self.saved_characters += len(document.page_content)
+            metadata = self._metadata[canonical]
+            if course_id is not None:
+                metadata[course_flag(course_id)] = True
+            metadata["duplicates"] = metadata.get("duplicates", 0) + 1
+            for key, fields in REFERENCE_FIELDS:
+                add_reference(metadata, key, next((document.metadata[field] for field in fields if document.metadata.get(field)), None))
+            if canonical in current:
+                # Not written yet, the upsert of this item carries the flags.
+                current[canonical].metadata.update(metadata)
+            else:
+                updates[canonical] = dict(metadata)
+        return kept_ids, kept_documents, updates
+
+    def checkpoint(self, ids: List[str], metadatas: List[dict]) -> List[Dict]:
+        """The canonical documents among ids, with their signatures, for restore()."""
+        return [
+            {"id": id, "signature": self._signatures[id].tobytes().hex(), "metadata": metadata}
+            for id, metadata in zip(ids, metadatas)
+            if id in self._signatures
+        ]
+
+    def restore(self, canonical: List[Dict], updates: Dict[str, dict]):
+        """Re-add the canonical documents and metadata updates of an item completed by an interrupted run."""
+        for entry in canonical:
+            metadata = entry["metadata"]
+            self._add(entry["id"], metadata.get("doc_type"), array("I", bytes.fromhex(entry["signature"])), metadata)
+        for id, metadata in updates.items():
+            if id in self._metadata:
+                self._metadata[id] = dict(metadata)
+
+    def _find(self, doc_type: str, signature: array) -> Optional[str]:
+        best, best_similarity = None, self.threshold
+        seen = set()
+        for key in self._band_keys(doc_type, signature):
+            for candidate in self._buckets.get(key, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                candidate_similarity = similarity(signature, self._signatures[candidate])
+                if candidate_similarity >= best_similarity:
+                    best, best_similarity = candidate, candidate_similarity
+        return best
+
+    def _add(self, id: str, doc_type: str, signature: array, metadata: dict):
+        self._signatures[id] = signature
+        self._metadata[id] = dict(metadata)
+        for key in self._band_keys(doc_type, signature):
+            self._buckets.setdefault(key, []).append(id)
+
+    def _band_keys(self, doc_type: str, signature: array):
+        # Hashed to one int per band, which is most of the detector's memory. A collision
+        # only adds a candidate, and candidates are compared by their signatures.
+        for band in range(self.bands):
+            yield hash((doc_type, band, signature[band * self.rows:(band + 1) * self.rows].tobytes()))
+
+    def stats(self) -> Dict:
+        duplicates = sum(self.duplicates.values())
+        return {
+            "documents": self.documents,
+            "duplicates": duplicates,
+            "by_doc_type": dict(self.duplicates),
+            "shrink_ratio": round(duplicates / self.documents, 4) if self.documents else 0.0,
+            "saved_characters": self.saved_characters,
+        }
@@ -0,0 +1,175 @@
+"""Compact digests of the scraped site, built at ingest time.
+
+Next to the regular documents, ingest stores three kinds of digest documents:
+
+    site_digest     the course catalogue: one line per course, split into parts
+    course_digest   the outline of one course: its sections and their modules
+    section_digest  one section with the names and descriptions of its modules
+
+They are generated deterministically from the scraped tree, so the same site
+always gives the same text (which also keeps the LLM prefix cache warm). Broad
+questions ("Welche Kurse gibt es zu X?") are answered from the catalogue instead
+of a wide retrieval over individual course documents.
+"""
+import html
+import os
+import re
+import weakref
+from typing import Iterable, Iterator, List, Optional
+
+from langchain.docstore.document import Document
+
+from .retrieval import get_documents, retrieve_many
+
+SITE_DIGEST_KEY = "site_digest"
+
+# Catalogue lines have to stay short: the whole catalogue goes into one prompt.
+CATALOGUE_SUMMARY_CHARS = 160
+CATALOGUE_SECTIONS = 8
+OUTLINE_SUMMARY_CHARS = 600
+MODULE_DESCRIPTION_CHARS = 160
+COURSES_PER_SITE_DIGEST = int(os.getenv("SITE_DIGEST_COURSES_PER_PART", "40"))
+SITE_DIGEST_PROMPT_PARTS = int(os.getenv("SITE_DIGEST_PROMPT_PARTS", "2"))
+
+_TAG = re.compile(r"<[^>]+>")
+
+
+def plain_text(value: Optional[str], limit: Optional[int] = None) -> str:
+    """Strip HTML, collapse whitespace and cut to `limit` characters at a word boundary."""
+    text = " ".join(html.unescape(_TAG.sub(" ", value or "")).split())
+    if limit and len(text) > limit:
+        text = text[:limit].rsplit(" ", 1)[0] + " …"
+    return text
+
+
+class CourseDigest:
+    __slots__ = ("course_id", "name", "text")
+
+    def __init__(self, course):
+        self.course_id = str(course.id)
+        self.name = course.name
+        lines = [f"Kursübersicht: {course.name} (ID {course.id})"]
+        if course.url:
+            lines.append(f"URL: {course.url}")
+        summary = plain_text(course.summary, OUTLINE_SUMMARY_CHARS)
+        if summary:
+            lines.append(f"Zusammenfassung: {summary}")
+        if course.sections:
+            lines.append("Abschnitte:")
+            for index, section in enumerate(course.sections, start=1):
+                modules = ", ".join(f"{module.name} ({module.modname})" for module in section.modules)
+                lines.append(f"{index}. {section.name}" + (f": {modules}" if modules else ""))
+        self.text = "\n".join(lines)
+
+    def __str__(self):
+        return self.text
+
+    def asdict(self):
+        return {
+            "course_id": self.course_id,
+            "name": self.name,
+            "doc_type": "course_digest",
+        }
+
+
+class SectionDigest:
+    __slots__ = ("course_id", "name", "section_index", "text")
+
+    def __init__(self, course, section, section_index: int):
+        self.course_id = str(course.id)
+        self.name = section.name
+        self.section_index = section_index
+        lines = [f"Abschnitt {section_index}: {section.name} im Kurs {course.name}"]
+        description = plain_text(section.description, OUTLINE_SUMMARY_CHARS)
+        if description:
+            lines.append(f"Beschreibung: {description}")
+        if section.modules:
+            lines.append("Module:")
+            for module in section.modules:
+                description = plain_text(module.description, MODULE_DESCRIPTION_CHARS)
+                lines.append(f"- {module.name} ({module.modname})" + (f": {description}" if description else ""))
+        self.text = "\n".join(lines)
+
+    def __str__(self):
+        return self.text
+
+    def asdict(self):
+        return {
+            "course_id": self.course_id,
+            "name": self.name,
+            "section_index": self.section_index,
+            "doc_type": "section_digest",
+        }
+
+
+class SiteDigest:
+    __slots__ = ("name", "part", "parts", "text")
+
+    def __init__(self, site, entries: List[str], part: int, parts: int, courses: int):
+        self.name = site.name
+        self.part = part
+        self.parts = parts
+        header = f"Kurskatalog {site.name}: {courses} Kurse"
+        if parts > 1:
+            header += f" (Teil {part} von {parts})"
+        self.text = "\n".join([header] + entries)
+
+    def __str__(self):
+        return self.text
+
+    def asdict(self):
+        return {
+            "name": self.name,
+            "part": self.part,
+            "parts": self.parts,
+            "doc_type": "site_digest",
+        }
+
+
+def catalogue_entry(course) -> str:
+    """One catalogue line; without loaded sections it only has name and summary."""
+    entry = f"- {course.name} (ID {course.id})"
+    summary = plain_text(course.summary, CATALOGUE_SUMMARY_CHARS)
+    if summary:
+        entry += f": {summary}"
+    if course.sections:
+        names = [section.name for section in course.sections if section.name][:CATALOGUE_SECTIONS]
+        more = len(course.sections) - len(names)
+        entry += " — Abschnitte: " + ", ".join(names) + (f" und {more} weitere" if more > 0 else "")
+    return entry
+
+
+def iter_course_digests(course) -> Iterator:
+    """The outline of a course and one digest per section that has modules or a description."""
+    yield CourseDigest(course)
+    for index, section in enumerate(course.sections, start=1):
+        if section.modules or plain_text(section.description):
+            yield SectionDigest(course, section, index)
+
+
+def site_digests(site, entries: Iterable[str]) -> List[SiteDigest]:
+    entries = list(entries)
+    chunks = [entries[start:start + COURSES_PER_SITE_DIGEST] for start in range(0, len(entries), COURSES_PER_SITE_DIGEST)] or [[]]
+    return [SiteDigest(site, chunk, part, len(chunks), len(entries)) for part, chunk in enumerate(chunks, start=1)]
+
+
+# Digests only change with a new index, so they are read once per opened vectorstore.
+_SITE_DIGESTS = weakref.WeakKeyDictionary()
+
+
+def load_site_digest(vectorstore) -> List[Document]:
+    try:
+        return _SITE_DIGESTS[vectorstore]
+    except KeyError:
+        pass
+    documents = sorted(get_documents(vectorstore, {"doc_type": "site_digest"}), key=lambda d: d.metadata.get("part", 0))
+    _SITE_DIGESTS[vectorstore] = documents
+    return documents
+
+
+def site_digest_context(vectorstore, query: str) -> List[Document]:
+    """The catalogue for a Site-Context prompt; large catalogues contribute their best matching parts."""
+    documents = load_site_digest(vectorstore)
+    if len(documents) <= SITE_DIGEST_PROMPT_PARTS:
+        return documents
+    return retrieve_many(vectorstore, [(query, {"doc_type": "site_digest"})], k=SITE_DIGEST_PROMPT_PARTS)
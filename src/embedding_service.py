@@ -0,0 +1,196 @@
+"""Standalone embedding service shared by all API workers.
+
+Loads the embedding model once and serves query and document embeddings over HTTP.
+Requests arriving within a short window are merged into one encoder batch, so
+concurrent queries from many workers cost roughly one forward pass.
+
+    python -m src.embedding_service --host 127.0.0.1 --port 7681
+
+API workers use it by setting EMBEDDING_SERVICE_URL (see load_embedding_function).
+"""
+import argparse
+import asyncio
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, List, Literal
+
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI
+from fastapi import Response as HTTPResponse
+from pydantic import BaseModel
+
+from .log import configure_logging
+from .metrics import EMBEDDING_BATCH_SECONDS, EMBEDDING_BATCH_SIZE, render_metrics
+from .retrieval import encode_queries
+from .setup import load_local_embedding_function
+
+
+class PendingRequest:
+    """An embedding request waiting for (the rest of) its vectors."""
+
+    __slots__ = ("texts", "future", "vectors")
+
+    def __init__(self, texts: List[str], future: asyncio.Future):
+        self.texts = texts
+        self.future = future
+        self.vectors: List[List[float]] = []
+
+
+class MicroBatcher:
+    """Collects embedding requests for up to `window` seconds and encodes them together.
+
+    Encoder batches hold at most `max_batch_size` texts; a larger request is
+    encoded in several batches. Queries go first: they are on the path of a
+    chat request, while documents come from ingest. A query that arrives while
+    a large document request is being encoded waits for one batch, not for the
+    whole request.
+    """
+
+    def __init__(self, embedding, max_batch_size: int = 64, window: float = 0.005):
+        self.embedding = embedding
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._queue: asyncio.Queue = None
+        self._pending: Dict[str, Deque[PendingRequest]] = {"query": deque(), "document": deque()}
+        # The encoder is not re-entrant; batches run one after another.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed")
+
+    async def submit(self, kind: str, texts: List[str]) -> List[List[float]]:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((kind, texts, future))
+        return await future
+
+    async def run(self):
+        self._queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._waiting():
+                self._take(await self._queue.get())
+                deadline = loop.time() + self.window
+                while self._waiting() < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        self._take(await asyncio.wait_for(self._queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+            await self._process("query" if self._pending["query"] else "document")
+            # Requests that queued while the batch encoded are considered for the next one.
+            while not self._queue.empty():
+                self._take(self._queue.get_nowait())
+
+    def _take(self, item):
+        kind, texts, future = item
+        if not texts:
+            future.set_result([])
+            return
+        self._pending[kind].append(PendingRequest(texts, future))
+
+    def _waiting(self) -> int:
+        return sum(len(request.texts) - len(request.vectors) for requests in self._pending.values() for request in requests)
+
+    async def _process(self, kind: str):
+        requests = self._pending[kind]
+        # The caller of a cancelled request is gone
+        while requests and requests[0].future.done():
+            requests.popleft()
+        if not requests:
+            return
+        # Up to max_batch_size texts from the front; all but the last request are completed
+        batch, size = [], 0
+        for request in requests:
+            if size >= self.max_batch_size:
+                break
+            start = len(request.vectors)
+            end = min(len(request.texts), start + self.max_batch_size - size)
+            batch.append((request, start, end))
+            size += end - start
+        texts = [text for request, start, end in batch for text in request.texts[start:end]]
+        try:
+            vectors = await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, kind, texts)
+        except Exception as e:
+            for request, _, _ in batch:
+                requests.remove(request)
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        offset = 0
+        for request, start, end in batch:
+            request.vectors.extend(vectors[offset:offset + end - start])
+            offset += end - start
+        while requests and len(requests[0].vectors) == len(requests[0].texts):
+            request = requests.popleft()
+            if not request.future.done():
+                request.future.set_result(request.vectors)
+
+    def _encode(self, kind: str, texts: List[str]) -> List[List[float]]:
+        start = time.perf_counter()
+        if kind == "query":
+            vectors = encode_queries(self.embedding, texts)
+        else:
+            vectors = self.embedding.embed_documents(texts)
+        EMBEDDING_BATCH_SIZE.labels(kind).observe(len(texts))
+        EMBEDDING_BATCH_SECONDS.labels(kind).observe(time.perf_counter() - start)
+        return vectors
+
+
+class EmbedRequest(BaseModel):
+    texts: List[str]
+    kind: Literal["query", "document"] = "query"
+
+
+class EmbedResponse(BaseModel):
+    embeddings: List[List[float]]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.BATCHER = MicroBatcher(
+        load_local_embedding_function(),
+        max_batch_size=int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "64")),
+        window=float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5")) / 1000,
+    )
+    task = asyncio.create_task(app.state.BATCHER.run())
+    yield
+    task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.post("/embed", response_model=EmbedResponse)
+async def embed(request: EmbedRequest):
+    if not request.texts:
+        return EmbedResponse(embeddings=[])
+    return EmbedResponse(embeddings=await app.state.BATCHER.submit(request.kind, request.texts))
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return HTTPResponse(content=body, media_type=content_type)
+
+
+def main():
+    load_dotenv()
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Run the shared embedding service.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7681)
+    args = parser.parse_args()
+    # A single process: the point of the service is one copy of the model.
+    uvicorn.run(app, host=args.host, port=args.port, workers=1)
+
+
+if __name__ == "__main__":
+    main()
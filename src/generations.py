@@ -0,0 +1,151 @@
+"""Versioned index generations inside the store directory.
+
+Every refresh builds a complete index into generations/<id>/ and then atomically
+points CURRENT at it. Readers only ever open published generations, so a refresh
+never exposes a half-built index, and other processes notice a new generation by
+re-reading CURRENT.
+
+A store without CURRENT is a legacy single-directory store and is used as is.
+"""
+import fcntl
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+GENERATIONS_DIRNAME = "generations"
+CURRENT_FILENAME = "CURRENT"
+MANIFEST_FILENAME = "manifest.json"
+REFRESH_LOCK_FILENAME = "refresh.lock"
+LEGACY_GENERATION = "legacy"
+
+
+def current_generation(root: str) -> Optional[str]:
+    """Id of the published generation, LEGACY_GENERATION for old stores, None for an empty store."""
+    try:
+        with open(os.path.join(root, CURRENT_FILENAME), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    if os.path.exists(os.path.join(root, "chroma.sqlite3")):
+        return LEGACY_GENERATION
+    return None
+
+
+def generation_path(root: str, generation: str) -> str:
+    if generation == LEGACY_GENERATION:
+        return root
+    return os.path.join(root, GENERATIONS_DIRNAME, generation)
+
+
+def new_generation(root: str) -> str:
+    generation = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+    os.makedirs(generation_path(root, generation), exist_ok=True)
+    return generation
+
+
+def unpublished_generations(root: str):
+    current = current_generation(root)
+    published = "" if current in (None, LEGACY_GENERATION) else current
+    directory = os.path.join(root, GENERATIONS_DIRNAME)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        generation for generation in os.listdir(directory)
+        if generation > published and not os.path.exists(os.path.join(directory, generation, MANIFEST_FILENAME))
+    )
+
+
+def read_manifest(root: str, generation: str) -> Dict:
+    try:
+        with open(os.path.join(generation_path(root, generation), MANIFEST_FILENAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def publish_generation(root: str, generation: str, manifest: Dict, published_at: Optional[datetime] = None):
+    """Point CURRENT at the generation.
+
+    `published_at` keeps the original time of a generation built elsewhere (an
+    imported snapshot), so its age and with it the next refresh stay right.
+    """
+    path = generation_path(root, generation)
+    published_at = published_at or datetime.now(timezone.utc)
+    manifest = dict(manifest, generation=generation, published_at=published_at.isoformat())
+    with open(os.path.join(path, MANIFEST_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    tmp_path = os.path.join(root, CURRENT_FILENAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(generation)
+        f.flush()
+        os.fsync(f.fileno())
+    timestamp = published_at.timestamp()
+    os.utime(tmp_path, (timestamp, timestamp))
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILENAME))
+
+
+def generation_age(root: str) -> Optional[float]:
+    """Seconds since the current generation was published (or the legacy store was written)."""
+    generation = current_generation(root)
+    if generation is None:
+        return None
+    if generation == LEGACY_GENERATION:
+        return time.time() - os.path.getmtime(os.path.join(root, "chroma.sqlite3"))
+    return time.time() - os.path.getmtime(os.path.join(root, CURRENT_FILENAME))
+
+
+def prune_generations(root: str, keep: int = 2):
+    """Delete all but the newest `keep` published generations.
+
+    The previous generation is kept by default because other workers may still be
+    serving from it until they notice the switch.
+    """
+    directory = os.path.join(root, GENERATIONS_DIRNAME)
+    current = current_generation(root)
+    if not os.path.isdir(directory) or current in (None, LEGACY_GENERATION):
+        return
+    published = sorted(
+        generation for generation in os.listdir(directory)
+        if generation <= current and os.path.exists(os.path.join(directory, generation, MANIFEST_FILENAME))
+    )
+    for generation in published[:-keep]:
+        shutil.rmtree(os.path.join(directory, generation), ignore_errors=True)
+
+
+class RefreshLock:
+    """Inter-process lock that makes exactly one process rebuild the index.
+
+    Non-blocking by default: acquire() returns False if another process holds it.
+    """
+
+    def __init__(self, root: str, blocking: bool = False):
+        self.path = os.path.join(root, REFRESH_LOCK_FILENAME)
+        self.blocking = blocking
+        self._file = None
+
+    def acquire(self) -> bool:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "a+")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
@@ -0,0 +1,239 @@
+"""Portable snapshots of a built index generation.
+
+A snapshot is a tar file (gzip-compressed if the name ends in .gz) holding one
+published generation, i.e. the vectors, document metadata and the auxiliary
+index files of its vectorstore backend (Chroma's sqlite and HNSW segments,
+vectors.bin/records.jsonl/hnsw.bin), behind a manifest:
+
+    snapshot.json  format version, generation, embedding model, backend, document
+                   count, scrape time and the size and sha256 of every file
+    index/...      the files of the generation directory
+
+    python -m src.index_snapshot export --output /snapshots/
+    python -m src.index_snapshot import /snapshots/ --root data/stores/moodlestore
+
+With INDEX_SNAPSHOT_PATH (a snapshot file, or a directory whose newest
+snapshot is used) a process that finds its store empty imports the snapshot
+instead of scraping and embedding the site. A snapshot built with another
+embedding model is refused, as is one whose files do not match their checksums;
+in both cases the index is built from Moodle as before.
+"""
+import argparse
+import glob
+import hashlib
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tarfile
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from .generations import (
+    GENERATIONS_DIRNAME,
+    LEGACY_GENERATION,
+    RefreshLock,
+    current_generation,
+    generation_path,
+    prune_generations,
+    publish_generation,
+    read_manifest,
+)
+
+logger = logging.getLogger(__name__)
+
+INDEX_SNAPSHOT_PATH = os.getenv("INDEX_SNAPSHOT_PATH", "")
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_MANIFEST = "snapshot.json"
+INDEX_PREFIX = "index/"
+GENERATION_ID = re.compile(r"^\d{8}T\d{6}$")
+CHUNK_SIZE = 1 << 20
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def export_snapshot(root: str, output: str, generation: Optional[str] = None) -> str:
+    """Write a published generation (default: the current one) to a snapshot file; returns its path."""
+    generation = generation or current_generation(root)
+    if generation in (None, LEGACY_GENERATION):
+        raise SnapshotError(f"{root} has no published index generation to export")
+    manifest = read_manifest(root, generation)
+    if not manifest:
+        raise SnapshotError(f"Generation {generation} is not published")
+    path = generation_path(root, generation)
+
+    files = []
+    for directory, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            full_path = os.path.join(directory, name)
+            files.append({
+                "path": os.path.relpath(full_path, path).replace(os.sep, "/"),
+                "size": os.path.getsize(full_path),
+                "sha256": file_sha256(full_path),
+            })
+    snapshot = {
+        "format": SNAPSHOT_FORMAT,
+        "generation": generation,
+        "embedding_model": manifest.get("embedding_model"),
+        "vectorstore": manifest.get("vectorstore") or "chroma",
+        "documents": manifest.get("documents"),
+        # Publishing follows the end of the ingest, the content is as fresh as that
+        "scraped_at": manifest.get("published_at"),
+        "exported_at": datetime.now(timezone.utc).isoformat(),
+        "files": files,
+    }
+
+    if os.path.isdir(output):
+        output = os.path.join(output, f"index-{generation}.tar")
+    tmp_path = f"{output}.tmp"
+    with tarfile.open(tmp_path, "w:gz" if output.endswith(".gz") else "w") as tar:
+        # The manifest goes first, so an import can check it before reading any vectors
+        data = json.dumps(snapshot, indent=2).encode("utf-8")
+        info = tarfile.TarInfo(SNAPSHOT_MANIFEST)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        for entry in files:
+            tar.add(os.path.join(path, *entry["path"].split("/")), arcname=INDEX_PREFIX + entry["path"], recursive=False)
+    os.replace(tmp_path, output)
+    logger.info("Index generation %s exported to %s", generation, output)
+    return output
+
+
+def latest_snapshot(path: str) -> str:
+    """The snapshot file itself, or the newest snapshot in a directory."""
+    if not os.path.isdir(path):
+        return path
+    snapshots = sorted(glob.glob(os.path.join(path, "index-*.tar")) + glob.glob(os.path.join(path, "index-*.tar.gz")))
+    if not snapshots:
+        raise SnapshotError(f"No index snapshot in {path}")
+    # Named after their generation, which sorts by time
+    return max(snapshots, key=lambda snapshot: os.path.basename(snapshot).split(".")[0])
+
+
+def read_snapshot_manifest(tar: tarfile.TarFile) -> Dict:
+    member = tar.next()
+    if member is None or member.name != SNAPSHOT_MANIFEST:
+        raise SnapshotError("Not an index snapshot, the manifest is missing")
+    snapshot = json.load(tar.extractfile(member))
+    if snapshot.get("format") != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"Unsupported snapshot format {snapshot.get('format')}")
+    if not GENERATION_ID.match(str(snapshot.get("generation"))):
+        raise SnapshotError(f"Invalid generation {snapshot.get('generation')!r}")
+    return snapshot
+
+
+def import_snapshot(root: str, path: str, embedding_model: str, force: bool = False) -> Optional[str]:
+    """Unpack and publish a snapshot; returns its generation, or None if the store is already as new.
+
+    The caller holds the store's RefreshLock.
+    """
+    path = latest_snapshot(path)
+    with tarfile.open(path, "r:*") as tar:
+        snapshot = read_snapshot_manifest(tar)
+        generation = snapshot["generation"]
+        if snapshot.get("embedding_model") != embedding_model:
+            raise SnapshotError(f"Snapshot {path} was embedded with {snapshot.get('embedding_model')}, not {embedding_model}")
+        current = current_generation(root)
+        if not force and current not in (None, LEGACY_GENERATION) and current >= generation:
+            logger.info("Index generation %s is not older than snapshot %s, keeping it", current, path)
+            return None
+
+        target = generation_path(root, generation)
+        staging = f"{target}.import"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        try:
+            _extract(tar, snapshot, staging)
+            shutil.rmtree(target, ignore_errors=True)
+            os.replace(staging, target)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    manifest = read_manifest(root, generation)
+    published_at = manifest.get("published_at")
+    publish_generation(
+        root,
+        generation,
+        dict(manifest, snapshot=os.path.basename(path)),
+        published_at=datetime.fromisoformat(published_at) if published_at else None,
+    )
+    prune_generations(root)
+    logger.info("Index generation %s imported from %s (%s documents)", generation, path, snapshot.get("documents"))
+    return generation
+
+
+def _extract(tar: tarfile.TarFile, snapshot: Dict, directory: str):
+    """Copy the index files to `directory`, checking every one against the manifest."""
+    expected = {entry["path"]: entry for entry in snapshot["files"]}
+    seen = set()
+    for member in tar:
+        if member.isdir() or member.name == SNAPSHOT_MANIFEST:
+            continue
+        name = member.name[len(INDEX_PREFIX):] if member.name.startswith(INDEX_PREFIX) else None
+        # Only the listed regular files are written, so no link or ../ entry gets out of the directory
+        entry = expected.get(name)
+        if entry is None or not member.isfile() or name in seen:
+            raise SnapshotError(f"Unexpected entry {member.name} in snapshot")
+        parts = name.split("/")
+        if any(part in ("", ".", "..") for part in parts):
+            raise SnapshotError(f"Invalid path {member.name} in snapshot")
+        destination = os.path.join(directory, *parts)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        source = tar.extractfile(member)
+        with open(destination, "wb") as f:
+            while chunk := source.read(CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        if size != entry["size"] or digest.hexdigest() != entry["sha256"]:
+            raise SnapshotError(f"Checksum mismatch for {name}")
+        seen.add(name)
+    missing = set(expected) - seen
+    if missing:
+        raise SnapshotError(f"Snapshot is incomplete, missing {sorted(missing)[:5]}")
+
+
+def main():
+    # Imported here: setup loads the vectorstore libraries and imports this module
+    from .setup import EMBEDDING_MODEL_NAME, PERSIST_DIRECTORY
+
+    parser = argparse.ArgumentParser(description="Export or import index snapshots.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the current index generation to a snapshot")
+    export_parser.add_argument("--root", default=PERSIST_DIRECTORY, help="store directory")
+    export_parser.add_argument("--generation", help="generation to export instead of the current one")
+    export_parser.add_argument("--output", default=".", help="snapshot file or directory")
+    import_parser = commands.add_parser("import", help="publish a snapshot as the current index generation")
+    import_parser.add_argument("snapshot", help="snapshot file, or a directory to take the newest from")
+    import_parser.add_argument("--root", default=PERSIST_DIRECTORY, help="store directory")
+    import_parser.add_argument("--force", action="store_true", help="import even if the store has a newer generation")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        print(export_snapshot(args.root, args.output, args.generation))
+        return
+    os.makedirs(os.path.join(args.root, GENERATIONS_DIRNAME), exist_ok=True)
+    # Serving processes follow the new CURRENT on their next index check
+    with RefreshLock(args.root, blocking=True):
+        generation = import_snapshot(args.root, args.snapshot, EMBEDDING_MODEL_NAME, force=args.force)
+    print(generation or "store is up to date")
+
+
+if __name__ == "__main__":
+    main()
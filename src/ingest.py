@@ -0,0 +1,360 @@
+"""Pipelined ingest of the Moodle site into the vectorstore.
+
+Scraping (network), document extraction (CPU), embedding (CPU, batched) and
+vectorstore writes run in their own threads, connected by bounded queues. A full
+queue blocks the stage in front of it, so a slow embedder throttles the scraper
+instead of letting scraped courses pile up in memory.
+
+Completed courses are appended to a checkpoint file. If the process dies, the
+next run skips those courses and continues with the first unfinished one.
+
+Near-duplicate documents are collapsed before embedding (see src.dedup). The
+checkpoint also keeps the detector's state for the completed courses, so a
+resumed run still collapses new copies of their documents.
+
+Every course also gets its digests (see src.digests); the site-wide course
+catalogue is written last, once all courses have been scraped.
+
+With max_documents set (a tenant's index limit, see src.tenants) the scraper
+stops taking new courses once that many documents are in the store or on their
+way; the skipped courses are counted in the report.
+
+Under PROFILE_INGEST every stage thread is a span with one child span per item
+(see src.profiling).
+"""
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from langchain.docstore.document import Document
+
+from .dedup import Deduplicator
+from .digests import SITE_DIGEST_KEY, catalogue_entry, iter_course_digests, site_digests
+from .log import log_event
+from .metrics import (
+    INGEST_QUEUE_DEPTH,
+    INGEST_STAGE_BUSY_SECONDS,
+    INGEST_STAGE_DOCUMENTS,
+    INGEST_STAGE_ITEMS,
+)
+from .profiling import add_span, span
+from .scrape_moodle import MoodleSiteInfo, get_course_sections, iter_course_nodes
+from .vectorstores import collection_of
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILENAME = "ingest_checkpoint.jsonl"
+SITE_KEY = "site"
+
+_DONE = object()
+
+
+class _Aborted(Exception):
+    pass
+
+
+class WorkItem:
+    """The documents of one course (or of the site itself) moving through the pipeline."""
+
+    __slots__ = ("key", "nodes", "ids", "texts", "metadatas", "embeddings", "catalogue", "updates")
+
+    def __init__(self, key: str, nodes: list, catalogue: Optional[str] = None):
+        self.key = key
+        self.nodes = nodes
+        self.ids = self.texts = self.metadatas = self.embeddings = None
+        # The course's line in the site catalogue, kept in the checkpoint for resumed runs.
+        self.catalogue = catalogue
+        # Metadata of canonical documents from earlier items that this item's duplicates point to.
+        self.updates = None
+
+
+class StageStats:
+    __slots__ = ("name", "items", "documents", "busy")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.documents = 0
+        self.busy = 0.0
+
+    def asdict(self, elapsed: float):
+        return {
+            "items": self.items,
+            "documents": self.documents,
+            "busy_seconds": round(self.busy, 2),
+            "documents_per_second": round(self.documents / elapsed, 2) if elapsed else 0.0,
+            "utilization": round(self.busy / elapsed, 2) if elapsed else 0.0,
+        }
+
+
+def to_document(node) -> Document:
+    # Chroma only accepts str, int, float and bool metadata values.
+    metadata = {key: value for key, value in node.asdict().items() if value is not None}
+    return Document(page_content=str(node), metadata=metadata)
+
+
+def load_checkpoint(path: str) -> Dict[str, Dict]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        records = (json.loads(line) for line in f if line.strip())
+        return {record["key"]: record for record in records}
+
+
+class IngestPipeline:
+    STAGES = ("scrape", "extract", "embed", "upsert")
+
+    def __init__(
+        self,
+        collection,
+        embedding,
+        checkpoint_path: str,
+        queue_size: int = int(os.getenv("INGEST_QUEUE_SIZE", "4")),
+        embed_batch_size: int = int(os.getenv("INGEST_EMBED_BATCH_SIZE", "64")),
+        report_interval: float = float(os.getenv("INGEST_REPORT_INTERVAL", "30")),
+        get_sections=get_course_sections,
+        dedup: Optional[Deduplicator] = None,
+        max_documents: Optional[int] = None,
+        on_progress: Optional[Callable[[Dict], None]] = None,
+    ):
+        self.collection = collection
+        self.embedding = embedding
+        self.checkpoint_path = checkpoint_path
+        self.embed_batch_size = embed_batch_size
+        self.report_interval = report_interval
+        self.get_sections = get_sections
+        self.dedup = dedup
+        self.max_documents = max_documents
+        self.skipped_courses = 0
+        # Called with every progress report, e.g. to publish it in the store's status file
+        self.on_progress = on_progress
+        # One queue in front of every stage but the first.
+        self.queues = {stage: queue.Queue(maxsize=queue_size) for stage in self.STAGES[1:]}
+        self.stats = {stage: StageStats(stage) for stage in self.STAGES}
+        self._failed = threading.Event()
+        self._finished = threading.Event()
+        # Unlike a failed stage, a cancelled run does not wait for the queued items
+        self._cancelled = threading.Event()
+        self._error: Optional[BaseException] = None
+        self._started = None
+
+    def run(self, site: MoodleSiteInfo) -> Dict:
+        """Ingest the site, resuming after the last checkpointed course. Returns the final report."""
+        completed = load_checkpoint(self.checkpoint_path)
+        if completed:
+            logger.info("Resuming ingest, %d items already completed", len(completed))
+            if self.dedup is not None:
+                # In checkpoint order, an item's updates apply to the metadata restored before it
+                for record in completed.values():
+                    self.dedup.restore(record.get("canonical", []), record.get("updates", {}))
+
+        self._started = time.perf_counter()
+        threads = [
+            self._thread("scrape", self._scrape, site, completed),
+            self._thread("extract", self._extract),
+            self._thread("embed", self._embed),
+            self._thread("upsert", self._upsert, bool(completed)),
+        ]
+        reporter = threading.Thread(target=self._report_periodically, name="ingest-report", daemon=True)
+        for thread in threads:
+            thread.start()
+        reporter.start()
+        try:
+            for thread in threads:
+                thread.join()
+        except BaseException:
+            # E.g. KeyboardInterrupt: stop the stages at their next item instead of
+            # leaving them running, the checkpoint keeps what they completed.
+            self._cancelled.set()
+            self._failed.set()
+            for thread in threads:
+                thread.join()
+            raise
+        finally:
+            self._finished.set()
+
+        report = self.report()
+        log_event(logger, logging.INFO, "ingest.finished", **report)
+        if self._error is not None:
+            raise self._error
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return report
+
+    def report(self) -> Dict:
+        elapsed = time.perf_counter() - self._started if self._started else 0.0
+        return {
+            "elapsed_seconds": round(elapsed, 2),
+            "stages": {name: stats.asdict(elapsed) for name, stats in self.stats.items()},
+            "queue_depth": {name: q.qsize() for name, q in self.queues.items()},
+            "dedup": self.dedup.stats() if self.dedup is not None else None,
+            "skipped_courses": self.skipped_courses,
+        }
+
+    def _report_periodically(self):
+        while not self._finished.wait(self.report_interval):
+            report = self.report()
+            for name, depth in report["queue_depth"].items():
+                INGEST_QUEUE_DEPTH.labels(name).set(depth)
+            log_event(logger, logging.INFO, "ingest.progress", **report)
+            if self.on_progress is not None:
+                try:
+                    self.on_progress(report)
+                except Exception:
+                    logger.exception("Could not report ingest progress")
+
+    def _thread(self, stage, fn, *args) -> threading.Thread:
+        # Each stage runs in a copy of the caller's context, so a profiled run sees its spans.
+        context = contextvars.copy_context()
+        return threading.Thread(target=context.run, args=(self._guard, stage, fn, *args), name=f"ingest-{stage}")
+
+    def _guard(self, stage, fn, *args):
+        try:
+            with span(f"ingest.{stage}"):
+                fn(*args)
+        except _Aborted:
+            pass
+        except BaseException as e:
+            logger.exception("Ingest stage %s failed", stage)
+            self._error = e
+            self._failed.set()
+
+    def _put(self, stage: str, item):
+        while True:
+            if self._cancelled.is_set():
+                raise _Aborted()
+            try:
+                self.queues[stage].put(item, timeout=0.5)
+                INGEST_QUEUE_DEPTH.labels(stage).set(self.queues[stage].qsize())
+                return
+            except queue.Full:
+                if self._failed.is_set():
+                    raise _Aborted()
+
+    def _get(self, stage: str):
+        while True:
+            if self._cancelled.is_set():
+                raise _Aborted()
+            try:
+                return self.queues[stage].get(timeout=0.5)
+            except queue.Empty:
+                if self._failed.is_set():
+                    raise _Aborted()
+
+    def _record(self, stage: str, item: WorkItem, started: float):
+        busy = time.perf_counter() - started
+        documents = len(item.ids) if item.ids is not None else len(item.nodes)
+        stats = self.stats[stage]
+        stats.items += 1
+        stats.documents += documents
+        stats.busy += busy
+        INGEST_STAGE_ITEMS.labels(stage).inc()
+        INGEST_STAGE_DOCUMENTS.labels(stage).inc(documents)
+        INGEST_STAGE_BUSY_SECONDS.labels(stage).inc(busy)
+        add_span(f"ingest.{stage}.item", busy, key=item.key, documents=documents)
+
+    def _scrape(self, site: MoodleSiteInfo, completed: Dict[str, Dict]):
+        if SITE_KEY not in completed:
+            self._put("extract", WorkItem(SITE_KEY, [site]))
+        catalogue = []
+        # Counted before collapsing duplicates, so the cap errs on the small side
+        documents = self.collection.count() if self.max_documents is not None else 0
+        for course in site.courses:
+            key = str(course.id)
+            if key in completed:
+                catalogue.append(completed[key].get("catalogue") or catalogue_entry(course))
+                continue
+            if self.max_documents is not None and documents >= self.max_documents:
+                self.skipped_courses += 1
+                continue
+            started = time.perf_counter()
+            course.sections = self.get_sections(course.id)
+            item = WorkItem(key, list(iter_course_nodes(course)) + list(iter_course_digests(course)), catalogue_entry(course))
+            documents += len(item.nodes)
+            catalogue.append(item.catalogue)
+            # The nodes keep the sections alive until the item leaves the pipeline.
+            course.sections = []
+            self._record("scrape", item, started)
+            self._put("extract", item)
+        if self.skipped_courses:
+            log_event(logger, logging.WARNING, "ingest.document_limit", max_documents=self.max_documents, skipped_courses=self.skipped_courses)
+        if SITE_DIGEST_KEY not in completed:
+            self._put("extract", WorkItem(SITE_DIGEST_KEY, site_digests(site, catalogue)))
+        self._put("extract", _DONE)
+
+    def _extract(self):
+        while (item := self._get("extract")) is not _DONE:
+            started = time.perf_counter()
+            documents = [to_document(node) for node in item.nodes]
+            # Ids are assigned before collapsing, so they do not depend on what was seen before.
+            item.ids = [f"{item.key}:{index}" for index in range(len(documents))]
+            if self.dedup is not None:
+                item.ids, documents, item.updates = self.dedup.collapse(item.ids, documents)
+            item.texts = [document.page_content for document in documents]
+            item.metadatas = [document.metadata for document in documents]
+            item.nodes = None
+            self._record("extract", item, started)
+            self._put("embed", item)
+        self._put("embed", _DONE)
+
+    def _embed(self):
+        while (item := self._get("embed")) is not _DONE:
+            started = time.perf_counter()
+            item.embeddings = []
+            for start in range(0, len(item.texts), self.embed_batch_size):
+                if self._cancelled.is_set():
+                    raise _Aborted()
+                item.embeddings.extend(self.embedding.embed_documents(item.texts[start:start + self.embed_batch_size]))
+            self._record("embed", item, started)
+            self._put("upsert", item)
+        self._put("upsert", _DONE)
+
+    def _upsert(self, resuming: bool):
+        with open(self.checkpoint_path, "a", encoding="utf-8") as checkpoint:
+            while (item := self._get("upsert")) is not _DONE:
+                started = time.perf_counter()
+                if resuming and item.key != SITE_KEY:
+                    # A course interrupted mid-write may have left documents behind.
+                    where = {"doc_type": "site_digest"} if item.key == SITE_DIGEST_KEY else {"course_id": item.key}
+                    self.collection.delete(where=where)
+                if item.ids:
+                    self.collection.upsert(
+                        ids=item.ids,
+                        embeddings=item.embeddings,
+                        metadatas=item.metadatas,
+                        documents=item.texts,
+                    )
+                if item.updates:
+                    self.collection.update(ids=list(item.updates), metadatas=list(item.updates.values()))
+                record = {"key": item.key}
+                if item.catalogue is not None:
+                    record["catalogue"] = item.catalogue
+                if self.dedup is not None and item.ids:
+                    record["canonical"] = self.dedup.checkpoint(item.ids, item.metadatas)
+                if item.updates:
+                    record["updates"] = item.updates
+                checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                self._record("upsert", item, started)
+
+
+def run_ingest(db, embedding, site: MoodleSiteInfo, persist_directory: str, **kwargs) -> Dict:
+    if os.getenv("INGEST_DEDUP", "true").lower() in ("1", "true", "yes"):
+        kwargs.setdefault("dedup", Deduplicator(threshold=float(os.getenv("INGEST_DEDUP_THRESHOLD", "0.85"))))
+    pipeline = IngestPipeline(
+        collection_of(db),
+        embedding,
+        checkpoint_path=os.path.join(persist_directory, CHECKPOINT_FILENAME),
+        **kwargs,
+    )
+    return pipeline.run(site)
+
+
+def ingest_incomplete(persist_directory: str) -> bool:
+    return os.path.exists(os.path.join(persist_directory, CHECKPOINT_FILENAME))
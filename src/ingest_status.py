@@ -0,0 +1,66 @@
+"""Progress and outcome of the index builds of a store.
+
+Whichever process builds a generation (the ingest worker, or an API worker with
+INGEST_MODE=inline) records it in ingest_status.json in the store directory:
+
+    state         running, published or failed
+    generation    the generation being built or last built
+    started_at    start of the build, finished_at its end
+    progress      the latest ingest report (stage throughput, queue depths),
+                  updated every INGEST_REPORT_INTERVAL seconds
+    documents     documents in the published generation
+    error         why the last build failed
+    worker        pid, host and next check of the ingest worker
+    updated_at    last write; a running build that stopped updating has died
+
+The file is replaced atomically, so readers in other processes never see half
+of it. GET /ingest/status shows it for every tenant next to the generation
+that is served.
+"""
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Dict
+
+from .generations import current_generation, generation_age
+
+STATUS_FILENAME = "ingest_status.json"
+
+# The ingest reporter thread and the build write the same file
+_lock = threading.Lock()
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def read_status(root: str) -> Dict:
+    try:
+        with open(os.path.join(root, STATUS_FILENAME), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def update_status(root: str, **fields) -> Dict:
+    """Merge `fields` into the store's status file; returns the new status."""
+    path = os.path.join(root, STATUS_FILENAME)
+    with _lock:
+        status = dict(read_status(root), **fields, updated_at=now())
+        os.makedirs(root, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(status, f, indent=2)
+        os.replace(tmp_path, path)
+    return status
+
+
+def index_status(root: str) -> Dict:
+    """The build status together with the published generation and its age."""
+    age = generation_age(root)
+    return dict(
+        read_status(root),
+        current_generation=current_generation(root),
+        age_seconds=round(age) if age is not None else None,
+    )
@@ -0,0 +1,151 @@
+"""Scraping and embedding in a process of their own.
+
+With INGEST_MODE=worker the API processes never build an index: they open the
+generations this worker publishes and switch to a new one within
+INDEX_CHECK_INTERVAL seconds, so refreshes do not compete with requests for
+the GIL and CPU, and a crashing build does not take the API down.
+
+    python -m src.ingest_worker                        # check every tenant each INGEST_WORKER_CHECK_MINUTES
+    python -m src.ingest_worker --once                 # one pass, e.g. from cron
+    python -m src.ingest_worker --once --force --tenant academy
+
+A pass builds every tenant whose index is missing or older than its refresh
+interval, one after the other; an empty store is restored from its snapshot if
+it has one. Builds hold the store's refresh lock, so a second worker (or an API
+process in inline mode) never runs the same build at the same time. A killed
+build resumes from its ingest checkpoint on the next pass. Progress and
+outcome go to the store's status file (see src.ingest_status).
+
+The worker limits itself before loading the embedding model:
+
+    INGEST_NICE           scheduling priority increment (default 10)
+    INGEST_MAX_MEMORY_MB  address space limit, a runaway build fails with
+                          MemoryError instead of pushing the host into swap
+    INGEST_CPU_THREADS    threads torch and the BLAS libraries embed with
+"""
+import argparse
+import logging
+import os
+import resource
+import signal
+import socket
+import threading
+from datetime import datetime, timedelta, timezone
+
+from dotenv import load_dotenv
+
+from .ingest_status import update_status
+from .log import configure_logging
+
+logger = logging.getLogger(__name__)
+
+# Before the configuration below is read, as in src.app
+load_dotenv()
+
+INGEST_NICE = int(os.getenv("INGEST_NICE", "10"))
+INGEST_MAX_MEMORY_MB = int(os.getenv("INGEST_MAX_MEMORY_MB", "0"))
+INGEST_CPU_THREADS = int(os.getenv("INGEST_CPU_THREADS", "0"))
+INGEST_WORKER_CHECK_MINUTES = float(os.getenv("INGEST_WORKER_CHECK_MINUTES", os.getenv("INDEX_REFRESH_CHECK_MINUTES", "60")))
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TOKENIZERS_PARALLELISM")
+
+
+def limit_resources(nice: int = INGEST_NICE, max_memory_mb: int = INGEST_MAX_MEMORY_MB, cpu_threads: int = INGEST_CPU_THREADS):
+    """Apply the worker's limits; must run before torch is imported."""
+    if nice:
+        os.nice(nice)
+    if max_memory_mb:
+        limit = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if cpu_threads:
+        for variable in THREAD_VARIABLES[:-1]:
+            os.environ[variable] = str(cpu_threads)
+        # The tokenizers' own pool would come on top of the limit
+        os.environ[THREAD_VARIABLES[-1]] = "false"
+
+
+def run_pass(embedding, tenants, force: bool = False) -> int:
+    """Refresh every tenant that is due; returns the number of generations published."""
+    # Imported here: setup loads the vectorstore libraries, which must see the limits
+    from .setup import refresh_vectorstore
+
+    published = 0
+    for tenant in tenants:
+        try:
+            generation = refresh_vectorstore(embedding, tenant.persist_directory, 0 if force else tenant.refresh_interval, tenant)
+        except Exception:
+            # Recorded in the status file, the other tenants still get their turn
+            logger.exception("Refreshing the index of tenant %s failed", tenant.key)
+            continue
+        if generation:
+            published += 1
+            logger.info("Tenant %s now serves index generation %s", tenant.key, generation)
+    return published
+
+
+def report_worker(tenants, next_check=None, running=True):
+    worker = {
+        "running": running,
+        "pid": os.getpid(),
+        "host": socket.gethostname(),
+        "next_check_at": next_check.isoformat() if next_check else None,
+    }
+    for tenant in tenants:
+        try:
+            update_status(tenant.persist_directory, worker=worker)
+        except OSError:
+            logger.exception("Could not write the ingest status of tenant %s", tenant.key)
+
+
+def main():
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Build and refresh the indexes outside the API processes.")
+    parser.add_argument("--once", action="store_true", help="run a single pass and exit")
+    parser.add_argument("--force", action="store_true", help="rebuild even indexes that are not due")
+    parser.add_argument("--tenant", action="append", help="only this tenant (repeatable)")
+    parser.add_argument("--interval", type=float, default=INGEST_WORKER_CHECK_MINUTES, help="minutes between passes")
+    parser.add_argument("--profile", help="profile the builds with these PROFILE_INGEST options, e.g. cprofile,memory")
+    args = parser.parse_args()
+
+    limit_resources()
+    if args.profile:
+        os.environ["PROFILE_INGEST"] = args.profile
+
+    from .setup import load_embedding_function
+    from .tenants import load_tenants
+
+    registry = load_tenants()
+    try:
+        tenants = [registry.get(key) for key in args.tenant] if args.tenant else list(registry)
+    except KeyError as e:
+        parser.error(f"Unknown tenant {e}")
+    embedding = load_embedding_function()
+
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        # The first signal lets a build in progress finish. A second one interrupts
+        # it: the pipeline stops its stage threads at their next item (or embedding
+        # batch) and the process exits. Either way the next pass resumes from the
+        # ingest checkpoint.
+        if stop.is_set():
+            raise KeyboardInterrupt
+        stop.set()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, on_signal)
+
+    while not stop.is_set():
+        report_worker(tenants)
+        run_pass(embedding, tenants, force=args.force)
+        if args.once:
+            break
+        # --force applies to the first pass only
+        args.force = False
+        report_worker(tenants, datetime.now(timezone.utc) + timedelta(minutes=args.interval))
+        stop.wait(args.interval * 60)
+    report_worker(tenants, running=False)
+    logger.info("Ingest worker stopped")
+
+
+if __name__ == "__main__":
+    main()
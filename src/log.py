@@ -0,0 +1,38 @@
+import json
+import logging
+import os
+import sys
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = None):
+    """Route all log records to stdout as one JSON object per line.
+
+    The level defaults to the LOG_LEVEL environment variable (INFO if unset).
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+
+
+def log_event(logger: logging.Logger, level: int, event: str, **fields):
+    # Callable field values are evaluated lazily, so expensive dumps (prompts,
+    # retrieved documents) cost nothing when the record would be dropped anyway.
+    if logger.isEnabledFor(level):
+        fields = {key: value() if callable(value) else value for key, value in fields.items()}
+        logger.log(level, event, extra={"fields": fields})
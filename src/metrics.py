@@ -0,0 +1,237 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+from .profiling import span
+
+# Buckets cover everything from a cached embedding lookup to a slow local LLM generation.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+STAGE_LATENCY = Histogram(
+    "moodle_rag_stage_seconds",
+    "Latency of the individual /chat pipeline stages.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "moodle_rag_llm_time_to_first_token_seconds",
+    "Time until the LLM backend streamed the first token.",
+    ["role"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOTAL_TIME = Histogram(
+    "moodle_rag_llm_total_seconds",
+    "Total time of an LLM generation.",
+    ["role"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "moodle_rag_llm_tokens_total",
+    "Tokens reported by the LLM backend.",
+    ["role", "direction"],
+)
+CACHE_REQUESTS = Counter(
+    "moodle_rag_cache_requests_total",
+    "Cache lookups by cache and result.",
+    ["cache", "result"],
+)
+ROUTING_OUTCOMES = Counter(
+    "moodle_rag_routing_outcomes_total",
+    "Contexts chosen by predict_context.",
+    ["context"],
+)
+# multiprocess_mode only takes effect when PROMETHEUS_MULTIPROC_DIR is set (multi-worker serving).
+VECTORSTORE_DOCUMENTS = Gauge(
+    "moodle_rag_vectorstore_documents",
+    "Number of documents in the loaded vectorstore of a tenant.",
+    ["tenant"],
+    multiprocess_mode="max",
+)
+IN_FLIGHT_REQUESTS = Gauge(
+    "moodle_rag_in_flight_requests",
+    "Number of /chat requests currently being processed.",
+    multiprocess_mode="livesum",
+)
+
+INGEST_QUEUE_DEPTH = Gauge(
+    "moodle_rag_ingest_queue_depth",
+    "Items waiting in the queue in front of an ingest stage.",
+    ["stage"],
+    multiprocess_mode="max",
+)
+INGEST_STAGE_ITEMS = Counter(
+    "moodle_rag_ingest_stage_items_total",
+    "Courses processed by an ingest stage.",
+    ["stage"],
+)
+INGEST_STAGE_DOCUMENTS = Counter(
+    "moodle_rag_ingest_stage_documents_total",
+    "Documents processed by an ingest stage.",
+    ["stage"],
+)
+INGEST_STAGE_BUSY_SECONDS = Counter(
+    "moodle_rag_ingest_stage_busy_seconds_total",
+    "Time an ingest stage spent working rather than waiting on its queues.",
+    ["stage"],
+)
+
+INGEST_DUPLICATES = Counter(
+    "moodle_rag_ingest_duplicates_total",
+    "Near-duplicate documents collapsed into a canonical document at ingest.",
+    ["doc_type"],
+)
+
+EMBEDDING_BATCH_SIZE = Histogram(
+    "moodle_rag_embedding_batch_size",
+    "Texts encoded per micro-batch by the embedding service.",
+    ["kind"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+EMBEDDING_BATCH_SECONDS = Histogram(
+    "moodle_rag_embedding_batch_seconds",
+    "Time spent encoding one micro-batch in the embedding service.",
+    ["kind"],
+    buckets=LATENCY_BUCKETS,
+)
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "moodle_rag_admission_queue_depth",
+    "Requests waiting for an LLM slot.",
+    ["limiter"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_ACTIVE = Gauge(
+    "moodle_rag_admission_active",
+    "LLM calls currently holding a slot.",
+    ["limiter"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "moodle_rag_admission_wait_seconds",
+    "Time requests waited for an LLM slot.",
+    ["limiter", "priority"],
+    buckets=LATENCY_BUCKETS,
+)
+ADMISSION_REJECTED = Counter(
+    "moodle_rag_admission_rejected_total",
+    "Requests shed because the queue was full or their wait deadline passed.",
+    ["limiter", "reason"],
+)
+
+LLM_BACKEND_REQUESTS = Counter(
+    "moodle_rag_llm_backend_requests_total",
+    "LLM calls per backend by result.",
+    ["role", "backend", "result"],
+)
+LLM_BACKEND_LATENCY = Histogram(
+    "moodle_rag_llm_backend_seconds",
+    "Duration of successful LLM calls per backend.",
+    ["role", "backend"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_BACKEND_OUTSTANDING = Gauge(
+    "moodle_rag_llm_backend_outstanding",
+    "LLM calls currently running on a backend.",
+    ["role", "backend"],
+    multiprocess_mode="livesum",
+)
+LLM_BACKEND_AVAILABLE = Gauge(
+    "moodle_rag_llm_backend_available",
+    "1 if the backend currently receives traffic, 0 if it is ejected.",
+    ["role", "backend"],
+    multiprocess_mode="livemin",
+)
+
+COALESCED_REQUESTS = Counter(
+    "moodle_rag_coalesced_requests_total",
+    "Requests that started a computation (leader) or joined an identical one in flight (follower).",
+    ["flight", "role"],
+)
+COALESCED_FLIGHT_SIZE = Histogram(
+    "moodle_rag_coalesced_flight_size",
+    "Number of requests answered by one computation.",
+    ["flight"],
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100),
+)
+
+CHAT_SESSIONS = Gauge(
+    "moodle_rag_chat_sessions",
+    "Chat sessions held in memory, per tenant.",
+    ["tenant"],
+    multiprocess_mode="livesum",
+)
+HISTORY_COMPACTIONS = Counter(
+    "moodle_rag_history_compactions_total",
+    "Compactions of chat session history into a summary, by result.",
+    ["result"],
+)
+
+DEGRADATIONS = Counter(
+    "moodle_rag_degradations_total",
+    "/chat stages that ran over their latency budget, by stage and the fallback used.",
+    ["stage", "fallback"],
+)
+
+TENANT_CHAT_REQUESTS = Counter(
+    "moodle_rag_tenant_chat_requests_total",
+    "/chat requests and /chat/batch items per tenant by result (ok, shed, timeout, error).",
+    ["tenant", "status"],
+)
+
+USER_PROFILE_FETCHES = Counter(
+    "moodle_rag_user_profile_fetches_total",
+    "User profiles fetched from Moodle, by result (ok, error).",
+    ["result"],
+)
+
+QUERY_LOG_RECORDS = Counter(
+    "moodle_rag_query_log_records_total",
+    "Request records handed to the query log, by result (written, dropped).",
+    ["result"],
+)
+
+# Stage durations of the current request, for the query log
+_STAGE_TIMINGS: ContextVar[Optional[Dict[str, float]]] = ContextVar("stage_timings", default=None)
+
+
+def collect_stage_timings() -> Dict[str, float]:
+    """Collect the stages observed from here on in this context (and tasks/threads started from it)."""
+    timings: Dict[str, float] = {}
+    _STAGE_TIMINGS.set(timings)
+    return timings
+
+
+def record_stage_timing(stage: str, seconds: float):
+    timings = _STAGE_TIMINGS.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds, 4)
+
+
+@contextmanager
+def observe_stage(stage: str):
+    """Observe STAGE_LATENCY; in a profiled request the stage is also a span."""
+    start = time.perf_counter()
+    try:
+        with span(stage):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage).observe(elapsed)
+        record_stage_timing(stage, elapsed)
+
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def render_metrics():
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Aggregate the samples written by all worker processes.
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
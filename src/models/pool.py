@@ -0,0 +1,220 @@
+"""Load-balanced, health-checked pools of OpenAI-compatible LLM backends.
+
+Each model role (routing, answer) has its own pool, configured with a comma-separated
+list of base URLs. Calls go to the available backend with the fewest outstanding
+requests. A backend that fails several times in a row, or whose moving-average
+latency exceeds the slow threshold, is ejected for eject_seconds. One ejected
+because background probes of its /models endpoint failed is brought back as soon
+as a probe answers again; a failing or slow one only once its time is up, as a
+node whose completions fail often still serves /models. Connection errors fail
+over to the next backend as long as no output has been streamed yet.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import openai
+import requests
+
+from ..deadline import DeadlineExceeded
+from ..log import log_event
+from ..metrics import LLM_BACKEND_AVAILABLE, LLM_BACKEND_LATENCY, LLM_BACKEND_OUTSTANDING, LLM_BACKEND_REQUESTS
+from ..profiling import span
+from .utils import create_chat_openai_with_base, generate
+
+logger = logging.getLogger(__name__)
+
+
+class NoBackendAvailable(Exception):
+    pass
+
+
+class Backend:
+    def __init__(self, url: str, model):
+        self.url = url
+        self.model = model
+        self.outstanding = 0
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        # "failing", "slow" or "probe_failed" while ejected
+        self.eject_reason = None
+
+    def available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def asdict(self, now: float):
+        return {
+            "url": self.url,
+            "available": self.available(now),
+            "outstanding": self.outstanding,
+            "latency_seconds": round(self.latency, 3) if self.latency is not None else None,
+            "requests": self.requests,
+            "errors": self.errors,
+            "consecutive_failures": self.consecutive_failures,
+            "eject_reason": self.eject_reason,
+        }
+
+
+class BackendPool:
+    def __init__(
+        self,
+        role: str,
+        urls: List[str],
+        max_tokens: int = 512,
+        failure_threshold: int = int(os.getenv("LLM_BACKEND_FAILURE_THRESHOLD", "3")),
+        slow_threshold: float = float(os.getenv("LLM_BACKEND_SLOW_SECONDS", "60")),
+        eject_seconds: float = float(os.getenv("LLM_BACKEND_EJECT_SECONDS", "30")),
+        probe_interval: float = float(os.getenv("LLM_BACKEND_PROBE_INTERVAL", "10")),
+    ):
+        self.role = role
+        self.backends = [
+            Backend(url, create_chat_openai_with_base(url, openai_api_key="lm-studio", max_tokens=max_tokens))
+            for url in urls
+        ]
+        self.failure_threshold = failure_threshold
+        self.slow_threshold = slow_threshold
+        self.eject_seconds = eject_seconds
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._probe_thread = None
+        for backend in self.backends:
+            LLM_BACKEND_AVAILABLE.labels(role, backend.url).set(1)
+
+    def generate(self, messages, on_token=None) -> str:
+        """Generate with the least busy backend, failing over on connection errors.
+
+        Once a chunk has been passed to `on_token` the call is not retried, the
+        caller would otherwise see the start of the answer twice.
+        """
+        tried = set()
+        while True:
+            backend = self._acquire(tried)
+            started = time.perf_counter()
+            streamed = False
+
+            def forward(token):
+                nonlocal streamed
+                streamed = True
+                on_token(token)
+
+            try:
+                with span("llm.generate", role=self.role, backend=backend.url, attempt=len(tried) + 1):
+                    result = generate(backend.model, messages, role=self.role, on_token=forward if on_token else None)
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                self._release(backend, started, ok=False)
+                tried.add(backend.url)
+                if streamed or len(tried) == len(self.backends):
+                    raise
+                log_event(logger, logging.WARNING, "llm.failover", role=self.role, backend=backend.url, error=str(e))
+                continue
+            except DeadlineExceeded:
+                # Stopped by the caller, says nothing about the backend
+                self._release(backend, started, ok=None)
+                raise
+            except Exception:
+                self._release(backend, started, ok=False)
+                raise
+            self._release(backend, started, ok=True)
+            return result
+
+    def _acquire(self, exclude) -> Backend:
+        if not self.backends:
+            raise NoBackendAvailable(f"No LLM backend configured for {self.role}")
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b.url not in exclude and b.available(now)]
+            if not candidates:
+                # Everything is ejected: trying the backend closest to re-admission beats failing outright.
+                candidates = sorted(
+                    (b for b in self.backends if b.url not in exclude), key=lambda b: b.ejected_until
+                )[:1]
+            if not candidates:
+                raise NoBackendAvailable(f"All LLM backends for {self.role} failed")
+            backend = min(candidates, key=lambda b: (b.outstanding, b.latency or 0.0))
+            backend.outstanding += 1
+            LLM_BACKEND_OUTSTANDING.labels(self.role, backend.url).set(backend.outstanding)
+            return backend
+
+    def _release(self, backend: Backend, started: float, ok: Optional[bool]):
+        duration = time.perf_counter() - started
+        with self._lock:
+            backend.outstanding -= 1
+            backend.requests += 1
+            LLM_BACKEND_OUTSTANDING.labels(self.role, backend.url).set(backend.outstanding)
+            if ok is None:
+                LLM_BACKEND_REQUESTS.labels(self.role, backend.url, "cancelled").inc()
+            elif ok:
+                backend.consecutive_failures = 0
+                backend.latency = duration if backend.latency is None else 0.8 * backend.latency + 0.2 * duration
+                LLM_BACKEND_REQUESTS.labels(self.role, backend.url, "ok").inc()
+                LLM_BACKEND_LATENCY.labels(self.role, backend.url).observe(duration)
+                if backend.latency > self.slow_threshold and len(self.backends) > 1:
+                    self._eject(backend, "slow")
+            else:
+                backend.errors += 1
+                backend.consecutive_failures += 1
+                LLM_BACKEND_REQUESTS.labels(self.role, backend.url, "error").inc()
+                if backend.consecutive_failures >= self.failure_threshold:
+                    self._eject(backend, "failing")
+
+    def _eject(self, backend: Backend, reason: str):
+        # A failed probe does not shorten an ejection for failing or slow calls
+        if reason != "probe_failed" or backend.eject_reason in (None, "probe_failed"):
+            backend.eject_reason = reason
+        backend.ejected_until = max(backend.ejected_until, time.monotonic() + self.eject_seconds)
+        LLM_BACKEND_AVAILABLE.labels(self.role, backend.url).set(0)
+        log_event(logger, logging.WARNING, "llm.backend_ejected", role=self.role, backend=backend.url, reason=reason)
+
+    def probe(self):
+        """Check every backend once and re-admit or eject it based on the result."""
+        for backend in self.backends:
+            try:
+                response = requests.get(f"{backend.url.rstrip('/')}/models", timeout=5)
+                healthy = response.ok
+            except requests.RequestException:
+                healthy = False
+            with self._lock:
+                if not healthy:
+                    self._eject(backend, "probe_failed")
+                elif backend.eject_reason == "probe_failed" or (backend.eject_reason and backend.available(time.monotonic())):
+                    backend.ejected_until = 0.0
+                    backend.eject_reason = None
+                    backend.consecutive_failures = 0
+                    # Forget the latency that got it ejected, the next calls measure it again.
+                    backend.latency = None
+                    LLM_BACKEND_AVAILABLE.labels(self.role, backend.url).set(1)
+                    log_event(logger, logging.INFO, "llm.backend_readmitted", role=self.role, backend=backend.url)
+
+    def start_health_checks(self):
+        if self._probe_thread is not None or not self.backends:
+            return
+        self._probe_thread = threading.Thread(target=self._probe_forever, name=f"probe-{self.role}", daemon=True)
+        self._probe_thread.start()
+
+    def _probe_forever(self):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                self.probe()
+            except Exception:
+                logger.exception("LLM backend probe failed")
+
+    def stats(self) -> List[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [backend.asdict(now) for backend in self.backends]
+
+
+def backend_urls(name: str) -> List[str]:
+    """Read `<name>S` (comma-separated) and fall back to the single-URL `<name>`."""
+    urls = os.getenv(name + "S") or os.getenv(name) or ""
+    return [url.strip() for url in urls.split(",") if url.strip()]
+
+
+ROUTING_POOL = BackendPool("routing", backend_urls("MINI_CUSTOM_LLM_URL"), max_tokens=128)
+ANSWER_POOL = BackendPool("answer", backend_urls("DEFAULT_CUSTOM_LLM_URL"), max_tokens=512)
@@ -0,0 +1,35 @@
+from typing import List
+
+import requests
+from langchain_core.embeddings import Embeddings
+
+
+class RemoteEmbeddings(Embeddings):
+    """Embeddings client for src.embedding_service.
+
+    Implements the regular embeddings interface, so it can replace the local
+    instructor model anywhere, plus embed_queries for batched query embedding.
+    """
+
+    def __init__(self, base_url: str, timeout: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self._session = requests.Session()
+
+    def _embed(self, kind: str, texts: List[str]) -> List[List[float]]:
+        response = self._session.post(
+            f"{self.base_url}/embed",
+            json={"texts": texts, "kind": kind},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.json()["embeddings"]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed("document", texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed("query", [text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return self._embed("query", texts)
@@ -1,4 +1,11 @@
+import os
+import time
 from langchain_openai import ChatOpenAI
+from ..metrics import LLM_TIME_TO_FIRST_TOKEN, LLM_TOKENS, LLM_TOTAL_TIME
+from ..profiling import annotate
+
+# Upper bound for a single LLM call; /chat gives up on it earlier (see src.deadline)
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", "120"))
 
 def create_chat_openai_with_base(openai_api_base, openai_api_key="-", max_tokens=512):
     return ChatOpenAI(
@@ -7,5 +14,35 @@ def create_chat_openai_with_base(openai_api_base, openai_api_key="-", max_tokens
         openai_api_key="-",
         temperature=0.1,
         max_tokens=max_tokens,
+        timeout=LLM_REQUEST_TIMEOUT,
         model_kwargs={"seed": 42},
-    )
\ No newline at end of file
+        stream_usage=True,
+    )
+
+
+def generate(model, messages, role, on_token=None):
+    """Stream a completion and record time-to-first-token, total time and token usage.
+
+    `on_token` is called with every non-empty chunk as it arrives.
+    """
+    start = time.perf_counter()
+    first_token = None
+    usage = None
+    parts = []
+    for chunk in model.stream(messages):
+        if first_token is None and chunk.content:
+            first_token = time.perf_counter()
+            LLM_TIME_TO_FIRST_TOKEN.labels(role).observe(first_token - start)
+        parts.append(chunk.content)
+        if on_token is not None and chunk.content:
+            on_token(chunk.content)
+        if getattr(chunk, "usage_metadata", None):
+            usage = chunk.usage_metadata
+    LLM_TOTAL_TIME.labels(role).observe(time.perf_counter() - start)
+    if first_token is not None:
+        annotate(**{"llm.time_to_first_token": round(first_token - start, 4)})
+    if usage:
+        LLM_TOKENS.labels(role, "in").inc(usage.get("input_tokens", 0))
+        LLM_TOKENS.labels(role, "out").inc(usage.get("output_tokens", 0))
+        annotate(**{"llm.input_tokens": usage.get("input_tokens", 0), "llm.output_tokens": usage.get("output_tokens", 0)})
+    return "".join(parts)
@@ -1,36 +1,60 @@
 import os
 import json
 from typing import Dict, List, Optional, Union
+from .moodle_snapshot import (
+    LEGACY_SNAPSHOT_FILENAME,
+    SNAPSHOT_FILENAME,
+    course_fingerprints,
+    iter_courses,
+    iter_legacy_courses,
+    read_site,
+)
 
 def read_moodle_store(store_path: str = "data/stores/moodlestore") -> Dict:
     """
-    Liest die gespeicherten Moodle-Daten aus dem Store.
+    Öffnet die gespeicherten Moodle-Daten aus dem Store.
+
+    Der JSONL-Snapshot wird nicht komplett geladen: `courses` ist ein Iterator,
+    der die Kurse einzeln samt Abschnitten, Modulen und Inhalten liefert.
+    Ältere moodle_content.json-Dateien werden weiterhin gelesen.
     
     Args:
         store_path: Pfad zum Moodle Store Verzeichnis
         
     Returns:
-        Dictionary mit allen Moodle-Daten
+        Dictionary mit `site`, `course_count` und einem Iterator über alle Kurse
     """
     store_data = {
         'site': None,
-        'courses': [],
-        'sections': [],
-        'modules': [],
-        'contents': []
+        'course_count': 0,
+        'courses': iter(())
     }
     
-    json_path = os.path.join(store_path, "moodle_content.json")
+    jsonl_path = os.path.join(store_path, SNAPSHOT_FILENAME)
+    json_path = os.path.join(store_path, LEGACY_SNAPSHOT_FILENAME)
+
+    if os.path.exists(jsonl_path):
+        print(f"Moodle-Daten werden gelesen aus {jsonl_path}")
+        site = read_site(jsonl_path) or {}
+        return {
+            'site': site,
+            'course_count': site.get('course_count', 0),
+            'courses': iter_courses(jsonl_path)
+        }
     
     if not os.path.exists(json_path):
-        print(f"Keine Moodle-Daten gefunden in {json_path}")
+        print(f"Keine Moodle-Daten gefunden in {store_path}")
         return store_data
         
     try:
         with open(json_path, 'r', encoding='utf-8') as f:
-            store_data = json.load(f)
+            legacy_data = json.load(f)
             print(f"Moodle-Daten erfolgreich geladen aus {json_path}")
-            return store_data
+            return {
+                'site': legacy_data.get('site'),
+                'course_count': len(legacy_data.get('courses', [])),
+                'courses': iter_legacy_courses(legacy_data)
+            }
     except Exception as e:
         print(f"Fehler beim Lesen der Moodle-Daten: {str(e)}")
         return store_data
@@ -38,47 +62,37 @@ def read_moodle_store(store_path: str = "data/stores/moodlestore") -> Dict:
 def write_store_content_file(store_data: Dict, output_file: str = "content_datastore.txt"):
     """
     Schreibt die Store-Daten in eine formatierte Textdatei.
+
+    Die Kurse werden nacheinander aus dem Iterator gelesen und direkt
+    geschrieben, die Laufzeit ist linear in der Größe des Snapshots.
     
     Args:
-        store_data: Die geladenen Store-Daten
+        store_data: Die mit read_moodle_store geöffneten Store-Daten
         output_file: Zieldatei für die formatierte Ausgabe
     """
     with open(output_file, "w", encoding="utf-8") as f:
         # Site Information
-        site = store_data.get('site', {})
+        site = store_data.get('site') or {}
         f.write(f"Moodle-Site: {site.get('name', '')}\n")
         f.write(f"URL: {site.get('url', '')}\n")
         f.write(f"Zusammenfassung: {site.get('summary', '')}\n\n")
         
-        courses = store_data.get('courses', [])
-        f.write(f"Gefundene Kurse: {len(courses)}\n\n")
+        f.write(f"Gefundene Kurse: {store_data.get('course_count', 0)}\n\n")
         
         # Für jeden Kurs
-        for course in courses:
+        for course in store_data.get('courses', []):
             f.write("=" * 80 + "\n")
             f.write(f"Kurs: {course.get('name', '')}\n")
             f.write(f"ID: {course.get('course_id', '')}\n")
             f.write(f"URL: {course.get('url', '')}\n")
             f.write(f"Zusammenfassung: {course.get('summary', '')}\n\n")
             
-            # Finde alle Abschnitte für diesen Kurs
-            course_sections = [
-                section for section in store_data.get('sections', [])
-                if section.get('course_id') == course.get('course_id')
-            ]
-            
             f.write("Abschnitte:\n")
-            for section in course_sections:
+            for section in course.get('sections', []):
                 f.write(f"    Abschnittsname: {section.get('name', '')}\n")
                 f.write(f"    Beschreibung: {section.get('description', '')}\n")
                 
-                # Finde alle Module für diesen Abschnitt
-                section_modules = [
-                    module for module in store_data.get('modules', [])
-                    if module.get('course_id') == course.get('course_id') and
-                    module.get('section_name') == section.get('name')
-                ]
-                
+                section_modules = section.get('modules', [])
                 if section_modules:
                     f.write("    Module:\n")
                     for module in section_modules:
@@ -87,12 +101,7 @@ def write_store_content_file(store_data: Dict, output_file: str = "content_datas
                         f.write(f"        URL: {module.get('url', '')}\n")
                         f.write(f"        Beschreibung: {module.get('description', '')}\n")
                         
-                        # Finde alle Inhalte für dieses Modul
-                        module_contents = [
-                            content for content in store_data.get('contents', [])
-                            if content.get('module_id') == module.get('id')
-                        ]
-                        
+                        module_contents = module.get('contents', [])
                         if module_contents:
                             f.write("        Inhalte:\n")
                             for content in module_contents:
@@ -104,6 +113,27 @@ def write_store_content_file(store_data: Dict, output_file: str = "content_datas
                 f.write("\n")
             f.write("\n")
 
+def compare_moodle_stores(old_store_path: str, new_store_path: str) -> Dict[str, List[str]]:
+    """
+    Vergleicht zwei Snapshots kursweise anhand von Prüfsummen.
+
+    Es wird je Kurs nur ein Hash im Speicher gehalten.
+
+    Args:
+        old_store_path: Store-Verzeichnis des alten Snapshots
+        new_store_path: Store-Verzeichnis des neuen Snapshots
+
+    Returns:
+        Dictionary mit den Kurs-IDs der hinzugefügten, entfernten und geänderten Kurse
+    """
+    old = course_fingerprints(read_moodle_store(old_store_path)['courses'])
+    new = course_fingerprints(read_moodle_store(new_store_path)['courses'])
+    return {
+        'added': [course_id for course_id in new if course_id not in old],
+        'removed': [course_id for course_id in old if course_id not in new],
+        'changed': [course_id for course_id in new if course_id in old and old[course_id] != new[course_id]]
+    }
+
 def main():
     # Daten aus dem Store laden
     store_data = read_moodle_store()
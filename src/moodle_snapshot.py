@@ -0,0 +1,165 @@
+"""Streaming JSONL snapshot of the scraped Moodle site.
+
+The snapshot holds one JSON record per line in tree order: the site record first,
+then every course followed by its sections, each section followed by its modules
+and each module followed by its contents. Because children always follow their
+parent, the course -> sections -> modules -> contents index is rebuilt in a single
+pass while only one course is held in memory at a time.
+"""
+import hashlib
+import json
+import os
+from collections import defaultdict
+from typing import Dict, Iterable, Iterator, Optional
+
+SNAPSHOT_FILENAME = "moodle_content.jsonl"
+LEGACY_SNAPSHOT_FILENAME = "moodle_content.json"
+
+
+class SnapshotWriter:
+    """Appends site and course records to a JSONL snapshot as they are scraped."""
+
+    def __init__(self, path: str = SNAPSHOT_FILENAME):
+        self.path = path
+        self._tmp_path = path + ".tmp"
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._tmp_path, "w", encoding="utf-8")
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._file.close()
+        if exc_type is None:
+            # Readers never see a half-written snapshot.
+            os.replace(self._tmp_path, self.path)
+        return False
+
+    def _write(self, record: Dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write_site(self, site):
+        self._write(
+            {
+                "type": "site",
+                "name": site.name,
+                "url": site.url,
+                "summary": site.summary,
+                "course_count": len(site.courses),
+            }
+        )
+
+    def write_course(self, course):
+        course_id = str(course.id)
+        self._write(
+            {"type": "course", "course_id": course_id, "name": course.name, "url": course.url, "summary": course.summary}
+        )
+        for section in course.sections:
+            self._write(
+                {"type": "section", "course_id": course_id, "name": section.name, "description": section.description}
+            )
+            for module in section.modules:
+                self._write(
+                    {
+                        "type": "module",
+                        "course_id": course_id,
+                        "section_name": section.name,
+                        "id": module.id,
+                        "name": module.name,
+                        "modname": module.modname,
+                        "url": module.url,
+                        "description": module.description,
+                    }
+                )
+                for content in module.contents:
+                    self._write(
+                        {
+                            "type": "content",
+                            "course_id": course_id,
+                            "module_id": module.id,
+                            "filename": content.filename,
+                            "fileurl": content.fileurl,
+                            "text": content.text,
+                        }
+                    )
+        self._file.flush()
+
+
+def iter_records(path: str) -> Iterator[Dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_site(path: str) -> Optional[Dict]:
+    for record in iter_records(path):
+        return record if record.get("type") == "site" else None
+    return None
+
+
+def iter_courses(path: str) -> Iterator[Dict]:
+    """Yield one course at a time with its sections, modules and contents nested.
+
+    Courses are dicts carrying a `sections` list; sections carry `modules` and
+    modules carry `contents`.
+    """
+    course = section = module = None
+    for record in iter_records(path):
+        record_type = record.pop("type", None)
+        if record_type == "course":
+            if course is not None:
+                yield course
+            course, section, module = dict(record, sections=[]), None, None
+        elif record_type == "section" and course is not None:
+            section, module = dict(record, modules=[]), None
+            course["sections"].append(section)
+        elif record_type == "module" and section is not None:
+            module = dict(record, contents=[])
+            section["modules"].append(module)
+        elif record_type == "content" and module is not None:
+            module["contents"].append(record)
+    if course is not None:
+        yield course
+
+
+def iter_legacy_courses(store_data: Dict) -> Iterator[Dict]:
+    """Group the flat lists of the legacy moodle_content.json in one pass each.
+
+    Produces the same nested structure as iter_courses.
+    """
+    sections_by_course = defaultdict(list)
+    for section in store_data.get("sections", []):
+        sections_by_course[section.get("course_id")].append(section)
+    modules_by_section = defaultdict(list)
+    for module in store_data.get("modules", []):
+        modules_by_section[(module.get("course_id"), module.get("section_name"))].append(module)
+    contents_by_module = defaultdict(list)
+    for content in store_data.get("contents", []):
+        contents_by_module[content.get("module_id")].append(content)
+
+    for course in store_data.get("courses", []):
+        course_id = course.get("course_id")
+        yield dict(
+            course,
+            sections=[
+                dict(
+                    section,
+                    modules=[
+                        dict(module, contents=contents_by_module.get(module.get("id"), []))
+                        for module in modules_by_section.get((course_id, section.get("name")), [])
+                    ],
+                )
+                for section in sections_by_course.get(course_id, [])
+            ],
+        )
+
+
+def course_fingerprints(courses: Iterable[Dict]) -> Dict[str, str]:
+    """Hash every course subtree so two snapshots can be compared course by course."""
+    return {
+        str(course.get("course_id")): hashlib.sha1(
+            json.dumps(course, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        for course in courses
+    }
@@ -0,0 +1,354 @@
+"""Opt-in profiling of single requests and of the ingest job.
+
+A profiled run records a tree of spans (the /chat stages, admission waits, LLM
+calls, ingest stages) and appends it to PROFILE_DIR/traces.jsonl as one OTLP
+JSON document per line, the format of the OpenTelemetry collector's file
+exporter. Options add more detail:
+
+    cprofile      cProfile of the worker threads, written to <trace_id>.prof
+    pyinstrument  the same with pyinstrument (if installed), written to <trace_id>.html
+    memory        tracemalloc peak and top allocation sites (process-wide)
+
+Requests are profiled when they carry an `X-Profile` header (e.g. `X-Profile: 1`
+or `X-Profile: cprofile,memory`) and PROFILE_HEADER is on, or are picked by
+PROFILE_SAMPLE_RATE; the response then carries `X-Trace-Id`. A request's profile
+is written in a thread, after the response has been handed back. The ingest job is profiled when
+PROFILE_INGEST is set to the options to use (`1` for spans only).
+
+Outside a profiled run, span() costs one context variable lookup.
+"""
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional
+
+from .log import log_event
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join("data", "profiles"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SAMPLE_OPTIONS = os.getenv("PROFILE_SAMPLE_OPTIONS", "")
+# Profiling on request is cheap to trigger, so the header is only honoured when switched on
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "false").lower() in ("1", "true", "yes")
+OPTIONS = ("cprofile", "pyinstrument", "memory")
+SERVICE_NAME = "moodle-rag"
+
+_trace: ContextVar[Optional["Trace"]] = ContextVar("profiling_trace", default=None)
+_span: ContextVar[Optional["Span"]] = ContextVar("profiling_span", default=None)
+_thread = threading.local()
+_export_lock = threading.Lock()
+_memory_lock = threading.Lock()
+_memory_users = 0
+_memory_owned = False
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attributes", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Dict):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+
+class Trace:
+    def __init__(self, name: str, options: Iterable[str] = ()):
+        self.trace_id = os.urandom(16).hex()
+        self.name = name
+        self.options = set(options)
+        self.spans: List[Span] = []
+        self.profiles = []
+        self.sessions = []
+        self.memory = None
+        self.root: Optional[Span] = None
+
+
+def parse_options(value: Optional[str]) -> set:
+    return {option.strip().lower() for option in (value or "").split(",")} & set(OPTIONS)
+
+
+def current_trace() -> Optional[Trace]:
+    return _trace.get()
+
+
+def annotate(**attributes):
+    """Add attributes to the current span, if any."""
+    current = _span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    trace = _trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = _span.get()
+    current = Span(name, parent.span_id if parent else None, attributes)
+    token = _span.set(current)
+    profiler = _start_thread_profiler(trace)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _stop_thread_profiler(trace, profiler)
+        current.end = time.time_ns()
+        _span.reset(token)
+        trace.spans.append(current)
+
+
+def add_span(name: str, duration: float, **attributes):
+    """Record a span that has just ended, for work that was timed without span()."""
+    trace = _trace.get()
+    if trace is None:
+        return
+    parent = _span.get()
+    finished = Span(name, parent.span_id if parent else None, attributes)
+    finished.end = time.time_ns()
+    finished.start = finished.end - int(duration * 1e9)
+    trace.spans.append(finished)
+
+
+@contextmanager
+def profile(name: str, options: Iterable[str] = (), defer_export: bool = False, **attributes):
+    """Profile everything run inside the block (and the threads it hands its context to).
+
+    With defer_export the caller exports the trace, e.g. off the event loop.
+    """
+    trace = Trace(name, options)
+    trace_token = _trace.set(trace)
+    span_token = _span.set(None)
+    if "memory" in trace.options:
+        _start_memory()
+    try:
+        with span(name, **attributes) as root:
+            trace.root = root
+            yield trace
+    finally:
+        if "memory" in trace.options:
+            trace.memory = _stop_memory()
+        _span.reset(span_token)
+        _trace.reset(trace_token)
+        if not defer_export:
+            export_quietly(trace)
+
+
+def profile_job(name: str, options: Optional[str] = None):
+    """profile() for a batch job if PROFILE_INGEST (or `options`) is set, a no-op otherwise."""
+    value = options if options is not None else os.getenv("PROFILE_INGEST", "")
+    if not value:
+        return nullcontext()
+    return profile(name, parse_options(value))
+
+
+def request_options(headers) -> Optional[set]:
+    """Profiling options for a request, None if it is not profiled."""
+    value = headers.get("x-profile") if PROFILE_HEADER else None
+    if value:
+        return parse_options(value)
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return parse_options(PROFILE_SAMPLE_OPTIONS)
+    return None
+
+
+async def profiling_middleware(request, call_next):
+    options = request_options(request.headers)
+    if options is None:
+        return await call_next(request)
+    attributes = {"http.method": request.method, "http.target": request.url.path}
+    with profile(f"{request.method} {request.url.path}", options, defer_export=True, **attributes) as trace:
+        response = await call_next(request)
+        # Streaming responses are only covered until their headers are sent.
+        annotate(**{"http.status_code": response.status_code})
+    # Writing the files (and rendering a pyinstrument report) would block the event loop
+    asyncio.get_running_loop().run_in_executor(None, export_quietly, trace)
+    response.headers["X-Trace-Id"] = trace.trace_id
+    return response
+
+
+def _in_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+def _start_thread_profiler(trace: Trace):
+    # The work happens in worker threads; the event loop thread is shared by all
+    # requests and would mix them up. One profiler per thread, at the outermost span.
+    if not trace.options & {"cprofile", "pyinstrument"} or getattr(_thread, "profiling", False) or _in_event_loop():
+        return None
+    if "pyinstrument" in trace.options:
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            log_event(logger, logging.WARNING, "profile.pyinstrument_missing")
+            trace.options.discard("pyinstrument")
+            trace.options.add("cprofile")
+        else:
+            profiler = Profiler(async_mode="disabled")
+            _thread.profiling = True
+            profiler.start()
+            return profiler
+    profiler = cProfile.Profile()
+    _thread.profiling = True
+    profiler.enable()
+    return profiler
+
+
+def _stop_thread_profiler(trace: Trace, profiler):
+    if profiler is None:
+        return
+    _thread.profiling = False
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        trace.profiles.append(profiler)
+    else:
+        trace.sessions.append(profiler.stop())
+
+
+def _start_memory():
+    global _memory_users, _memory_owned
+    with _memory_lock:
+        if _memory_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _memory_owned = True
+        _memory_users += 1
+        tracemalloc.reset_peak()
+
+
+def _stop_memory() -> Dict:
+    global _memory_users, _memory_owned
+    with _memory_lock:
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+        _memory_users -= 1
+        if _memory_users == 0 and _memory_owned:
+            tracemalloc.stop()
+            _memory_owned = False
+    return {
+        "peak_bytes": peak,
+        "current_bytes": current,
+        "top": [{"location": str(stat.traceback), "bytes": stat.size, "count": stat.count} for stat in top],
+    }
+
+
+def _attribute(key: str, value) -> Dict:
+    if isinstance(value, bool):
+        encoded = {"boolValue": value}
+    elif isinstance(value, int):
+        encoded = {"intValue": str(value)}
+    elif isinstance(value, float):
+        encoded = {"doubleValue": value}
+    else:
+        encoded = {"stringValue": str(value)}
+    return {"key": key, "value": encoded}
+
+
+def to_otlp(trace: Trace) -> Dict:
+    spans = []
+    for s in trace.spans:
+        entry = {
+            "traceId": trace.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            "kind": 1,
+            "startTimeUnixNano": str(s.start),
+            "endTimeUnixNano": str(s.end),
+            "attributes": [_attribute(key, value) for key, value in s.attributes.items()],
+            # STATUS_CODE_ERROR = 2, STATUS_CODE_UNSET = 0
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 0},
+        }
+        if s.parent_id:
+            entry["parentSpanId"] = s.parent_id
+        spans.append(entry)
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [_attribute("service.name", SERVICE_NAME), _attribute("process.pid", os.getpid())]},
+                "scopeSpans": [{"scope": {"name": "moodle_rag.profiling"}, "spans": spans}],
+            }
+        ]
+    }
+
+
+def summarize(trace: Trace) -> Dict:
+    """Wall time per span name, largest first."""
+    totals: Dict[str, Dict] = {}
+    for s in trace.spans:
+        entry = totals.setdefault(s.name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["count"] += 1
+        entry["seconds"] += s.duration
+        entry["max_seconds"] = max(entry["max_seconds"], s.duration)
+    for entry in totals.values():
+        entry["seconds"] = round(entry["seconds"], 4)
+        entry["max_seconds"] = round(entry["max_seconds"], 4)
+    return dict(sorted(totals.items(), key=lambda item: -item[1]["seconds"]))
+
+
+def export_quietly(trace: Trace):
+    try:
+        export(trace)
+    except Exception:
+        logger.exception("Could not export profile %s", trace.trace_id)
+
+
+def export(trace: Trace):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    if trace.memory is not None and trace.root is not None:
+        trace.root.attributes["memory.peak_bytes"] = trace.memory["peak_bytes"]
+    files = {"spans": os.path.join(PROFILE_DIR, "traces.jsonl")}
+    line = json.dumps(to_otlp(trace), ensure_ascii=False)
+    with _export_lock, open(files["spans"], "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+    if trace.profiles:
+        stats = pstats.Stats(trace.profiles[0])
+        for profiler in trace.profiles[1:]:
+            stats.add(profiler)
+        files["cprofile"] = os.path.join(PROFILE_DIR, f"{trace.trace_id}.prof")
+        stats.dump_stats(files["cprofile"])
+    if trace.sessions:
+        from pyinstrument.renderers import HTMLRenderer
+        from pyinstrument.session import Session
+
+        session = trace.sessions[0]
+        for other in trace.sessions[1:]:
+            session = Session.combine(session, other)
+        files["pyinstrument"] = os.path.join(PROFILE_DIR, f"{trace.trace_id}.html")
+        with open(files["pyinstrument"], "w", encoding="utf-8") as f:
+            f.write(HTMLRenderer().render(session))
+
+    log_event(
+        logger,
+        logging.INFO,
+        "profile.trace",
+        trace_id=trace.trace_id,
+        name=trace.name,
+        seconds=round(trace.root.duration, 4) if trace.root else None,
+        spans=summarize(trace),
+        memory=trace.memory,
+        files=files,
+    )
@@ -0,0 +1,139 @@
+"""Prompt assembly laid out for the prefix caches of the local LLM servers.
+
+llama.cpp and vLLM reuse the KV cache of the longest prompt prefix they have
+already seen. The prompts are therefore built from the most stable part to the
+most volatile one:
+
+    instructions (identical for every request)
+    retrieved documents (sorted, so requests about the same course share them)
+    usercontext and query (different for every request)
+
+Documents are sorted by a key that does not depend on the retrieval ranking, so
+two questions about the same course whose top-k sets overlap produce the same
+leading documents regardless of their similarity scores.
+"""
+from typing import Iterable, List, Optional
+
+from langchain.docstore.document import Document
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+ANSWER_INSTRUCTIONS = (
+    "Du bist ein hilfreicher Assistent der dabei unterstützt, passende Kurse auf der Kursplattform FututreLearnLab zu finden und über die verfügbaren Lerninhalte zu informieren.\n"
+    "\n"
+    "Nutze den Kontext aus der folgenden Nachricht, um die Nutzeranfrage am Ende der Nachricht zu beantworten. "
+    "Bei Fragen zu bestimmten Kursinhalten oder verfügbaren Kursen, nutze auschließlich Infromationen aus dem Kontext, der auf Basis der Nutzeranfrage zusammengestellt wurde. "
+    "Nicht alle Informationen sind relevant, entscheide also selbst, welche Informationen du teilen möchtest.\n"
+    "Antworte auf die Nutzeranfrage unter Berücksichtigung des Kontexts und der Nutzeranfrage. Wenn der Kontext keine relevanten Informationen enthält, antworte mit 'Ich habe keine Informationen zu diesem Thema'."
+)
+
+ROUTING_INSTRUCTIONS = (
+    "Choose which sources are most relevant to answer the user query below.\n"
+    "\n"
+    "Choose one of the following options, by reffering to its name only:\n"
+    "[Site-Context]: Includes general information about the site, its features and course offerings.\n"
+    "[Course-Context]: Includes information about a single specific course and its contents.\n"
+    "[User-Context]: Includes information about the current user, its bio, learning activity and interests and goals."
+)
+
+# Broad documents first: they are shared by the most requests.
+DOC_TYPE_ORDER = {
+    "site": 0,
+    "site_digest": 1,
+    "course": 2,
+    "course_digest": 3,
+    "section": 4,
+    "section_digest": 5,
+    "module": 6,
+    "content": 7,
+    # Different for every user
+    "user_profile": 8,
+}
+
+
+def document_sort_key(document: Document):
+    metadata = document.metadata or {}
+    return (
+        DOC_TYPE_ORDER.get(metadata.get("doc_type"), len(DOC_TYPE_ORDER)),
+        str(metadata.get("course_id", "")),
+        metadata.get("part") or metadata.get("section_index") or 0,
+        str(metadata.get("name") or metadata.get("filename") or ""),
+        document.page_content,
+    )
+
+
+def order_documents(documents: Iterable[Document]) -> List[Document]:
+    """Sort documents deterministically and drop exact duplicates."""
+    ordered = []
+    seen = set()
+    for document in sorted(documents, key=document_sort_key):
+        if document.page_content in seen:
+            continue
+        seen.add(document.page_content)
+        ordered.append(document)
+    return ordered
+
+
+def format_document(document: Document) -> str:
+    # The scraped texts carry the indentation of the f-strings that produced them.
+    lines = (line.strip() for line in document.page_content.strip().splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def format_context(documents: Iterable[Document]) -> str:
+    return "\n\n".join(format_document(document) for document in order_documents(documents))
+
+
+def format_history(summary: str, turns) -> str:
+    lines = []
+    if summary:
+        lines.append(f"Zusammenfassung des früheren Gesprächs: {summary}")
+    for turn in turns:
+        lines.append(f"Nutzer: {turn.user}")
+        lines.append(f"Assistent: {turn.assistant}")
+    return "\n".join(lines)
+
+
+def build_answer_messages(
+    documents: Iterable[Document], query: str, usercontext: Optional[str], history: Optional[str] = None
+) -> List[BaseMessage]:
+    history = f"Bisheriger Gesprächsverlauf:\n{history}\n\n" if history else ""
+    return [
+        SystemMessage(content=ANSWER_INSTRUCTIONS),
+        HumanMessage(
+            content=(
+                "Kontext:\n"
+                f"{format_context(documents)}\n"
+                "Kontext Ende\n"
+                "\n"
+                f"{history}"
+                f"Der Nutzer befindet sich momentan auf der Kursplatform in folgendem Kontext: {usercontext}\n"
+                f"Der Nutzer hat folgende Nachricht geschrieben: {query}"
+            )
+        ),
+    ]
+
+
+def build_routing_messages(query: str, usercontext: Optional[str]) -> List[BaseMessage]:
+    return [
+        HumanMessage(
+            content=(
+                f"{ROUTING_INSTRUCTIONS}\n"
+                "\n"
+                f"User Context: {usercontext}\n"
+                f"User Query: {query}"
+            )
+        ),
+    ]
+
+
+def build_summary_messages(summary: str, turns) -> List[BaseMessage]:
+    return [
+        HumanMessage(
+            content=(
+                "Fasse den folgenden Gesprächsverlauf zwischen einem Nutzer und dem Assistenten der Kursplattform in höchstens fünf Sätzen zusammen. "
+                "Behalte die Fragen des Nutzers, genannte Kurse und wichtige Fakten aus den Antworten. Antworte nur mit der Zusammenfassung.\n"
+                "\n"
+                f"{format_history(summary, turns)}"
+            )
+        ),
+    ]
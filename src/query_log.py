@@ -0,0 +1,209 @@
+"""Anonymized log of /chat requests, for replay and cache warming.
+
+With QUERY_LOG_DIR set, every /chat and /chat/stream request is appended as one
+JSON line to QUERY_LOG_DIR/queries.<pid>.jsonl (one file per worker, rotated at
+QUERY_LOG_MAX_MB into .1 ... .QUERY_LOG_BACKUPS):
+
+    {"ts": 1718000000.1, "endpoint": "chat", "tenant": "default", "message": "...", "course_id": "12",
+     "usercontext": "...", "session": "3f9a...", "context": "Course-Context",
+     "status": "ok", "coalesced": false, "cached": false, "degraded": ["retrieval:cache"],
+     "timings": {"routing": 0.41, "query_embedding": 0.02, ..., "total": 2.3}}
+
+Before writing, e-mail addresses, URLs and long numbers (phone and matriculation
+numbers) are masked in message and usercontext. Session ids are replaced by a
+keyed hash (QUERY_LOG_SALT; random per process if unset), so follow-ups can
+still be grouped without storing the id.
+
+Records go through a bounded queue to a writer thread. When the disk cannot
+keep up they are dropped and counted; a request never waits for the log.
+"""
+import glob
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .coalesce import normalize
+from .metrics import QUERY_LOG_RECORDS
+
+logger = logging.getLogger(__name__)
+
+QUERY_LOG_DIR = os.getenv("QUERY_LOG_DIR", "")
+QUERY_LOG_MAX_BYTES = int(float(os.getenv("QUERY_LOG_MAX_MB", "50")) * 2**20)
+QUERY_LOG_BACKUPS = int(os.getenv("QUERY_LOG_BACKUPS", "5"))
+QUERY_LOG_QUEUE_SIZE = int(os.getenv("QUERY_LOG_QUEUE_SIZE", "10000"))
+QUERY_LOG_SALT = os.getenv("QUERY_LOG_SALT") or os.urandom(16).hex()
+
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(\.[\w-]+)+")
+_URL = re.compile(r"https?://\S+")
+_NUMBER = re.compile(r"\+?\d[\d /-]{5,}\d")
+_MASK = re.compile(r"<(email|url|number)>")
+
+
+def anonymize(text: Optional[str]) -> Optional[str]:
+    if not text:
+        return text
+    text = _EMAIL.sub("<email>", text)
+    text = _URL.sub("<url>", text)
+    return _NUMBER.sub("<number>", text)
+
+
+def masked(record: Dict) -> bool:
+    """Whether anonymize() changed the message or usercontext of a logged request."""
+    return any(_MASK.search(record.get(field) or "") for field in ("message", "usercontext"))
+
+
+def pseudonymize(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    return hmac.new(QUERY_LOG_SALT.encode(), value.encode("utf-8"), hashlib.sha256).hexdigest()[:16]
+
+
+class QueryLog:
+    def __init__(self, directory: str, max_bytes: int = QUERY_LOG_MAX_BYTES, backups: int = QUERY_LOG_BACKUPS, queue_size: int = QUERY_LOG_QUEUE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue: "queue.Queue[Dict]" = queue.Queue(maxsize=queue_size)
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def record(self, request, **fields):
+        """Queue one request record; returns immediately."""
+        if not self.enabled:
+            return
+        record = {
+            "ts": round(time.time(), 3),
+            "message": anonymize(request.message),
+            "course_id": request.course_id,
+            "usercontext": anonymize(request.usercontext),
+            "session": pseudonymize(getattr(request, "session_id", None)),
+        }
+        record.update(fields)
+        self._start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            QUERY_LOG_RECORDS.labels("dropped").inc()
+
+    def flush(self):
+        """Wait until every queued record is written."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def _start(self):
+        # Threads do not survive a fork, every worker starts its own writer
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                os.makedirs(self.directory, exist_ok=True)
+                threading.Thread(target=self._run, name="query-log", daemon=True).start()
+                self._pid = os.getpid()
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, f"queries.{os.getpid()}.jsonl")
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            # Write whatever piled up meanwhile in one go
+            while len(records) < 1000:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(records)
+                QUERY_LOG_RECORDS.labels("written").inc(len(records))
+            except Exception:
+                logger.exception("Could not write the query log")
+                QUERY_LOG_RECORDS.labels("dropped").inc(len(records))
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+    def _write(self, records: List[Dict]):
+        path = self.path
+        with open(path, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            size = f.tell()
+        if size >= self.max_bytes:
+            self._rotate(path)
+
+    def _rotate(self, path: str):
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{path}.{index}"):
+                os.replace(f"{path}.{index}", f"{path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(path, f"{path}.1")
+        else:
+            os.remove(path)
+
+
+QUERY_LOG = QueryLog(QUERY_LOG_DIR)
+
+
+def log_files(paths: Iterable[str]) -> List[str]:
+    """Expand log directories into their (rotated) log files."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "queries.*.jsonl*"))))
+        else:
+            files.append(path)
+    return files
+
+
+def read_records(paths: Iterable[str], since: Optional[float] = None) -> List[Dict]:
+    """All records of the given files or directories, oldest first."""
+    records = []
+    for path in log_files(paths):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if since is None or record.get("ts", 0) >= since:
+                    records.append(record)
+    records.sort(key=lambda record: record.get("ts", 0))
+    return records
+
+
+def popular_queries(records: Iterable[Dict], limit: int) -> List[Tuple[Dict, int]]:
+    """The most frequent answerable stand-alone questions with how often they were asked.
+
+    Follow-ups in a session depend on their history and are left out.
+    """
+    counts: Counter = Counter()
+    latest: Dict[tuple, Dict] = {}
+    for record in records:
+        if record.get("session") or record.get("status") != "ok" or not record.get("context"):
+            continue
+        key = (normalize(record.get("message")), record.get("course_id"), normalize(record.get("usercontext")))
+        counts[key] += 1
+        latest[key] = record
+    return [(latest[key], count) for key, count in counts.most_common(limit)]
+
+
+def iter_replay(records: List[Dict], speed: float) -> Iterator[Tuple[float, Dict]]:
+    """(offset in seconds from the start, record) at the recorded pace divided by `speed`; speed 0 is as fast as possible."""
+    if not records:
+        return
+    start = records[0].get("ts", 0)
+    for record in records:
+        yield ((record.get("ts", start) - start) / speed if speed else 0.0), record
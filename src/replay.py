@@ -0,0 +1,116 @@
+"""Re-drive logged /chat traffic against a running API.
+
+Reads query log files or directories (see src.query_log) and sends every
+request at its recorded offset, divided by --speed (2 = twice as fast, 0 = as
+fast as --concurrency allows):
+
+    python -m src.replay data/query_log --url http://localhost:8000 --speed 4
+    python -m src.replay queries.1234.jsonl --speed 0 --concurrency 16 --output replay.jsonl
+
+Requests go to the endpoint and tenant they were recorded for. Pseudonymized session ids
+are sent as they are, so follow-ups land in the same (new) session. A summary
+with status counts and latency percentiles goes to stderr; with --output every
+result is written as JSONL.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+
+from .batch_cli import percentile
+from .query_log import iter_replay, read_records
+
+TENANT_HEADER = "X-Tenant"
+
+ENDPOINTS = {"chat": "/chat", "stream": "/chat/stream"}
+
+
+def send(session: requests.Session, url: str, record: Dict, timeout: float) -> Dict:
+    body = {"message": record["message"], "course_id": record.get("course_id"), "usercontext": record.get("usercontext")}
+    if record.get("session"):
+        body["session_id"] = record["session"]
+    endpoint = ENDPOINTS.get(record.get("endpoint"), "/chat")
+    headers = {TENANT_HEADER: record["tenant"]} if record.get("tenant") else None
+    started = time.perf_counter()
+    result = {"ts": record.get("ts"), "endpoint": endpoint, "recorded_seconds": record.get("timings", {}).get("total")}
+    try:
+        with session.post(f"{url.rstrip('/')}{endpoint}", json=body, headers=headers, stream=True, timeout=timeout) as response:
+            first_chunk = None
+            for chunk in response.iter_content(chunk_size=None):
+                if first_chunk is None and chunk:
+                    first_chunk = time.perf_counter() - started
+            result.update(status=response.status_code, first_chunk_seconds=first_chunk)
+    except requests.RequestException as e:
+        result.update(status="error", error=str(e))
+    result["seconds"] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def replay(url: str, records: List[Dict], speed: float, concurrency: int, timeout: float, on_result) -> None:
+    local = threading.local()
+
+    def run(record):
+        # One connection pool per worker thread
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        on_result(send(local.session, url, record, timeout))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for offset, record in iter_replay(records, speed):
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(run, record)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-drive logged /chat traffic against a running API.")
+    parser.add_argument("logs", nargs="+", help="query log files or directories")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--speed", type=float, default=1.0, help="pace relative to the recording, 0 for no pauses")
+    parser.add_argument("--concurrency", type=int, default=32, help="maximum requests in flight")
+    parser.add_argument("--limit", type=int, help="replay only the first N records")
+    parser.add_argument("--since", type=float, help="only records after this unix timestamp")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--output", help="JSONL file for the individual results")
+    args = parser.parse_args()
+
+    records = read_records(args.logs, since=args.since)[: args.limit]
+    output = open(args.output, "w", encoding="utf-8") if args.output else None
+    statuses: Counter = Counter()
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def on_result(result):
+        with lock:
+            statuses[result["status"]] += 1
+            if result["status"] == 200:
+                latencies.append(result["seconds"])
+            if output is not None:
+                output.write(json.dumps(result) + "\n")
+
+    started = time.monotonic()
+    try:
+        replay(args.url, records, args.speed, args.concurrency, args.timeout, on_result)
+    finally:
+        if output is not None:
+            output.close()
+    elapsed = time.monotonic() - started
+
+    print(
+        f"{len(records)} requests in {elapsed:.1f}s ({len(records) / elapsed if elapsed else 0:.1f}/s), "
+        f"status {dict(statuses)}, p50 {percentile(latencies, 0.5):.2f}s, p90 {percentile(latencies, 0.9):.2f}s, "
+        f"p99 {percentile(latencies, 0.99):.2f}s",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
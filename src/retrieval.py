@@ -0,0 +1,137 @@
+import json
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from langchain.docstore.document import Document
+
+from .cache import LRUCache
+from .metrics import observe_stage, record_cache
+
+# Query embeddings are cheap to keep and expensive to recompute; identical questions
+# ("Wann ist die Klausur?") are common within a course.
+QUERY_EMBEDDING_CACHE = LRUCache(maxsize=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "4096")))
+
+
+class SearchHit(NamedTuple):
+    id: str
+    document: Document
+    distance: float
+
+
+def embed_queries(embedding, queries: Sequence[str]) -> List[List[float]]:
+    """Embed all queries with a single model batch, reusing cached embeddings."""
+    vectors: Dict[str, List[float]] = {}
+    missing = []
+    for query in dict.fromkeys(queries):
+        cached = QUERY_EMBEDDING_CACHE.get(query)
+        record_cache("query_embedding", cached is not None)
+        if cached is None:
+            missing.append(query)
+        else:
+            vectors[query] = cached
+
+    if missing:
+        for query, vector in zip(missing, encode_queries(embedding, missing)):
+            QUERY_EMBEDDING_CACHE.set(query, vector)
+            vectors[query] = vector
+
+    return [vectors[query] for query in queries]
+
+
+def encode_queries(embedding, queries: List[str]) -> List[List[float]]:
+    """Embed a batch of queries without the cache."""
+    if hasattr(embedding, "embed_queries"):
+        return embedding.embed_queries(queries)
+    if hasattr(embedding, "query_instruction") and hasattr(embedding, "client"):
+        # HuggingFaceInstructEmbeddings only exposes a single-query embed_query, but
+        # its encoder accepts a whole batch of [instruction, text] pairs.
+        pairs = [[embedding.query_instruction, query] for query in queries]
+        return embedding.client.encode(pairs, **embedding.encode_kwargs).tolist()
+    return [embedding.embed_query(query) for query in queries]
+
+
+def search_many(
+    vectorstore,
+    queries: Sequence[Tuple[str, Optional[dict]]],
+    k: int = 5,
+) -> List[List[SearchHit]]:
+    """Run many (query, filter) searches and return the hits for every query.
+
+    All queries are embedded in one batch. Queries sharing a filter are sent to the
+    vectorstore as one multi-vector search, so n queries over m distinct filters cost
+    m search calls.
+    """
+    if not queries:
+        return []
+
+    with observe_stage("query_embedding"):
+        vectors = embed_queries(vectorstore.embeddings, [query for query, _ in queries])
+
+    groups: Dict[str, List[int]] = {}
+    for index, (_, filter) in enumerate(queries):
+        groups.setdefault(json.dumps(filter, sort_keys=True), []).append(index)
+
+    results: List[List[SearchHit]] = [[] for _ in queries]
+    with observe_stage("vector_search"):
+        for indices in groups.values():
+            filter = queries[indices[0]][1]
+            hits = _search_vectors(vectorstore, [vectors[i] for i in indices], filter, k)
+            for index, query_hits in zip(indices, hits):
+                results[index] = query_hits
+    return results
+
+
+def retrieve_many(
+    vectorstore,
+    queries: Sequence[Tuple[str, Optional[dict]]],
+    k: int = 5,
+    limit: Optional[int] = None,
+) -> List[Document]:
+    """Run many (query, filter) searches and merge them into one de-duplicated ranking.
+
+    Documents found by several queries are kept once with their best distance.
+    """
+    return [hit.document for hit in merge_hits(search_many(vectorstore, queries, k), limit)]
+
+
+def merge_hits(results: Sequence[Sequence[SearchHit]], limit: Optional[int] = None) -> List[SearchHit]:
+    best: Dict[str, SearchHit] = {}
+    for hits in results:
+        for hit in hits:
+            if hit.id not in best or hit.distance < best[hit.id].distance:
+                best[hit.id] = hit
+    merged = sorted(best.values(), key=lambda hit: hit.distance)
+    return merged[:limit] if limit else merged
+
+
+def get_documents(vectorstore, where: dict) -> List[Document]:
+    """All documents matching a metadata filter, without a similarity search."""
+    if hasattr(vectorstore, "get_documents"):
+        return vectorstore.get_documents(where)
+    response = vectorstore._collection.get(where=where, include=["documents", "metadatas"])
+    return [
+        Document(page_content=text or "", metadata=metadata or {})
+        for text, metadata in zip(response["documents"], response["metadatas"])
+    ]
+
+
+def _search_vectors(vectorstore, vectors, filter, k) -> List[List[SearchHit]]:
+    if hasattr(vectorstore, "search_by_vectors"):
+        return vectorstore.search_by_vectors(vectors, k=k, filter=filter)
+
+    # Chroma answers several query embeddings sharing one `where` clause in one call.
+    response = vectorstore._collection.query(
+        query_embeddings=vectors,
+        n_results=k,
+        where=filter or None,
+        include=["documents", "metadatas", "distances"],
+    )
+    return [
+        [
+            SearchHit(id=id, document=Document(page_content=text or "", metadata=metadata or {}), distance=distance)
+            for id, text, metadata, distance in zip(ids, texts, metadatas, distances)
+        ]
+        for ids, texts, metadatas, distances in zip(
+            response["ids"], response["documents"], response["metadatas"], response["distances"]
+        )
+    ]
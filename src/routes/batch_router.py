@@ -0,0 +1,175 @@
+"""Bulk answering for FAQ lists and course onboarding questions.
+
+A batch is processed in three phases: every item is routed, all routed items are
+embedded and searched together (one embedding batch, one vectorstore call per
+distinct filter), and the answers are generated with bounded concurrency. Each
+item is streamed back as one JSON line as soon as it is done, so the order of
+the lines follows completion, not the request; `index` refers to the position
+in the request.
+
+Batch calls queue behind interactive requests at the LLM limiters and may wait
+there much longer before they are shed. The items of a batch count against the
+tenant's max_concurrent_chats (see src.tenants) like its /chat requests, and
+show up in its request metrics.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+from ..admission import ANSWER_LIMITER, PRIORITY_BATCH, ROUTING_LIMITER, Overloaded
+from ..log import log_event
+from ..metrics import ROUTING_OUTCOMES, TENANT_CHAT_REQUESTS
+from ..retrieval import search_many
+from .main_router import (
+    RETRIEVAL_K,
+    Query,
+    build_prompt,
+    generate_answer,
+    get_search_filter,
+    get_tenant,
+    get_vectorstore,
+    predict_context,
+    with_site_digest,
+)
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "2"))
+BATCH_MAX_WAIT = float(os.getenv("BATCH_ADMISSION_MAX_WAIT_SECONDS", "300"))
+
+
+class BatchQuery(BaseModel):
+    items: List[Query]
+    # Lowers the number of concurrent LLM calls of this batch, capped at BATCH_MAX_CONCURRENCY
+    concurrency: Optional[int] = None
+
+
+@router.post("/chat/batch")
+async def chat_batch(batch: BatchQuery, vectorstore=Depends(get_vectorstore), tenant=Depends(get_tenant)):
+    if len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch.")
+    concurrency = max(1, min(batch.concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    return StreamingResponse(as_json_lines(run_batch(batch.items, vectorstore, concurrency, tenant)), media_type="application/x-ndjson")
+
+
+async def as_json_lines(results):
+    async for result in results:
+        yield json.dumps(result, ensure_ascii=False) + "\n"
+
+
+def describe(e: Exception) -> str:
+    if isinstance(e, Overloaded):
+        return f"{e}, retry after {e.retry_after}s"
+    return f"{type(e).__name__}: {e}"
+
+
+async def run_batch(items: List[Query], vectorstore, concurrency: int, tenant):
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [
+        {"index": index, "message": item.message, "course_id": item.course_id, "context": None, "response": None, "error": None, "timings": {}}
+        for index, item in enumerate(items)
+    ]
+    failed = 0
+    # Indexes of the items that did not get an LLM slot
+    shed = set()
+
+    def finish(result):
+        result["timings"]["total"] = round(time.perf_counter() - started, 3)
+        status = "ok" if result["error"] is None else "shed" if result["index"] in shed else "error"
+        TENANT_CHAT_REQUESTS.labels(tenant.key, status).inc()
+        return result
+
+    async def route(result, item):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                async with tenant.chat_slot(PRIORITY_BATCH, max_wait=BATCH_MAX_WAIT), ROUTING_LIMITER.slot(PRIORITY_BATCH, max_wait=BATCH_MAX_WAIT):
+                    predicted_context = await run_in_threadpool(predict_context, item)
+            except Overloaded:
+                shed.add(result["index"])
+                raise
+            result["timings"]["routing"] = round(time.perf_counter() - start, 3)
+        ROUTING_OUTCOMES.labels(predicted_context or "none").inc()
+        result["context"] = predicted_context
+        if predicted_context is None:
+            result["error"] = "Sorry, context wasn't correct."
+
+    def prompt(result, item, documents):
+        return build_prompt(item, with_site_digest(vectorstore, result["context"], item.message, documents))
+
+    async def answer(result, item, documents):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                messages = await run_in_threadpool(prompt, result, item, documents)
+                async with tenant.chat_slot(PRIORITY_BATCH, max_wait=BATCH_MAX_WAIT), ANSWER_LIMITER.slot(PRIORITY_BATCH, max_wait=BATCH_MAX_WAIT):
+                    result["response"] = await run_in_threadpool(generate_answer, messages)
+            except Overloaded as e:
+                shed.add(result["index"])
+                result["error"] = describe(e)
+            except Exception as e:
+                logger.exception("Error in batch item %s", result["index"])
+                result["error"] = describe(e)
+            result["timings"]["generation"] = round(time.perf_counter() - start, 3)
+        return finish(result)
+
+    tasks = []
+    try:
+        routed = await asyncio.gather(*(route(result, item) for result, item in zip(results, items)), return_exceptions=True)
+        pending = []
+        for result, item, error in zip(results, items, routed):
+            if isinstance(error, Exception):
+                result["error"] = describe(error)
+            if result["error"] is None:
+                pending.append((result, item))
+            else:
+                failed += 1
+                yield finish(result)
+
+        if pending:
+            start = time.perf_counter()
+            try:
+                # All messages in one embedding batch, one vectorstore call per distinct filter
+                hits = await run_in_threadpool(
+                    search_many,
+                    vectorstore,
+                    [(item.message, get_search_filter(result["context"], item.course_id)) for result, item in pending],
+                    RETRIEVAL_K,
+                )
+            except Exception as e:
+                logger.exception("Error in batch retrieval")
+                for result, _ in pending:
+                    result["error"] = describe(e)
+                    failed += 1
+                    yield finish(result)
+                return
+            # Shared by all items of the batch
+            retrieval = round(time.perf_counter() - start, 3)
+            for result, _ in pending:
+                result["timings"]["retrieval"] = retrieval
+
+            tasks = [
+                asyncio.create_task(answer(result, item, [hit.document for hit in item_hits]))
+                for (result, item), item_hits in zip(pending, hits)
+            ]
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                failed += result["error"] is not None
+                yield result
+    finally:
+        # The client went away: no point in generating the rest.
+        for task in tasks:
+            task.cancel()
+        log_event(logger, logging.INFO, "batch.done", items=len(items), failed=failed, seconds=round(time.perf_counter() - started, 3))
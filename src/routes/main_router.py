@@ -1,18 +1,46 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi import Response as HTTPResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from starlette.requests import Request
 from pydantic import BaseModel
 from typing import Optional
-from langchain_core.prompts import ChatPromptTemplate
-from langchain.prompts import HumanMessagePromptTemplate
-from langchain_core.messages import SystemMessage
-from langchain_core.output_parsers import StrOutputParser
-from operator import itemgetter
+import asyncio
+import logging
 import os
 import re
-from ..models.utils import create_chat_openai_with_base
+import time
+import weakref
+from ..admission import ANSWER_LIMITER, ROUTING_LIMITER, Overloaded, priority_for
+from ..cache import LRUCache
+from ..coalesce import SingleFlight, coalesce_key, normalize
+from ..deadline import RETRIEVAL_BUDGET, ROUTING_BUDGET, DeadlineExceeded, budget, deadline, degraded, expired, run_stage
+from ..dedup import course_filter
+from ..ingest_status import index_status
+from ..digests import site_digest_context
+from ..log import log_event
+from ..metrics import IN_FLIGHT_REQUESTS, ROUTING_OUTCOMES, TENANT_CHAT_REQUESTS, collect_stage_timings, observe_stage, record_cache, render_metrics
+from ..models.pool import ANSWER_POOL, ROUTING_POOL
+from ..profiling import annotate
+from ..prompting import build_answer_messages, build_routing_messages
+from ..query_log import QUERY_LOG
+from ..retrieval import retrieve_many
+from ..user_profile import USER_CONTEXT, USER_PROFILES
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+RETRIEVAL_K = 5
+
+# Route of a request whose routing call ran over its budget and has no course_id
+CHAT_FALLBACK_CONTEXT = os.getenv("CHAT_FALLBACK_CONTEXT", "Site-Context")
+CHAT_ERROR_MESSAGE = "Entschuldigung, beim Beantworten deiner Frage ist ein Fehler aufgetreten. Bitte versuche es noch einmal."
+CUT_SHORT_NOTE = "\n\n(Die Antwort wurde aus Zeitgründen gekürzt.)"
+SOURCES_ONLY_INTRO = "Ich konnte deine Frage nicht rechtzeitig beantworten. Diese Inhalte passen zu ihr:"
+NO_ANSWER_MESSAGE = "Ich konnte deine Frage nicht rechtzeitig beantworten. Bitte versuche es gleich noch einmal."
+TIMED_OUT_MESSAGE = "Der Chat hat zu lange auf einen freien Platz gewartet, bitte versuche es gleich noch einmal."
+
 class Home(BaseModel):
     title: str = "MOODLE RAG CHAT API"
     description: str = "API for the MOODLE RAG CHAT project"
@@ -37,16 +65,49 @@ class Query(BaseModel):
     message: str
     course_id: Optional[str] = None
     usercontext: Optional[str] = "Dashboard"
+    # Follow-up questions with the same session_id see the previous turns
+    session_id: Optional[str] = None
+    # Moodle id of the logged-in user, for questions about their own learning (USER_PROFILES)
+    user_id: Optional[str] = None
 
 
 class Response(BaseModel):
     response: str
 
-def get_vectorstore(req: Request):
-    if not hasattr(req.app.state, 'VECTORSTORE'):
-        print("Vectorstore not initialized!")
-        load_vectorstore(req.app.state.EMBEDDINGFUNTION)
-    return req.app.state.VECTORSTORE
+# Which site (see src.tenants) a request is for; without it the default tenant answers
+TENANT_HEADER = "X-Tenant"
+
+
+def get_tenant(req: Request):
+    try:
+        return req.app.state.TENANTS.get(req.headers.get(TENANT_HEADER))
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Unknown tenant")
+
+
+def get_vectorstore(tenant=Depends(get_tenant)):
+    # Switches to a newly published index generation if another process refreshed it
+    return tenant.index.get()
+
+
+@router.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return HTTPResponse(content=body, media_type=content_type)
+
+
+@router.get("/backends")
+def backends():
+    return {"routing": ROUTING_POOL.stats(), "answer": ANSWER_POOL.stats()}
+
+
+@router.get("/ingest/status")
+def ingest_status(req: Request):
+    # Builds are reported by whichever process ran them, "served_generation" is this worker's
+    return {
+        tenant.key: dict(index_status(tenant.persist_directory), served_generation=tenant.index.generation)
+        for tenant in req.app.state.TENANTS
+    }
 
 
 #@router.post("/chat", response_model=Response)
@@ -55,133 +116,428 @@ def get_vectorstore(req: Request):
 #    response = process_query(request, vectorstore, predicted_context)
 #    return Response(response=response)
 
+CHAT_FLIGHTS = SingleFlight("chat")
+
+
+def chat_key(request):
+    return coalesce_key(request.message, request.course_id, request.usercontext, request.session_id)
+
+
+def flight_key(request, tenant, personal_context=None):
+    # Users asking the same question share the routing, and the answer unless it is about their own learning
+    return (tenant.key, chat_key(request)) + ((personal_context, request.user_id) if personal_context else ())
+
+
+async def own_flight(flight, request, vectorstore, priority, tenant):
+    """The flight whose answer fits this request.
+
+    A question routed to User-Context is answered from the profile of the user
+    who started the flight, so the others asking it get a flight of their own,
+    which skips the routing.
+    """
+    if not USER_PROFILES:
+        return flight
+    await flight.wait_for_info("context")
+    if flight.info.get("context") != USER_CONTEXT or flight.info.get("user_id") == request.user_id:
+        return flight
+    return CHAT_FLIGHTS.join(
+        flight_key(request, tenant, USER_CONTEXT),
+        lambda flight: run_chat(request, vectorstore, priority, flight, tenant, USER_CONTEXT),
+    )
+
+
+def personal(request, predicted_context):
+    """Whether the answer is built from the user's profile and only fits that user."""
+    return USER_PROFILES and bool(request.user_id) and predicted_context == USER_CONTEXT
+
+
+@router.get("/coalescing")
+def coalescing():
+    return {"chat": CHAT_FLIGHTS.stats()}
+
+
+@router.delete("/chat/sessions/{session_id}")
+def delete_session(session_id: str, tenant=Depends(get_tenant)):
+    return {"deleted": tenant.sessions.drop(session_id)}
+
+
 @router.post("/chat", response_model=Response)
-async def chat(request: Query, vectorstore=Depends(get_vectorstore)):
+async def chat(request: Query, vectorstore=Depends(get_vectorstore), tenant=Depends(get_tenant)):
+    IN_FLIGHT_REQUESTS.inc()
+    priority = priority_for(request)
+    started, timings = time.perf_counter(), collect_stage_timings()
+    entry = {"tenant": tenant.key, "status": "ok", "context": None, "coalesced": False, "cached": False, "degraded": []}
     try:
-        print(f"Received request: {request}")
-        
-        predicted_context = predict_context(request)
-        print(f"Predicted context: {predicted_context}")
-        
-        if predicted_context is None:
-            print("Failed to predict context")
-            return Response(response="Sorry, context wasn't correct.")
-            
-        response = process_query(request, vectorstore, predicted_context)
-        print(f"Generated response: {response}")
-        
+        cached = cached_answer(request, vectorstore, tenant)
+        if cached is not None:
+            entry.update(cached=True, context=cached[0])
+            return Response(response=cached[1])
+
+        # Identical questions asked at the same time (of the same site) share one answer.
+        # The flight task takes the deadline of the request that started it along.
+        with deadline():
+            flight = CHAT_FLIGHTS.join(flight_key(request, tenant), lambda flight: run_chat(request, vectorstore, priority, flight, tenant))
+            flight = await own_flight(flight, request, vectorstore, priority, tenant)
+        # A follower's trace only shows the wait, the work is in the leader's trace
+        entry["coalesced"] = flight.requests > 1
+        annotate(**{"chat.coalesced": entry["coalesced"]})
+        try:
+            response = await flight.wait()
+        finally:
+            entry.update(context=flight.info.get("context"), degraded=flight.info.get("degraded", []))
+        log_event(logger, logging.DEBUG, "chat.response", response=response)
+
         return Response(response=response)
-    except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}")
-        # Log the full traceback
-        import traceback
-        print(traceback.format_exc())
-        return Response(response=f"There is following error: {str(e)}")
+    except Overloaded as e:
+        entry["status"] = "shed"
+        raise overloaded(e, priority)
+    except DeadlineExceeded as e:
+        entry["status"] = "timeout"
+        raise timed_out(e)
+    except Exception:
+        entry["status"] = "error"
+        logger.exception("Error in chat endpoint")
+        return Response(response=CHAT_ERROR_MESSAGE)
+    finally:
+        IN_FLIGHT_REQUESTS.dec()
+        log_query(request, "chat", started, timings, entry)
+
+@router.post("/chat/stream")
+async def chat_stream(request: Query, vectorstore=Depends(get_vectorstore), tenant=Depends(get_tenant)):
+    priority = priority_for(request)
+    started, timings = time.perf_counter(), collect_stage_timings()
+    cached = cached_answer(request, vectorstore, tenant)
+    if cached is not None:
+        log_query(request, "stream", started, timings, {"tenant": tenant.key, "status": "ok", "context": cached[0], "coalesced": False, "cached": True, "degraded": []})
+        return PlainTextResponse(cached[1])
+
+    with deadline():
+        flight = CHAT_FLIGHTS.join(flight_key(request, tenant), lambda flight: run_chat(request, vectorstore, priority, flight, tenant))
+        flight = await own_flight(flight, request, vectorstore, priority, tenant)
+    entry = {"tenant": tenant.key, "status": "ok", "context": None, "coalesced": flight.requests > 1, "cached": False, "degraded": []}
+    annotate(**{"chat.coalesced": entry["coalesced"]})
+    try:
+        # Hold the response headers back until there is something to stream, so shedding is still a 503
+        await flight.started()
+    except Overloaded as e:
+        entry["status"] = "shed"
+        log_query(request, "stream", started, timings, entry)
+        raise overloaded(e, priority)
+    except DeadlineExceeded as e:
+        entry["status"] = "timeout"
+        log_query(request, "stream", started, timings, entry)
+        raise timed_out(e)
+    except Exception:
+        entry["status"] = "error"
+        log_query(request, "stream", started, timings, entry)
+        logger.exception("Error in chat stream endpoint")
+        return PlainTextResponse(CHAT_ERROR_MESSAGE)
+
+    def done():
+        entry.update(context=flight.info.get("context"), degraded=flight.info.get("degraded", []))
+        log_query(request, "stream", started, timings, entry)
+
+    return StreamingResponse(stream_chat(flight, done), media_type="text/plain; charset=utf-8")
+
+async def stream_chat(flight, on_done=None):
+    IN_FLIGHT_REQUESTS.inc()
+    try:
+        async for chunk in flight.stream():
+            yield chunk
+    except Exception:
+        logger.exception("Error in chat stream")
+        yield f"\n{CHAT_ERROR_MESSAGE}"
+    finally:
+        IN_FLIGHT_REQUESTS.dec()
+        if on_done is not None:
+            on_done()
+
+def log_query(request, endpoint, started, timings, entry):
+    # Followers and cache hits have no stage timings of their own, only the total
+    elapsed = time.perf_counter() - started
+    TENANT_CHAT_REQUESTS.labels(entry["tenant"], entry["status"]).inc()
+    # Stamped with the arrival time, which is what a replay paces by
+    QUERY_LOG.record(request, ts=round(time.time() - elapsed, 3), endpoint=endpoint, **entry, timings=dict(timings, total=round(elapsed, 4)))
+
+def overloaded(e, priority):
+    log_event(logger, logging.WARNING, "chat.shed", limiter=e.limiter, reason=e.reason, priority=priority)
+    return HTTPException(
+        status_code=503,
+        detail="Der Chat ist gerade überlastet, bitte versuche es gleich noch einmal.",
+        headers={"Retry-After": str(e.retry_after)},
+    )
+
+def timed_out(e):
+    log_event(logger, logging.WARNING, "chat.timed_out", stage=e.stage)
+    return HTTPException(status_code=504, detail=TIMED_OUT_MESSAGE)
+
+# Answers depend on the index, so every opened generation has its own cache
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL_MINUTES", "0")) * 60 or None
+_ANSWER_CACHES = weakref.WeakKeyDictionary()
+
+
+# Fallback for retrievals that run over their budget, per opened generation as well
+RETRIEVAL_CACHE_SIZE = int(os.getenv("RETRIEVAL_CACHE_SIZE", "1000"))
+_RETRIEVAL_CACHES = weakref.WeakKeyDictionary()
+
+
+def retrieval_cache(vectorstore) -> Optional[LRUCache]:
+    if RETRIEVAL_CACHE_SIZE <= 0:
+        return None
+    cache = _RETRIEVAL_CACHES.get(vectorstore)
+    if cache is None:
+        cache = _RETRIEVAL_CACHES.setdefault(vectorstore, LRUCache(maxsize=RETRIEVAL_CACHE_SIZE))
+    return cache
+
+
+def retrieval_key(query, predicted_context, course_id):
+    return (normalize(query), predicted_context, course_id)
+
+
+def answer_cache(vectorstore, maxsize: Optional[int] = None) -> Optional[LRUCache]:
+    maxsize = ANSWER_CACHE_SIZE if maxsize is None else maxsize
+    if maxsize <= 0:
+        return None
+    cache = _ANSWER_CACHES.get(vectorstore)
+    if cache is None:
+        cache = _ANSWER_CACHES.setdefault(vectorstore, LRUCache(maxsize=maxsize, ttl=ANSWER_CACHE_TTL))
+    return cache
+
+
+def cached_answer(request, vectorstore, tenant):
+    """(context, response) of an earlier identical stand-alone question, or None."""
+    # Answers in a session depend on its history
+    cache = answer_cache(vectorstore, tenant.answer_cache_size) if not request.session_id else None
+    if cache is None:
+        return None
+    cached = cache.get(chat_key(request))
+    if cached is not None and personal(request, cached[0]):
+        # Answered without a profile, the user gets one with theirs
+        cached = None
+    record_cache("answer", cached is not None)
+    return cached
+
+
+def store_answer(request, vectorstore, tenant, predicted_context, response):
+    if personal(request, predicted_context):
+        return
+    cache = answer_cache(vectorstore, tenant.answer_cache_size) if not request.session_id else None
+    if cache is not None:
+        cache.set(chat_key(request), (predicted_context, response))
+
+
+async def route_chat(request, priority, flight):
+    # Waiting for an LLM slot counts against the deadline as well
+    try:
+        async with ROUTING_LIMITER.slot(priority, max_wait=budget(ROUTING_LIMITER.max_wait)):
+            with observe_stage("routing"):
+                try:
+                    predicted_context = await run_stage("routing", predict_context, request, stage_budget=ROUTING_BUDGET)
+                except DeadlineExceeded:
+                    predicted_context = fallback_route(request, flight)
+    except Overloaded:
+        # The deadline, not a full queue, ended the wait for a slot
+        if not expired():
+            raise
+        predicted_context = fallback_route(request, flight)
+    ROUTING_OUTCOMES.labels(predicted_context or "none").inc()
+    return predicted_context
+
+
+async def run_chat(request, vectorstore, priority, flight, tenant, predicted_context=None):
+    # A tenant with max_concurrent_chats queues its own requests before they compete for the shared LLMs
+    try:
+        async with tenant.chat_slot(priority, max_wait=budget()):
+            return await answer_chat(request, vectorstore, priority, flight, tenant, predicted_context)
+    except Overloaded:
+        # The deadline ran out in the tenant's queue, before any stage could fall back
+        if not expired():
+            raise
+        raise DeadlineExceeded("admission")
+
+
+async def answer_chat(request, vectorstore, priority, flight, tenant, predicted_context=None):
+    """Route (unless the context is already known), retrieve and generate the answer."""
+    log_event(logger, logging.DEBUG, "chat.request", tenant=tenant.key, message=request.message, course_id=request.course_id, usercontext=request.usercontext)
+
+    if predicted_context is None:
+        predicted_context = await route_chat(request, priority, flight)
+    # Followers wait for these to decide whether the answer fits them (see own_flight)
+    flight.update_info(context=predicted_context, user_id=request.user_id)
+    annotate(**{"chat.context": predicted_context or "none"})
+    log_event(logger, logging.INFO, "chat.routed", tenant=tenant.key, course_id=request.course_id, context=predicted_context)
+
+    if predicted_context is None:
+        return "Sorry, context wasn't correct."
+
+    session = tenant.sessions.get(request.session_id) if request.session_id else None
+    # Fetched from Moodle (on a cache miss) while the documents are retrieved
+    profile = asyncio.ensure_future(user_profile_context(request, tenant, flight)) if personal(request, predicted_context) else None
+    try:
+        context = await run_stage("retrieval", retrieve_context, request, vectorstore, predicted_context, session, stage_budget=RETRIEVAL_BUDGET)
+    except DeadlineExceeded:
+        cache = retrieval_cache(vectorstore)
+        context = cache.get(retrieval_key(search_query(request, session), predicted_context, request.course_id)) if cache is not None else None
+        degrade(flight, "retrieval", "cache" if context is not None else "skipped")
+        context = context or []
+    if profile is not None:
+        context = await profile + context
+    messages = build_prompt(request, context, session)
+
+    if expired():
+        degrade(flight, "generation", "sources_only")
+        return sources_only(context)
+    loop = asyncio.get_running_loop()
+    streamed = []
+
+    def on_token(token):
+        # Runs on the generation thread; raising here stops the stream at the deadline
+        if expired():
+            raise DeadlineExceeded("generation")
+        streamed.append(token)
+        loop.call_soon_threadsafe(flight.push, token)
+
+    try:
+        async with ANSWER_LIMITER.slot(priority, max_wait=budget(ANSWER_LIMITER.max_wait)):
+            # Tokens arrive on the worker thread and are handed to the flight on the event loop
+            with observe_stage("generation"):
+                response = await run_stage("generation", generate_answer, messages, on_token)
+    except DeadlineExceeded:
+        if not streamed:
+            degrade(flight, "generation", "sources_only")
+            return sources_only(context)
+        degrade(flight, "generation", "truncated")
+        flight.push(CUT_SHORT_NOTE)
+        return "".join(streamed) + CUT_SHORT_NOTE
+    except Overloaded:
+        # The deadline, not a full queue, ended the wait for a slot
+        if not expired():
+            raise
+        degrade(flight, "generation", "sources_only")
+        return sources_only(context)
+    if session is not None:
+        tenant.sessions.record(session, request.message, response)
+    store_answer(request, vectorstore, tenant, predicted_context, response)
+    return response
+
+
+async def user_profile_context(request, tenant, flight):
+    """The user's profile document, none if Moodle does not deliver it within the retrieval budget."""
+    try:
+        profile = await run_stage("user_profile", tenant.profiles.get, request.user_id, stage_budget=RETRIEVAL_BUDGET)
+    except DeadlineExceeded:
+        degrade(flight, "user_profile", "skipped")
+        return []
+    except Exception:
+        logger.exception("Could not fetch the profile of a user")
+        return []
+    return [profile.to_document()]
+
+
+def degrade(flight, stage, fallback):
+    flight.info.setdefault("degraded", []).append(f"{stage}:{fallback}")
+    annotate(**{f"chat.degraded.{stage}": fallback})
+    degraded(stage, fallback)
+
+
+def fallback_context(request):
+    return "Course-Context" if request.course_id else CHAT_FALLBACK_CONTEXT
+
+
+def fallback_route(request, flight):
+    degrade(flight, "routing", "course_route" if request.course_id else "default_route")
+    return fallback_context(request)
+
+
+def sources_only(context):
+    """Answer that only points to the retrieved documents, for a generation that ran out of time."""
+    sources = []
+    for document in context:
+        name = document.metadata.get("name") or document.metadata.get("filename")
+        if not name:
+            continue
+        source = f"- {name} ({document.metadata['url']})" if document.metadata.get("url") else f"- {name}"
+        if source not in sources:
+            sources.append(source)
+    if not sources:
+        return NO_ANSWER_MESSAGE
+    return "\n".join([SOURCES_ONLY_INTRO] + sources)
+
+def get_filters_for_context(predicted_context, course_id):
+    # Define a mapping of predicted_context to their respective filter functions
+    context_filters = {
+        "Site-Context": lambda: [{"doc_type": {"$in": ["site", "course", "course_digest"]}}],
+        "Course-Context": lambda: [
+            course_filter(course_id),
+            {"doc_type": {"$in": ["course", "course_digest", "section_digest", "module"]}},
+        ] if course_id else []
+    }
+
+    # Get the filter function based on predicted_context, default to an empty list if context not found
+    filters = context_filters.get(predicted_context, lambda: [])()
+
+    return filters
 
 def process_query(request, vectorstore, predicted_context):
+    return generate_answer(prepare_answer(request, vectorstore, predicted_context))
+
+def prepare_answer(request, vectorstore, predicted_context, session=None):
+    return build_prompt(request, retrieve_context(request, vectorstore, predicted_context, session), session)
+
+def search_query(request, session=None):
+    # Follow-ups ("und wann ist die Prüfung?") rarely name their topic, the previous question does
+    previous = session.last_user_message() if session else None
+    return f"{previous}\n{request.message}" if previous else request.message
+
+def retrieve_context(request, vectorstore, predicted_context, session=None):
+    query = search_query(request, session)
+
     # Retriever will search for the top_5 most similar documents to the query.
-    search_kwargs={"k": 5}
-    filters = []
-    
-    def get_filters_for_context(predicted_context, course_id):
-        # Define a mapping of predicted_context to their respective filter functions
-        context_filters = {
-            "Site-Context": lambda: [{"doc_type": {"$in": ["site", "course"]}}],
-            "Course-Context": lambda: [
-                {"course_id": {"$eq": course_id}, "doc_type": {"$in": ["course", "module"]}}
-            ] if course_id else []
-        }
-
-        # Get the filter function based on predicted_context, default to an empty list if context not found
-        filters = context_filters.get(predicted_context, lambda: [])()
-
-        return filters
-
-    # Usage in your main_router.py
-    filters = get_filters_for_context(predicted_context, request.course_id)
-
-    if filters:
-        search_kwargs["filter"] = {"$and": filters} if len(filters) > 1 else filters[0]
-    
-    print("Set retriever with filters: " + str(search_kwargs))
-    
-    retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
-
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            SystemMessage(
-                content=(
-                    "Du bist ein hilfreicher Assistent der dabei unterstützt, passende Kurse auf der Kursplattform FututreLearnLab zu finden und über die verfügbaren Lerninhalte zu informieren."
-                )
-            ),
-            HumanMessagePromptTemplate.from_template(
-                (   
-                    "Nutze den folgenden Kontext, um die nachfolgende Nutzeranfrage zu beantworten\n"
-                    "\n"
-                    "Der Nutzer befindet sich momentan auf der Kursplatform in folgendem Kontext: {usercontext}\n"
-                    "Bei Fragen zu bestimmten Kursinhalten oder verfügbaren Kursen, nutze auschließlich Infromationen aus dem nachgehenden Kontext, der auf Basis der Nutzeranfrage zusammengestellt wurde. Nicht alle Informationen sind relevant, entscheide also selbst, welche Informationen du teilen möchtest.\n"
-                    "{context}\n"
-                    "\n"
-                    "Kontext Ende"
-                    "\n"
-                    "Der Nutzer hat folgende Nachricht geschrieben: {query}"
-                    "\n"
-                    "Antworte auf die Nutzeranfrage unter Berücksichtigung des Kontexts und der Nutzeranfrage. Wenn der Kontext keine relevanten Informationen enthält, antworte mit 'Ich habe keine Informationen zu diesem Thema'."
-                )
-            ),
-        ]
-    )
-    
-    # model = create_chat_openai_with_base(os.getenv("DEFAULT_CUSTOM_LLM_URL"))
-    model = create_chat_openai_with_base(os.getenv("DEFAULT_CUSTOM_LLM_URL"), openai_api_key="lm-studio")
-
-    chain = (
-        {"context": itemgetter("query") | retriever, "query": itemgetter("query"), "usercontext" : itemgetter("usercontext")}
-        | prompt
-        | model
-        | StrOutputParser()
-    )
+    context = retrieve_many(vectorstore, [(query, get_search_filter(predicted_context, request.course_id))], k=RETRIEVAL_K)
+    context = with_site_digest(vectorstore, predicted_context, query, context)
+    cache = retrieval_cache(vectorstore)
+    if cache is not None:
+        # Also when the request has stopped waiting for it: the next one can use it
+        cache.set(retrieval_key(query, predicted_context, request.course_id), context)
 
-    print("Retrieving context")
-    context = retriever.invoke(request.message)
-    print("Context retrieved")
+    log_event(logger, logging.DEBUG, "retrieval.context", context=lambda: str(context))
 
-    print("Context: " + str(context))
+    return context
 
-    print("Processing query")
-    print(prompt.format_prompt(query = request.message, usercontext = request.usercontext, context = context))
+def with_site_digest(vectorstore, predicted_context, query, context):
+    # Broad questions get the whole course catalogue, the search adds the best matching outlines
+    if predicted_context != "Site-Context":
+        return context
+    return site_digest_context(vectorstore, query) + context
 
-    return chain.invoke({"query": request.message, "usercontext": request.usercontext})
+def get_search_filter(predicted_context, course_id):
+    filters = get_filters_for_context(predicted_context, course_id)
+    search_filter = ({"$and": filters} if len(filters) > 1 else filters[0]) if filters else None
 
-def predict_context(request):
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            HumanMessagePromptTemplate.from_template(
-                (   
-                    "User Query: {query}\n"
-                    "User Context: {usercontext}\n"
-                    "\n"
-                    "Based on the previous query choose which sources are most relevant to answer the user query.\n"
-                    "\n"
-                    "Choose one of the following options, by reffering to its name only:\n"
-                    "[Site-Context]: Includes general information about the site, its features and course offerings.\n"
-                    "[Course-Context]: Includes information about a single specific course and its contents.\n"
-                    "[User-Context]: Includes information about the current user, its bio, learning activity and interests and goals."
-                )
-            ),
-        ]
-    )
-    
-    # model = create_chat_openai_with_base(os.getenv("DEFAULT_CUSTOM_LLM_URL"))
-    model = create_chat_openai_with_base(os.getenv("MINI_CUSTOM_LLM_URL"), openai_api_key="lm-studio", max_tokens=128)
+    log_event(logger, logging.DEBUG, "retrieval.search_kwargs", search_kwargs={"k": RETRIEVAL_K, "filter": search_filter})
+
+    return search_filter
+
+def build_prompt(request, context, session=None):
+    with observe_stage("prompt_build"):
+        # Instructions and sorted documents first, so the LLM server can reuse its prefix cache
+        history = session.history() if session else None
+        messages = build_answer_messages(context, request.message, request.usercontext, history=history)
 
-    chain = ( prompt | model | StrOutputParser() )
+    log_event(logger, logging.DEBUG, "answer.prompt", prompt=lambda: "\n".join(m.content for m in messages))
 
-    print("Processing query")
-    print(prompt.format_prompt(query = request.message, usercontext = request.usercontext))
+    return messages
 
-    answer = chain.invoke({"query": request.message, "usercontext": request.usercontext})
-    print("Answer: " + str(answer))
+def generate_answer(messages, on_token=None):
+    return ANSWER_POOL.generate(messages, on_token=on_token)
+
+def predict_context(request):
+    messages = build_routing_messages(request.message, request.usercontext)
+    log_event(logger, logging.DEBUG, "routing.prompt", prompt=lambda: "\n".join(m.content for m in messages))
+
+    answer = ROUTING_POOL.generate(messages)
+    log_event(logger, logging.DEBUG, "routing.answer", answer=answer)
     # get only content that matches the desired output [Site-Context] or [Course-Context] or [User-Context]
 
     match = re.search(r"\[(.*?)\]", answer)
@@ -190,8 +546,6 @@ def predict_context(request):
     else:
         return None
 
-    print("Predicted context: " + str(predicted_context))
-
     return predicted_context
 
 
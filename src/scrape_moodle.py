@@ -1,26 +1,51 @@
 import requests
 from pydantic import BaseModel, Field
-from typing import Tuple, List, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Iterator, NamedTuple, Tuple, List, Optional
 import os
-import json
+import sys
+from .moodle_snapshot import SNAPSHOT_FILENAME, SnapshotWriter
+
+
+class MoodleConnection(NamedTuple):
+    url: Optional[str]
+    token: Optional[str]
+
+
+_CONNECTION: ContextVar[Optional[MoodleConnection]] = ContextVar("moodle_connection", default=None)
+
+
+@contextmanager
+def moodle_site(url: str, token: str):
+    """Send the API calls made in this context (and in threads started from a copy of it) to another site."""
+    reset = _CONNECTION.set(MoodleConnection(url, token))
+    try:
+        yield
+    finally:
+        _CONNECTION.reset(reset)
+
+
+def moodle_connection() -> MoodleConnection:
+    # Read at call time, so a .env loaded after import still applies
+    return _CONNECTION.get() or MoodleConnection(os.getenv("MOODLE_URL"), os.getenv("MOODLE_API_TOKEN"))
 
 
 # Function to call Moodle API
-def moodle_api_call(function_name, params):
+def moodle_api_call(function_name, params, timeout=None):
     # Configuration
-    MOODLE_URL = os.getenv("MOODLE_URL")
-    API_TOKEN = os.getenv("MOODLE_API_TOKEN")
+    MOODLE_URL, API_TOKEN = moodle_connection()
     REST_ENDPOINT = f"{MOODLE_URL}/webservice/rest/server.php"
     params["wstoken"] = API_TOKEN
     params["moodlewsrestformat"] = "json"
     params["wsfunction"] = function_name
-    response = requests.get(REST_ENDPOINT, params=params)
+    response = requests.get(REST_ENDPOINT, params=params, timeout=timeout)
     response.raise_for_status()
     return response.json()
 
 
 def get_content_text(fileurl):
-    API_TOKEN = os.getenv("MOODLE_API_TOKEN")
+    API_TOKEN = moodle_connection().token
     params = {}
     params["wstoken"] = API_TOKEN
     response = requests.get(fileurl, params=params)
@@ -28,7 +53,19 @@ def get_content_text(fileurl):
     return response.json()
 
 
+def _intern(value):
+    # Module types, section names ("Allgemeines") and course ids repeat across the whole
+    # site; interning keeps a single copy of each.
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _course_id(course_id):
+    return None if course_id is None else _intern(str(course_id))
+
+
 class MoodleModuleContent:
+    __slots__ = ("type", "course_id", "filename", "fileurl", "text")
+
     def __init__(
         self,
         type: str,
@@ -37,7 +74,8 @@ class MoodleModuleContent:
         fileurl: Optional[str] = "",
         text: Optional[str] = "",
     ):
-        self.type = type
+        self.type = _intern(type)
+        self.course_id = _course_id(course_id)
         self.filename = filename
         self.fileurl = fileurl
         self.text = text
@@ -57,6 +95,8 @@ class MoodleModuleContent:
 
 
 class MoodleModule:
+    __slots__ = ("id", "course_id", "name", "description", "modname", "url", "contents")
+
     def __init__(
         self,
         name: str,
@@ -64,13 +104,16 @@ class MoodleModule:
         url: str,
         course_id: int = None,
         description: Optional[str] = "",
-        contents: List[MoodleModuleContent] = [],
+        contents: Optional[List[MoodleModuleContent]] = None,
+        id: int = None,
     ):
+        self.id = id
+        self.course_id = _course_id(course_id)
         self.name = name
         self.description = description
-        self.modname = modname
+        self.modname = _intern(modname)
         self.url = url
-        self.contents = contents
+        self.contents = contents if contents is not None else []
 
     def __str__(self):
         string = f"""
@@ -92,20 +135,26 @@ class MoodleModule:
             "description": self.description,
             "doc_type": "module",
             "course_id": self.course_id,
+            "url": self.url,
+            # Stable across refreshes, unlike the document ids; labels of benchmarks.retrieval_sweep
+            "module_id": None if self.id is None else str(self.id),
         }
 
 
 class MoodleCourseSection:
+    __slots__ = ("course_id", "name", "description", "modules")
+
     def __init__(
         self,
         name: str,
         course_id: int = None,
         description: Optional[str] = "",
-        modules: List[MoodleModule] = [],
+        modules: Optional[List[MoodleModule]] = None,
     ):
-        self.name = name
+        self.course_id = _course_id(course_id)
+        self.name = _intern(name)
         self.description = description
-        self.modules = modules
+        self.modules = modules if modules is not None else []
 
     def __str__(self):
         string = f"""
@@ -131,18 +180,20 @@ class MoodleCourseSection:
 
 
 class MoodleCourse:
+    __slots__ = ("id", "name", "summary", "url", "sections")
+
     def __init__(
         self,
         id: int,
         name: str,
         summary: Optional[str] = "",
-        sections: List[MoodleCourseSection] = [],
+        sections: Optional[List[MoodleCourseSection]] = None,
     ):
         self.id = id
         self.name = name
         self.summary = summary
-        self.url = f"{os.getenv('MOODLE_URL')}/course/view.php?id={id}"
-        self.sections = sections
+        self.url = f"{moodle_connection().url}/course/view.php?id={id}"
+        self.sections = sections if sections is not None else []
 
     def __str__(self):
         string = f"""
@@ -168,17 +219,19 @@ class MoodleCourse:
 
 
 class MoodleSiteInfo:
+    __slots__ = ("name", "summary", "url", "courses")
+
     def __init__(
         self,
         name: str,
         url: str,
         summary: Optional[str] = "",
-        courses: List[MoodleCourse] = [],
+        courses: Optional[List[MoodleCourse]] = None,
     ):
         self.name = name
         self.summary = summary
         self.url = url
-        self.courses = courses
+        self.courses = courses if courses is not None else []
 
     def __str__(self):
         string = f"""
@@ -222,7 +275,7 @@ def get_courses() -> MoodleSiteInfo:
 
     site_info = MoodleSiteInfo(
         name=data[0].get("fullname"),
-        url=os.getenv("MOODLE_URL"),
+        url=moodle_connection().url,
         summary=data[0].get("summary"),
     )
 
@@ -264,6 +317,7 @@ def get_course_sections(course_id) -> List[MoodleCourseSection]:
                         contents.append(
                             MoodleModuleContent(
                                 type="file",
+                                course_id=course_id,
                                 filename=content.get("filename"),
                                 fileurl=content.get("fileurl"),
                                 text=contenttext,
@@ -272,20 +326,23 @@ def get_course_sections(course_id) -> List[MoodleCourseSection]:
                     else:
                         contents.append(
                             MoodleModuleContent(
-                                type="file", filename=content.get("filename")
+                                type="file", course_id=course_id, filename=content.get("filename")
                             )
                         )
             modules.append(
                 MoodleModule(
+                    id=module.get("id"),
                     name=module.get("name"),
                     modname=module.get("modname"),
                     url=module.get("url"),
+                    course_id=course_id,
                     contents=contents,
                 )
             )
         sections.append(
             MoodleCourseSection(
                 name=section.get("name"),
+                course_id=course_id,
                 description=section.get("summary"),
                 modules=modules,
             )
@@ -305,6 +362,32 @@ def scrape_moodle_data() -> MoodleSiteInfo:
 
     return site
 
+def iter_scraped_courses(
+    site: MoodleSiteInfo,
+    get_sections: Callable[[int], List[MoodleCourseSection]] = get_course_sections,
+) -> Iterator[MoodleCourse]:
+    """Fetch the sections of one course at a time.
+
+    Each course is yielded with its sections loaded and emptied again once the
+    consumer moves on, so only the course currently being processed is held in memory.
+    """
+    for course in site.courses:
+        course.sections = get_sections(course.id)
+        try:
+            yield course
+        finally:
+            course.sections = []
+
+
+def iter_course_nodes(course: MoodleCourse) -> Iterator:
+    """Walk a course depth-first: the course, then each section, its modules and their contents."""
+    yield course
+    for section in course.sections:
+        yield section
+        for module in section.modules:
+            yield module
+            yield from module.contents
+
 def write_course_data(file, course: MoodleCourse, indent_level: int = 0):
     indent = "    " * indent_level
     file.write(f"{indent}Kurs: {course.name}\n")
@@ -356,50 +439,20 @@ def scrape_moodle_data_to_file():
         print("Keine Daten verfügbar.")
         return
 
-    for course in site.courses:
-        sections = get_course_sections(course.id)
-        course.sections = sections
-
-    with open("moodle_content.txt", "w", encoding="utf-8") as f:
+    # Kurse werden einzeln abgerufen und sofort geschrieben, sodass immer nur ein Kurs im Speicher liegt
+    with open("moodle_content.txt", "w", encoding="utf-8") as f, SnapshotWriter(SNAPSHOT_FILENAME) as snapshot:
         f.write(f"Moodle-Site: {site.name}\n")
         f.write(f"URL: {site.url}\n")
         f.write(f"Zusammenfassung: {site.summary}\n\n")
+        snapshot.write_site(site)
         
         if site.courses:
             f.write(f"Gefundene Kurse: {len(site.courses)}\n\n")
-            for course in site.courses:
+            for course in iter_scraped_courses(site):
                 write_course_data(f, course)
                 f.write("\n" + "="*80 + "\n\n")
-
-    # Zusätzlich JSON-Export für strukturierte Daten
-    with open("moodle_content.json", "w", encoding="utf-8") as f:
-        json.dump(
-            {
-                "site": site.asdict(),
-                "courses": [course.asdict() for course in site.courses],
-                "sections": [
-                    section.asdict() 
-                    for course in site.courses 
-                    for section in course.sections
-                ],
-                "modules": [
-                    module.asdict()
-                    for course in site.courses
-                    for section in course.sections
-                    for module in section.modules
-                ],
-                "contents": [
-                    content.asdict()
-                    for course in site.courses
-                    for section in course.sections
-                    for module in section.modules
-                    for content in module.contents
-                ]
-            },
-            f,
-            indent=2,
-            ensure_ascii=False
-        )
+                # Zusätzlich JSONL-Export für strukturierte Daten
+                snapshot.write_course(course)
 
 # Trigger the scrape
 def main():
@@ -0,0 +1,147 @@
+"""Server-side chat sessions for follow-up questions.
+
+Sessions are keyed by the session_id the client sends with its query and held in
+an LRU cache with a time-to-live, so the number of sessions is bounded. Each
+session keeps the most recent turns verbatim. Once the history exceeds the token
+budget, the older turns are folded into a running summary by the small routing
+model, so the history part of the prompt stays roughly the same size however
+long the conversation gets. Compaction runs in the background after the answer
+has been returned.
+
+Sessions live in the memory of one worker process; with several workers the
+load balancer has to route a session to the same worker. Every tenant has its
+own store (see src.tenants).
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, NamedTuple, Optional
+
+from .admission import ROUTING_LIMITER, Overloaded
+from .cache import LRUCache
+from .log import log_event
+from .metrics import CHAT_SESSIONS, HISTORY_COMPACTIONS
+from .models.pool import ROUTING_POOL
+from .prompting import build_summary_messages, format_history
+
+logger = logging.getLogger(__name__)
+
+# Answers can be long; a single turn must not blow the memory bound on its own.
+MAX_TURN_CHARS = 4000
+
+
+def estimate_tokens(text: str) -> int:
+    # Close enough for German and English text with the usual BPE vocabularies.
+    return len(text) // 4 + 1
+
+
+class Turn(NamedTuple):
+    user: str
+    assistant: str
+
+
+class ChatSession:
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.summary = ""
+        self.turns: List[Turn] = []
+        self.compacting = False
+        self.lock = threading.Lock()
+
+    def tokens(self) -> int:
+        with self.lock:
+            return estimate_tokens(self.summary) + sum(estimate_tokens(t.user) + estimate_tokens(t.assistant) for t in self.turns)
+
+    def history(self) -> Optional[str]:
+        """The history as it goes into the prompt, None for a new session."""
+        with self.lock:
+            if not self.summary and not self.turns:
+                return None
+            return format_history(self.summary, self.turns)
+
+    def last_user_message(self) -> Optional[str]:
+        with self.lock:
+            return self.turns[-1].user if self.turns else None
+
+    def add_turn(self, user: str, assistant: str):
+        with self.lock:
+            self.turns.append(Turn(user[:MAX_TURN_CHARS], assistant[:MAX_TURN_CHARS]))
+
+
+class SessionStore:
+    def __init__(
+        self,
+        maxsize: int = int(os.getenv("CHAT_SESSION_MAX", "1000")),
+        ttl: float = float(os.getenv("CHAT_SESSION_TTL_MINUTES", "60")) * 60,
+        token_budget: int = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "800")),
+        keep_turns: int = int(os.getenv("CHAT_HISTORY_KEEP_TURNS", "2")),
+        summarize: Callable = ROUTING_POOL.generate,
+        tenant: str = "default",
+    ):
+        self.tenant = tenant
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+        self.summarize = summarize
+        self._sessions = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        # One summary at a time, the small model also serves routing.
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compact")
+
+    def get(self, session_id: str) -> ChatSession:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id)
+            # Setting it again refreshes the time-to-live.
+            self._sessions.set(session_id, session)
+        CHAT_SESSIONS.labels(self.tenant).set(len(self._sessions))
+        return session
+
+    def drop(self, session_id: str) -> bool:
+        with self._lock:
+            dropped = self._sessions.pop(session_id) is not None
+        CHAT_SESSIONS.labels(self.tenant).set(len(self._sessions))
+        return dropped
+
+    def record(self, session: ChatSession, user: str, assistant: str):
+        session.add_turn(user, assistant)
+        if len(session.turns) <= self.keep_turns or session.tokens() <= self.token_budget:
+            return
+        with session.lock:
+            if session.compacting:
+                return
+            session.compacting = True
+        self._executor.submit(self.compact, session)
+
+    def compact(self, session: ChatSession):
+        """Fold all but the last `keep_turns` turns into the summary."""
+        try:
+            with session.lock:
+                old_turns = session.turns[:-self.keep_turns] if self.keep_turns else list(session.turns)
+                summary = session.summary
+            if not old_turns:
+                return
+            try:
+                # Behind the routing requests, the summary is not waited for
+                with ROUTING_LIMITER.thread_slot():
+                    new_summary = self.summarize(build_summary_messages(summary, old_turns)).strip()
+                HISTORY_COMPACTIONS.labels("ok").inc()
+            except Overloaded as e:
+                # The routing model is busy; the turns stay and the next turn tries again.
+                HISTORY_COMPACTIONS.labels("overloaded").inc()
+                log_event(logger, logging.INFO, "session.compaction_deferred", session_id=session.session_id, reason=e.reason)
+                return
+            except Exception as e:
+                # Keep the memory bound even without a summary; the old turns are lost.
+                new_summary = summary
+                HISTORY_COMPACTIONS.labels("error").inc()
+                log_event(logger, logging.WARNING, "session.compaction_failed", session_id=session.session_id, error=str(e))
+            with session.lock:
+                session.summary = new_summary
+                # Turns are only ever appended meanwhile, the compacted ones are still at the front.
+                del session.turns[:len(old_turns)]
+            log_event(logger, logging.DEBUG, "session.compacted", session_id=session.session_id, turns=len(old_turns), summary=new_summary)
+        finally:
+            with session.lock:
+                session.compacting = False
@@ -1,67 +1,220 @@
 from langchain_community.vectorstores import Chroma
 from chromadb.config import Settings
 from chromadb import PersistentClient
+from chromadb.api.client import SharedSystemClient
 from langchain_community.embeddings import HuggingFaceInstructEmbeddings
 from langchain.docstore.document import Document
-from .scrape_moodle import scrape_moodle_data, MoodleSiteInfo
+from .models.remote_embeddings import RemoteEmbeddings
+from .generations import (
+    LEGACY_GENERATION,
+    RefreshLock,
+    current_generation,
+    generation_age,
+    generation_path,
+    new_generation,
+    prune_generations,
+    publish_generation,
+    unpublished_generations,
+)
+from .index_snapshot import INDEX_SNAPSHOT_PATH, SnapshotError, import_snapshot
+from .ingest import ingest_incomplete, run_ingest
+from .ingest_status import now, update_status
+from .metrics import VECTORSTORE_DOCUMENTS
+from .profiling import profile_job, span
+from .vectorstores import VECTORSTORE_BACKEND, collection_of, finalize, open_backend, stored_backend
+from .scrape_moodle import get_courses
+from contextlib import nullcontext
+from typing import Optional
+import logging
 import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PERSIST_DIRECTORY = os.path.join("data", "stores", "moodlestore")
+EMBEDDING_MODEL_NAME = "hkunlp/instructor-large"
+REFRESH_INTERVAL = float(os.getenv("INDEX_REFRESH_INTERVAL_HOURS", "24")) * 3600
+# "inline": the API processes build and refresh the index themselves.
+# "worker": src.ingest_worker does, the API only opens the generations it publishes.
+INGEST_MODE = os.getenv("INGEST_MODE", "inline")
+WORKER_WAIT_INTERVAL = 10
 
 
 def load_embedding_function():
+    # With EMBEDDING_SERVICE_URL set, workers share the model loaded by src.embedding_service.
+    service_url = os.getenv("EMBEDDING_SERVICE_URL")
+    if service_url:
+        return RemoteEmbeddings(service_url)
+    return load_local_embedding_function()
+
+
+def load_local_embedding_function(model_name=EMBEDDING_MODEL_NAME):
     return HuggingFaceInstructEmbeddings(
-        model_name="hkunlp/instructor-large",
+        model_name=model_name,
         query_instruction="Represent the user query for retriving relevant documents: ",
         embed_instruction="Represent the document for retrieval: ",
     )
 
 
-def load_vectorstore(embedding):
-    persist_directory = "data\stores\moodlestore"
-    if not os.path.exists(persist_directory):
-        os.makedirs(persist_directory)
-        # Scrape Moodle data
-        print("Scraping Moodle data")
-        site = scrape_moodle_data()
-        print("Moodle data scraped")
-
-        # Load Moodle data into documents
-        documents = []
-        documents.append(site)
-        for course in site.courses:
-            documents.append(course)
-            for section in course.sections:
-                documents.append(section)
-                for module in section.modules:
-                    documents.append(module)
-                    for content in module.contents:
-                        documents.append(content)
-
-        documents = [
-            Document(
-                page_content=str(doc),
-                metadata=doc.asdict(),
-            )
-            for doc in documents
-        ]
-
-        print("Embedding documents")
-        # Load documents into Vecorstore
-        db = Chroma.from_documents(
-            documents=documents,
-            embedding=embedding,
-            collection_metadata={"hnsw:space": "cosine"},
-            persist_directory=persist_directory,
+def open_vectorstore(persist_directory, embedding):
+    # Existing stores keep their backend, VECTORSTORE_BACKEND applies to new ones
+    backend = stored_backend(persist_directory) or VECTORSTORE_BACKEND
+    if backend != "chroma":
+        return open_backend(backend, persist_directory, embedding)
+    return Chroma(
+        client=PersistentClient(persist_directory),
+        embedding_function=embedding,
+        client_settings=Settings(anonymized_telemetry=False),
+        collection_metadata={"hnsw:space": "cosine"},
+    )
+
+
+def ingest_vectorstore(db, embedding, persist_directory, tenant=None, on_progress=None):
+    # Scrape Moodle data and embed it course by course, so memory use is bounded
+    # by the largest course instead of the whole site.
+    # PROFILE_INGEST=1 (or cprofile,memory) reports where wall time and memory went
+    # A tenant (see src.tenants) scrapes its own site; the stage threads inherit the connection
+    with profile_job("ingest"), tenant.scraping() if tenant is not None else nullcontext():
+        logger.info("Scraping Moodle data")
+        with span("ingest.site"):
+            site = get_courses()
+        report = run_ingest(db, embedding, site, persist_directory, max_documents=getattr(tenant, "max_documents", None), on_progress=on_progress)
+        with span("ingest.finalize"):
+            finalize(db)
+    logger.info("Vectorstore loaded with %d documents", collection_of(db).count())
+    return report
+
+
+def build_generation(embedding, root=PERSIST_DIRECTORY, tenant=None) -> str:
+    """Scrape and embed the site into a new index generation and publish it."""
+    # An interrupted build is resumed from its ingest checkpoint instead of starting over.
+    pending = unpublished_generations(root)
+    generation = pending[-1] if pending else new_generation(root)
+    path = generation_path(root, generation)
+    update_status(root, state="running", generation=generation, pid=os.getpid(), started_at=now(), finished_at=None, progress=None, error=None)
+    try:
+        db = open_vectorstore(path, embedding)
+        report = ingest_vectorstore(db, embedding, path, tenant, on_progress=lambda progress: update_status(root, progress=progress))
+        documents = collection_of(db).count()
+        publish_generation(
+            root,
+            generation,
+            {
+                "embedding_model": EMBEDDING_MODEL_NAME,
+                "vectorstore": stored_backend(path),
+                "documents": documents,
+                "dedup": report.get("dedup"),
+                "skipped_courses": report.get("skipped_courses"),
+            },
         )
+    except BaseException as e:
+        update_status(root, state="failed", finished_at=now(), error=repr(e))
+        raise
+    update_status(root, state="published", finished_at=now(), progress=report, documents=documents)
+    prune_generations(root)
+    logger.info("Index generation %s published", generation)
+    return generation
+
+
+def refresh_vectorstore(embedding, root=PERSIST_DIRECTORY, max_age=REFRESH_INTERVAL, tenant=None) -> Optional[str]:
+    """Build a new generation if the current one is older than max_age seconds.
 
-        print("Vectorstore loaded")
+    Safe to call from every worker: only the process holding the refresh lock
+    builds, and once it has published, the others find a fresh generation and skip.
+    An empty store is restored from the tenant's snapshot if there is one.
+    """
+    with RefreshLock(root) as acquired:
+        if not acquired:
+            return None
+        age = generation_age(root)
+        if age is not None and age < max_age:
+            return None
+        return (age is None and restore_snapshot(root, tenant)) or build_generation(embedding, root, tenant)
 
-        print(str(len(db.get()["metadatas"])) + " documents loaded")
 
+def restore_snapshot(root=PERSIST_DIRECTORY, tenant=None) -> Optional[str]:
+    """Import the configured index snapshot into an empty store, None if there is none or it does not fit."""
+    path = tenant.snapshot_path if tenant is not None else INDEX_SNAPSHOT_PATH
+    if not path:
+        return None
+    try:
+        return import_snapshot(root, path, EMBEDDING_MODEL_NAME)
+    except (SnapshotError, OSError, ValueError):
+        logger.exception("Could not import the index snapshot %s, building the index instead", path)
+        return None
+
+
+def load_vectorstore(embedding, root=PERSIST_DIRECTORY, tenant=None):
+    generation = current_generation(root)
+    if INGEST_MODE == "worker":
+        # The ingest worker builds the index, even the first one
+        return open_vectorstore(generation_path(root, generation or wait_for_generation(root)), embedding)
+    if generation is None:
+        # Empty store: the first process to get here imports a snapshot or builds, the others wait for it.
+        with RefreshLock(root, blocking=True):
+            generation = current_generation(root) or restore_snapshot(root, tenant) or build_generation(embedding, root, tenant)
+    elif generation == LEGACY_GENERATION and ingest_incomplete(root):
+        # A legacy ingest was interrupted, continue after the last completed course.
+        db = open_vectorstore(root, embedding)
+        ingest_vectorstore(db, embedding, root, tenant)
         return db
-    else:
-        return Chroma(
-            client=PersistentClient(persist_directory),
-            embedding_function=embedding,
-            client_settings=Settings(anonymized_telemetry=False),
-            collection_metadata={"hnsw:space": "cosine"},
-        )
+    return open_vectorstore(generation_path(root, generation), embedding)
+
+
+def wait_for_generation(root=PERSIST_DIRECTORY) -> str:
+    logger.info("Waiting for the ingest worker to publish an index generation in %s", root)
+    while (generation := current_generation(root)) is None:
+        time.sleep(WORKER_WAIT_INTERVAL)
+    return generation
+
+
+class IndexHandle:
+    """The vectorstore of the current index generation.
+
+    get() re-reads the generation pointer at most every `check_interval` seconds and
+    switches to a newly published generation, so every worker follows refreshes made
+    by whichever process built them. After a fork a Chroma store is reopened, because
+    a client inherited from the parent holds sqlite connections, so every worker has
+    its own copy; only the fork_safe memory-mapped backends stay shared.
+    """
+
+    def __init__(self, embedding, root=PERSIST_DIRECTORY, check_interval=float(os.getenv("INDEX_CHECK_INTERVAL", "10")), tenant=None):
+        self.embedding = embedding
+        self.root = root
+        self.tenant = tenant
+        self.check_interval = check_interval
+        self.generation = None
+        self.vectorstore = None
+        self._pid = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        # Called with (vectorstore, generation) whenever a store is opened, e.g. to warm caches
+        self.on_open = None
+
+    def get(self, force: bool = False):
+        now = time.monotonic()
+        if force or self.vectorstore is None or self._pid != os.getpid() or now - self._checked > self.check_interval:
+            with self._lock:
+                self._checked = now
+                generation = current_generation(self.root)
+                forked = self._pid is not None and self._pid != os.getpid()
+                if self.vectorstore is None or generation != self.generation or (forked and not getattr(self.vectorstore, "fork_safe", False)):
+                    self._open(generation, forked)
+                self._pid = os.getpid()
+        return self.vectorstore
+
+    def _open(self, generation, forked):
+        if forked:
+            # Drop (without stopping) the client systems copied from the parent process.
+            getattr(SharedSystemClient, "_identifer_to_system", {}).clear()
+        if generation is None:
+            self.vectorstore = load_vectorstore(self.embedding, self.root, self.tenant)
+            generation = current_generation(self.root)
+        else:
+            self.vectorstore = open_vectorstore(generation_path(self.root, generation), self.embedding)
+        self.generation = generation
+        VECTORSTORE_DOCUMENTS.labels(getattr(self.tenant, "key", "default")).set(collection_of(self.vectorstore).count())
+        logger.info("Index generation %s loaded", generation)
+        if self.on_open is not None:
+            self.on_open(self.vectorstore, generation)
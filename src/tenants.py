@@ -0,0 +1,167 @@
+"""Several Moodle sites served by one process.
+
+TENANTS_FILE names a JSON file with one entry per site, keyed by the tenant key
+that requests send in the X-Tenant header:
+
+    {
+      "default": "campus",
+      "tenants": {
+        "campus": {"moodle_url": "https://moodle.example.org", "moodle_token_env": "CAMPUS_MOODLE_TOKEN"},
+        "academy": {
+          "moodle_url": "https://academy.example.org",
+          "moodle_token_env": "ACADEMY_MOODLE_TOKEN",
+          "refresh_hours": 6,
+          "max_documents": 50000,
+          "chat_sessions": 200,
+          "answer_cache_size": 200,
+          "max_concurrent_chats": 4,
+          "snapshot_path": "/snapshots/academy"
+        }
+      }
+    }
+
+Each tenant has its own index generations (data/stores/<key>, or
+"persist_directory"), refresh interval, chat sessions, answer cache and user
+profiles (see src.user_profile). The embedding model and the LLM backend pools
+are shared, so a site adds its index and caches to the process rather than
+another copy of the models. The limits keep one site from taking the memory or
+the LLM slots of the others:
+
+    max_documents         courses beyond this many documents are not indexed
+    chat_sessions         sessions held for the tenant (default CHAT_SESSION_MAX)
+    answer_cache_size     cached answers per index generation (default ANSWER_CACHE_SIZE)
+    max_concurrent_chats  /chat requests of the tenant being answered at once,
+                          more wait in a queue of max_queued_chats
+
+An empty index is restored from the tenant's "snapshot_path" (see
+src.index_snapshot) if it has one. Without TENANTS_FILE there is a single
+tenant, "default", that scrapes MOODLE_URL with MOODLE_API_TOKEN into
+data/stores/moodlestore as before, with INDEX_SNAPSHOT_PATH as its snapshot.
+Requests without X-Tenant go to the default tenant.
+"""
+import json
+import os
+import re
+from contextlib import asynccontextmanager, nullcontext
+from typing import Dict, Iterator, Optional
+
+from .admission import PRIORITY_DEFAULT, AdmissionController
+from .index_snapshot import INDEX_SNAPSHOT_PATH
+from .scrape_moodle import moodle_site
+from .sessions import SessionStore
+from .setup import PERSIST_DIRECTORY, REFRESH_INTERVAL
+from .user_profile import UserProfileStore
+
+TENANTS_FILE = os.getenv("TENANTS_FILE", "")
+DEFAULT_TENANT = "default"
+TENANT_KEY = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class Tenant:
+    def __init__(
+        self,
+        key: str,
+        moodle_url: Optional[str] = None,
+        moodle_token: Optional[str] = None,
+        persist_directory: Optional[str] = None,
+        refresh_interval: float = REFRESH_INTERVAL,
+        max_documents: Optional[int] = None,
+        chat_sessions: Optional[int] = None,
+        answer_cache_size: Optional[int] = None,
+        max_concurrent_chats: Optional[int] = None,
+        max_queued_chats: int = 32,
+        snapshot_path: Optional[str] = None,
+    ):
+        if not TENANT_KEY.match(key):
+            raise ValueError(f"Invalid tenant key {key!r}, use letters, digits, '-' and '_'")
+        self.key = key
+        self.moodle_url = moodle_url
+        self.moodle_token = moodle_token
+        self.persist_directory = persist_directory or os.path.join("data", "stores", key)
+        self.refresh_interval = refresh_interval
+        self.max_documents = max_documents
+        self.answer_cache_size = answer_cache_size
+        self.snapshot_path = snapshot_path
+        self.sessions = SessionStore(tenant=key, **({"maxsize": chat_sessions} if chat_sessions else {}))
+        self.profiles = UserProfileStore(site=self.scraping)
+        self.limiter = None
+        if max_concurrent_chats:
+            self.limiter = AdmissionController(
+                f"tenant.{key}",
+                max_concurrency=max_concurrent_chats,
+                max_queue=max_queued_chats,
+                max_wait=float(os.getenv("LLM_ADMISSION_MAX_WAIT_SECONDS", "15")),
+            )
+        # IndexHandle of the tenant's current generation, set up by the app
+        self.index = None
+
+    def scraping(self):
+        """Context in which the scrape functions talk to this tenant's site."""
+        if self.moodle_url is None:
+            # Configured from MOODLE_URL/MOODLE_API_TOKEN
+            return nullcontext()
+        return moodle_site(self.moodle_url, self.moodle_token)
+
+    @asynccontextmanager
+    async def chat_slot(self, priority: int = PRIORITY_DEFAULT, max_wait: Optional[float] = None):
+        """Held while one of the tenant's requests is answered, if the tenant has a limit.
+
+        max_wait replaces the limiter's own wait, e.g. with what is left of a /chat
+        request's deadline, or the longer wait of a batch item.
+        """
+        if self.limiter is None:
+            yield
+            return
+        async with self.limiter.slot(priority, max_wait=max_wait):
+            yield
+
+
+class TenantRegistry:
+    def __init__(self, tenants: Dict[str, Tenant], default: str):
+        if default not in tenants:
+            raise ValueError(f"Default tenant {default!r} is not configured")
+        self.tenants = tenants
+        self.default = tenants[default]
+
+    def get(self, key: Optional[str]) -> Tenant:
+        """The tenant for a key; KeyError for an unknown one."""
+        return self.tenants[key] if key else self.default
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(self.tenants.values())
+
+    def __len__(self) -> int:
+        return len(self.tenants)
+
+
+def tenant_from_config(key: str, config: Dict) -> Tenant:
+    token = config.get("moodle_token")
+    if token is None and config.get("moodle_token_env"):
+        token = os.getenv(config["moodle_token_env"])
+    if config.get("moodle_url") and not token:
+        raise ValueError(f"Tenant {key!r} has no Moodle API token")
+    refresh_hours = config.get("refresh_hours")
+    return Tenant(
+        key,
+        moodle_url=config.get("moodle_url"),
+        moodle_token=token,
+        persist_directory=config.get("persist_directory"),
+        refresh_interval=refresh_hours * 3600 if refresh_hours is not None else REFRESH_INTERVAL,
+        max_documents=config.get("max_documents"),
+        chat_sessions=config.get("chat_sessions"),
+        answer_cache_size=config.get("answer_cache_size"),
+        max_concurrent_chats=config.get("max_concurrent_chats"),
+        max_queued_chats=config.get("max_queued_chats", 32),
+        snapshot_path=config.get("snapshot_path"),
+    )
+
+
+def load_tenants(path: str = TENANTS_FILE) -> TenantRegistry:
+    if not path:
+        return TenantRegistry({DEFAULT_TENANT: Tenant(DEFAULT_TENANT, persist_directory=PERSIST_DIRECTORY, snapshot_path=INDEX_SNAPSHOT_PATH)}, DEFAULT_TENANT)
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    tenants = {key: tenant_from_config(key, tenant) for key, tenant in config["tenants"].items()}
+    if not tenants:
+        raise ValueError(f"No tenants configured in {path}")
+    return TenantRegistry(tenants, config.get("default") or next(iter(tenants)))
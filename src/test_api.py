@@ -1,34 +1,327 @@
+import asyncio
+import threading
+
+import pytest
 import uvicorn
-from fastapi import FastAPI
-from src.routes.main_router import router as main_router
-from src.setup import load_embedding_function, load_vectorstore
-from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
-import os
 
+# Loaded before the app modules, as in src.app: they read their configuration on import
 load_dotenv()
 
-# Initialize app
-app = FastAPI()
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+from langchain.docstore.document import Document
+from src.admission import PRIORITY_COURSE, PRIORITY_DEFAULT, PRIORITY_TEACHER, AdmissionController, Overloaded
+from src.coalesce import Flight, SingleFlight
+from src.deadline import deadline
+from src.routes import main_router
+from src.routes.main_router import CHAT_FALLBACK_CONTEXT, SOURCES_ONLY_INTRO, Query, flight_key, get_tenant
+from src.tenants import DEFAULT_TENANT, Tenant, TenantRegistry, load_tenants
+from src.user_profile import USER_CONTEXT
+from apscheduler.schedulers.background import BackgroundScheduler
+
 
-# Store resources in app's state so they can be accessed in views
-app.state.EMBEDDINGFUNCTION = load_embedding_function()
+def create_app(tenants) -> FastAPI:
+    app = FastAPI()
 
-def update_vectorstore():
-    app.state.VECTORSTORE = load_vectorstore(app.state.EMBEDDINGFUNCTION)
+    # The routes look the index up through the request's tenant, the default one without X-Tenant
+    app.state.TENANTS = tenants
+    app.state.INDEX = tenants.default.index
 
-update_vectorstore()
-scheduler = BackgroundScheduler()
-scheduler.add_job(update_vectorstore, 'interval', days=1)
+    # Add a test route for debugging purposes
+    @app.get("/")
+    async def root():
+        return {"message": "API is working!"}
 
-# Add a test route for debugging purposes
-@app.get("/")
-async def root():
-    return {"message": "API is working!"}
+    # Shows which tenant and index generation a request is routed to, e.g. with -H "X-Tenant: academy"
+    @app.get("/tenant")
+    async def tenant_route(tenant=Depends(get_tenant)):
+        return {"tenant": tenant.key, "generation": tenant.index.generation}
 
-# Register routes from main_router
-app.include_router(main_router)
+    # Register routes from main_router
+    app.include_router(main_router.router)
+    return app
 
-if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+def serve():
+    # Imported here, the tests do without the embedding model
+    from src.setup import IndexHandle, load_embedding_function
+
+    embedding = load_embedding_function()
+    tenants = load_tenants()
+    for tenant in tenants:
+        tenant.index = IndexHandle(embedding, tenant.persist_directory, tenant=tenant)
+        tenant.index.get()
+
+    def update_vectorstore():
+        for tenant in tenants:
+            tenant.index.get(force=True)
+
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(update_vectorstore, 'interval', days=1)
     scheduler.start()
+    uvicorn.run(create_app(tenants), host="0.0.0.0", port=8000)
+
+
+class VectorStore:
+    pass
+
+
+class StaticIndex:
+    """IndexHandle of a generation that never changes."""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.vectorstore = VectorStore()
+
+    def get(self, force=False):
+        return self.vectorstore
+
+
+@pytest.fixture
+def tenants(tmp_path):
+    default = Tenant(DEFAULT_TENANT, persist_directory=str(tmp_path / DEFAULT_TENANT))
+    academy = Tenant("academy", persist_directory=str(tmp_path / "academy"), max_concurrent_chats=1)
+    for tenant in (default, academy):
+        tenant.index = StaticIndex(f"{tenant.key}-generation")
+    return TenantRegistry({default.key: default, academy.key: academy}, DEFAULT_TENANT)
+
+
+@pytest.fixture
+def client(tenants):
+    return TestClient(create_app(tenants))
+
+
+@pytest.fixture
+def blocked():
+    """Released at the end of the test, so stage threads waiting on it finish."""
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def test_root(client):
+    assert client.get("/").json() == {"message": "API is working!"}
+
+
+def test_requests_go_to_the_tenant_of_their_header(client):
+    assert client.get("/tenant").json() == {"tenant": "default", "generation": "default-generation"}
+    assert client.get("/tenant", headers={"X-Tenant": "academy"}).json() == {"tenant": "academy", "generation": "academy-generation"}
+    assert client.get("/tenant", headers={"X-Tenant": "unknown"}).status_code == 404
+
+
+# Admission control
+
+
+def test_waiters_are_served_by_priority():
+    async def run():
+        limiter = AdmissionController("test", max_concurrency=1, max_queue=10, max_wait=5)
+        served = []
+
+        async def call(name, priority):
+            async with limiter.slot(priority):
+                served.append(name)
+
+        await limiter.acquire()
+        calls = [
+            asyncio.create_task(call("default", PRIORITY_DEFAULT)),
+            asyncio.create_task(call("course", PRIORITY_COURSE)),
+            asyncio.create_task(call("teacher", PRIORITY_TEACHER)),
+        ]
+        await asyncio.sleep(0)
+        assert limiter.queue_depth == 3
+        limiter.release()
+        await asyncio.gather(*calls)
+        return served
+
+    assert asyncio.run(run()) == ["teacher", "course", "default"]
+
+
+def test_overloaded_when_the_wait_expires_or_the_queue_is_full():
+    async def run():
+        limiter = AdmissionController("test", max_concurrency=1, max_queue=1, max_wait=5)
+        await limiter.acquire()
+        with pytest.raises(Overloaded) as timeout:
+            await limiter.acquire(max_wait=0.01)
+        assert timeout.value.reason == "timeout"
+        assert limiter.queue_depth == 0
+
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as full:
+            await limiter.acquire()
+        assert full.value.reason == "queue_full"
+        assert full.value.retry_after >= 1
+        limiter.release()
+        await waiting
+
+    asyncio.run(run())
+
+
+def test_cancelled_callers_give_their_slot_back():
+    async def run():
+        limiter = AdmissionController("test", max_concurrency=1, max_queue=10, max_wait=5)
+
+        async def hold():
+            async with limiter.slot():
+                await asyncio.sleep(60)
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.queue_depth == 1
+
+        # A client that goes away while queued leaves the queue
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert limiter.queue_depth == 0
+
+        # One that goes away while being answered frees its slot
+        holder.cancel()
+        await asyncio.gather(holder, return_exceptions=True)
+        await asyncio.wait_for(limiter.acquire(), 1)
+        limiter.release()
+
+    asyncio.run(run())
+
+
+# Coalescing
+
+
+def test_followers_get_the_result_of_the_leader():
+    async def run():
+        flights = SingleFlight("test")
+        calls = []
+
+        async def compute(flight):
+            calls.append(flight.key)
+            await asyncio.sleep(0.01)
+            return "Am Montag."
+
+        leader = flights.join("key", compute)
+        follower = flights.join("key", compute)
+        assert follower is leader and leader.requests == 2
+        assert await asyncio.gather(leader.wait(), follower.wait()) == ["Am Montag.", "Am Montag."]
+        assert calls == ["key"]
+        assert flights.stats()["coalesced"] == 1
+
+    asyncio.run(run())
+
+
+def test_followers_get_the_error_of_the_leader():
+    async def run():
+        flights = SingleFlight("test")
+
+        async def compute(flight):
+            await asyncio.sleep(0.01)
+            raise ValueError("backend down")
+
+        leader = flights.join("key", compute)
+        follower = flights.join("key", compute)
+        for flight in (leader, follower):
+            with pytest.raises(ValueError):
+                await flight.wait()
+
+    asyncio.run(run())
+
+
+def test_late_follower_replays_the_stream():
+    async def run():
+        flights = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def compute(flight):
+            flight.push("Die Klausur ")
+            flight.push("ist ")
+            await release.wait()
+            flight.push("am Montag.")
+            return "Die Klausur ist am Montag."
+
+        leader = flights.join("key", compute)
+        await asyncio.sleep(0)
+        follower = flights.join("key", compute)
+        assert follower is leader
+
+        chunks = []
+
+        async def read():
+            async for chunk in follower.stream():
+                chunks.append(chunk)
+
+        reader = asyncio.create_task(read())
+        await asyncio.sleep(0)
+        assert chunks == ["Die Klausur ", "ist "]
+        release.set()
+        await reader
+        assert chunks == ["Die Klausur ", "ist ", "am Montag."]
+
+    asyncio.run(run())
+
+
+def test_flight_key_separates_users_only_for_user_context(tenants):
+    tenant = tenants.default
+    first = Query(message="Wie weit bin ich?", course_id="12", user_id="1")
+    second = Query(message="wie weit  bin ich?", course_id="12", user_id="2")
+    assert flight_key(first, tenant) == flight_key(second, tenant)
+    assert flight_key(first, tenant, USER_CONTEXT) != flight_key(second, tenant, USER_CONTEXT)
+    assert flight_key(first, tenant) != flight_key(first, tenants.get("academy"))
+
+
+# Deadlines
+
+
+@pytest.mark.parametrize("course_id, route", [("12", "course_route"), (None, "default_route")])
+def test_routing_falls_back_when_over_budget(monkeypatch, blocked, course_id, route):
+    monkeypatch.setattr(main_router, "ROUTING_BUDGET", 0.05)
+    monkeypatch.setattr(main_router, "predict_context", lambda request: blocked.wait(5))
+
+    async def run():
+        flight = Flight("key")
+        with deadline(5):
+            context = await main_router.route_chat(Query(message="Wann ist die Klausur?", course_id=course_id), PRIORITY_DEFAULT, flight)
+        return context, flight.info["degraded"]
+
+    context, degraded = asyncio.run(run())
+    assert context == ("Course-Context" if course_id else CHAT_FALLBACK_CONTEXT)
+    assert degraded == [f"routing:{route}"]
+
+
+def test_generation_over_the_deadline_answers_with_the_sources(monkeypatch, blocked, tenants):
+    source = Document(page_content="Termine", metadata={"name": "Klausurtermine", "url": "https://moodle.example.org/mod/page/view.php?id=7"})
+    monkeypatch.setattr(main_router, "retrieve_context", lambda request, vectorstore, context, session=None: [source])
+    monkeypatch.setattr(main_router, "build_prompt", lambda request, context, session=None: ["messages"])
+    monkeypatch.setattr(main_router, "generate_answer", lambda messages, on_token=None: blocked.wait(5))
+    tenant = tenants.default
+
+    async def run():
+        flight = Flight("key")
+        with deadline(0.1):
+            response = await main_router.answer_chat(Query(message="Wann ist die Klausur?", course_id="12"), tenant.index.get(), PRIORITY_DEFAULT, flight, tenant, "Course-Context")
+        return response, flight.info["degraded"]
+
+    response, degraded = asyncio.run(run())
+    assert response == f"{SOURCES_ONLY_INTRO}\n- Klausurtermine (https://moodle.example.org/mod/page/view.php?id=7)"
+    assert degraded == ["generation:sources_only"]
+
+
+def test_deadline_spent_in_the_tenant_queue_is_a_504(monkeypatch, tenants):
+    monkeypatch.setattr(main_router, "deadline", lambda: deadline(0.05))
+    academy = tenants.get("academy")
+
+    async def run():
+        # Another request of the tenant holds its only chat slot
+        await academy.limiter.acquire()
+        try:
+            with pytest.raises(HTTPException) as e:
+                await main_router.chat(Query(message="Wann ist die Klausur?"), academy.index.get(), academy)
+        finally:
+            academy.limiter.release()
+        return e.value
+
+    error = asyncio.run(run())
+    assert error.status_code == 504
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,45 @@
+from langchain.docstore.document import Document
+
+from src.dedup import Deduplicator, course_flag
+
+TEXT = (
+    "Willkommen im Kurs. Hier finden Sie die Termine der Klausur, die Sprechstunden und alle Materialien der Vorlesung. "
+    "Die Folien werden jede Woche vor der Vorlesung hochgeladen, die Übungsblätter am Freitag nach der Übung."
+)
+
+
+def section(course_id: str, text: str = TEXT) -> Document:
+    return Document(page_content=text, metadata={"doc_type": "section", "course_id": course_id, "name": f"Allgemeines {course_id}"})
+
+
+def test_near_duplicate_is_dropped_and_flags_the_canonical_document():
+    dedup = Deduplicator(threshold=0.8)
+    ids, documents, updates = dedup.collapse(["1:0"], [section("1")])
+    assert ids == ["1:0"]
+    assert documents[0].metadata[course_flag("1")] is True
+
+    ids, documents, updates = dedup.collapse(["2:0"], [section("2", TEXT + " Viel Erfolg!")])
+    assert ids == [] and documents == []
+    assert updates["1:0"][course_flag("2")] is True
+    assert updates["1:0"]["duplicates"] == 1
+    assert updates["1:0"]["duplicate_course_ids"] == "2"
+    assert dedup.stats()["duplicates"] == 1
+
+
+def test_duplicate_within_one_item_updates_the_pending_document():
+    dedup = Deduplicator()
+    ids, documents, updates = dedup.collapse(["1:0", "1:1"], [section("1"), section("1")])
+    assert ids == ["1:0"]
+    assert updates == {}
+    assert documents[0].metadata["duplicates"] == 1
+
+
+def test_documents_below_the_threshold_stay_separate():
+    dedup = Deduplicator(threshold=0.85)
+    dedup.collapse(["1:0"], [section("1")])
+    other = "Die Klausur findet im Hörsaal statt. Bitte bringen Sie Ihren Studierendenausweis und einen Stift mit."
+    ids, documents, updates = dedup.collapse(["2:0"], [section("2", other)])
+    assert ids == ["2:0"]
+    assert updates == {}
+    assert documents[0].metadata[course_flag("2")] is True
+    assert course_flag("1") not in documents[0].metadata
@@ -0,0 +1,72 @@
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+import pytest
+
+from src.generations import current_generation, generation_path, new_generation, publish_generation
+from src.index_snapshot import SNAPSHOT_FORMAT, SNAPSHOT_MANIFEST, SnapshotError, export_snapshot, import_snapshot
+
+MODEL = "hkunlp/instructor-large"
+GENERATION = "20240601T120000"
+
+
+def published_store(root: str) -> str:
+    generation = new_generation(root)
+    with open(os.path.join(generation_path(root, generation), "records.jsonl"), "w", encoding="utf-8") as f:
+        f.write('{"op": "put", "id": "a", "text": "a", "metadata": {}}\n')
+    publish_generation(root, generation, {"embedding_model": MODEL, "vectorstore": "numpy", "documents": 1})
+    return generation
+
+
+def write_snapshot(path: str, members, files=None):
+    """A snapshot whose manifest lists `files` (default: the members as given) and that holds `members`."""
+    if files is None:
+        files = [
+            {"path": name[len("index/"):], "size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+            for name, data in members
+        ]
+    manifest = {"format": SNAPSHOT_FORMAT, "generation": GENERATION, "embedding_model": MODEL, "files": files}
+    with tarfile.open(path, "w") as tar:
+        for name, data in [(SNAPSHOT_MANIFEST, json.dumps(manifest).encode("utf-8"))] + list(members):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def test_export_and_import_round_trip(tmp_path):
+    generation = published_store(str(tmp_path / "source"))
+    snapshot = export_snapshot(str(tmp_path / "source"), str(tmp_path))
+
+    root = str(tmp_path / "target")
+    assert import_snapshot(root, snapshot, MODEL) == generation
+    assert current_generation(root) == generation
+    with open(os.path.join(generation_path(root, generation), "records.jsonl"), encoding="utf-8") as f:
+        assert f.read().startswith('{"op": "put"')
+
+
+def test_import_rejects_a_checksum_mismatch(tmp_path):
+    data = b"vectors"
+    files = [{"path": "vectors.bin", "size": len(data), "sha256": hashlib.sha256(b"other").hexdigest()}]
+    snapshot = write_snapshot(str(tmp_path / "index-20240601T120000.tar"), [("index/vectors.bin", data)], files)
+
+    root = str(tmp_path / "store")
+    with pytest.raises(SnapshotError, match="Checksum mismatch"):
+        import_snapshot(root, snapshot, MODEL)
+    assert current_generation(root) is None
+    assert not os.path.exists(generation_path(root, GENERATION))
+
+
+@pytest.mark.parametrize("name", ["/tmp/escaped", "index/../escaped", "index//tmp/escaped", "../escaped"])
+def test_import_rejects_paths_outside_the_generation(tmp_path, name):
+    snapshot = write_snapshot(str(tmp_path / "index-20240601T120000.tar"), [(name, b"x")])
+
+    root = str(tmp_path / "store")
+    with pytest.raises(SnapshotError):
+        import_snapshot(root, snapshot, MODEL)
+    assert current_generation(root) is None
+    assert not os.path.exists(tmp_path / "escaped")
+    assert not os.path.exists(os.path.join(root, "escaped"))
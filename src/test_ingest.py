@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from src.dedup import Deduplicator, course_flag
+from src.ingest import CHECKPOINT_FILENAME, IngestPipeline
+from src.scrape_moodle import MoodleCourse, MoodleCourseSection, MoodleModule, MoodleModuleContent, MoodleSiteInfo
+
+TEXT = (
+    "Willkommen im Kurs. Hier finden Sie die Termine der Klausur, die Sprechstunden und alle Materialien der Vorlesung. "
+    "Die Folien werden jede Woche vor der Vorlesung hochgeladen, die Übungsblätter am Freitag nach der Übung. "
+    "Fragen zum Stoff stellen Sie bitte im Forum, damit alle Teilnehmenden von den Antworten profitieren können."
+)
+
+
+def site(courses: int) -> MoodleSiteInfo:
+    return MoodleSiteInfo(
+        name="Test Site",
+        url="https://moodle.example.org",
+        courses=[MoodleCourse(id=i, name=f"Kurs {i}", summary=f"Zusammenfassung {i}") for i in range(1, courses + 1)],
+    )
+
+
+def copied_sections(course_id):
+    # Every course is a copy of the same template
+    return [
+        MoodleCourseSection(
+            name="Allgemeines",
+            course_id=course_id,
+            description=TEXT,
+            modules=[
+                MoodleModule(
+                    id=course_id * 100,
+                    name="Ankündigungen",
+                    modname="page",
+                    url=f"https://moodle.example.org/mod/page/view.php?id={course_id * 100}",
+                    course_id=course_id,
+                    contents=[MoodleModuleContent(type="file", course_id=course_id, filename="index.html", text=TEXT)],
+                )
+            ],
+        )
+    ]
+
+
+class Collection:
+    def __init__(self):
+        self.documents = {}
+        self.fail_on = None
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        self.documents.update((id, dict(metadata)) for id, metadata in zip(ids, metadatas))
+        if self.fail_on is not None and any(id.startswith(self.fail_on) for id in ids):
+            # The process dies after writing the course, before its checkpoint
+            self.fail_on = None
+            raise RuntimeError("killed")
+
+    def update(self, ids, metadatas):
+        for id, metadata in zip(ids, metadatas):
+            self.documents[id].update(metadata)
+
+    def delete(self, where):
+        (key, value), = where.items()
+        self.documents = {id: metadata for id, metadata in self.documents.items() if metadata.get(key) != value}
+
+    def count(self):
+        return len(self.documents)
+
+
+class Embeddings:
+    def embed_documents(self, texts):
+        return [[0.0] for _ in texts]
+
+
+def pipeline(collection, tmp_path) -> IngestPipeline:
+    return IngestPipeline(
+        collection,
+        Embeddings(),
+        os.path.join(str(tmp_path), CHECKPOINT_FILENAME),
+        get_sections=copied_sections,
+        dedup=Deduplicator(),
+        report_interval=60,
+    )
+
+
+def test_resume_after_crash_mid_course_keeps_collapsing_duplicates(tmp_path):
+    collection = Collection()
+    collection.fail_on = "2:"
+    with pytest.raises(RuntimeError):
+        pipeline(collection, tmp_path).run(site(3))
+
+    pipeline(collection, tmp_path).run(site(3))
+
+    copies = [id for id, metadata in collection.documents.items() if metadata["doc_type"] in ("section", "module", "content") and metadata.get("course_id") != "1"]
+    assert copies == []
+    canonical = [metadata for metadata in collection.documents.values() if metadata["doc_type"] in ("section", "module", "content")]
+    assert canonical
+    for metadata in canonical:
+        assert metadata[course_flag("2")] and metadata[course_flag("3")]
+        assert metadata["duplicates"] == 2
+        assert metadata["duplicate_course_ids"] == "2\n3"
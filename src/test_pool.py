@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from src.models import pool as pool_module
+from src.models.pool import BackendPool
+
+
+class Healthy:
+    ok = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def backend_pool(monkeypatch):
+    def generate(model, messages, role, on_token=None):
+        if model == "http://bad":
+            raise RuntimeError("completion failed")
+        return "ok"
+
+    monkeypatch.setattr(pool_module, "create_chat_openai_with_base", lambda url, **kwargs: url)
+    monkeypatch.setattr(pool_module, "generate", generate)
+    # /models answers on every backend
+    monkeypatch.setattr(pool_module.requests, "get", lambda url, timeout: Healthy())
+    return BackendPool("answer", ["http://bad", "http://good"], failure_threshold=2, eject_seconds=30)
+
+
+def test_failing_backend_stays_ejected_while_its_probe_succeeds(backend_pool, clock):
+    bad = backend_pool.backends[0]
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            backend_pool.generate([])
+    assert bad.eject_reason == "failing"
+
+    clock[0] += 10
+    backend_pool.probe()
+    assert not bad.available(clock[0])
+    assert [backend_pool.generate([]) for _ in range(3)] == ["ok"] * 3
+
+    clock[0] += 21
+    backend_pool.probe()
+    assert bad.available(clock[0])
+    assert bad.eject_reason is None
+    assert bad.consecutive_failures == 0
+
+
+def test_probe_readmits_backend_ejected_by_a_failed_probe(backend_pool, clock, monkeypatch):
+    bad = backend_pool.backends[0]
+    monkeypatch.setattr(pool_module.requests, "get", lambda url, timeout: type("Down", (), {"ok": url.startswith("http://good")})())
+    backend_pool.probe()
+    assert bad.eject_reason == "probe_failed"
+
+    monkeypatch.setattr(pool_module.requests, "get", lambda url, timeout: Healthy())
+    clock[0] += 10
+    backend_pool.probe()
+    assert bad.available(clock[0])
@@ -0,0 +1,60 @@
+import json
+import os
+import time
+from types import SimpleNamespace
+
+from src import warmup
+from src.query_log import QueryLog, masked, popular_queries, read_records
+from src.routes.main_router import Query, answer_cache, chat_key
+from src.tenants import Tenant
+
+
+def request(message, course_id="12", usercontext="Kurs", session_id=None, user_id=None):
+    return SimpleNamespace(message=message, course_id=course_id, usercontext=usercontext, session_id=session_id, user_id=user_id)
+
+
+def record(message, context="Course-Context", **fields):
+    return dict({"ts": time.time(), "tenant": "default", "message": message, "course_id": "12", "usercontext": "Kurs", "context": context, "status": "ok"}, **fields)
+
+
+def test_record_is_anonymized(tmp_path):
+    log = QueryLog(str(tmp_path))
+    log.record(request("Meine Matrikelnummer ist 1234567, schreib an max.muster@uni.de", session_id="s-1", user_id="4711"), context="User-Context")
+    log.flush()
+
+    [logged] = read_records([str(tmp_path)])
+    assert logged["message"] == "Meine Matrikelnummer ist <number>, schreib an <email>"
+    assert "user_id" not in logged
+    assert "4711" not in json.dumps(logged)
+    assert logged["session"] != "s-1"
+    assert masked(logged)
+
+
+def test_popular_queries_rank_by_frequency():
+    records = [record("Wann ist die Klausur?")] * 3 + [record("Wo ist der Hörsaal?")] * 2 + [record("Raum?")]
+    # Follow-ups and failed requests are not stand-alone questions
+    records += [record("Raum?", session="abc")] * 5 + [record("Raum?", status="error")] * 5
+
+    popular = popular_queries(records, 3)
+    assert [(entry["message"], count) for entry, count in popular] == [("Wann ist die Klausur?", 3), ("Wo ist der Hörsaal?", 2), ("Raum?", 1)]
+
+
+def test_warm_up_skips_masked_questions(tmp_path, monkeypatch):
+    records = [record("Wann ist die Klausur?"), record("Note für <number>?"), record("Frage", usercontext="Mail an <email>")]
+    with open(os.path.join(str(tmp_path), "queries.1.jsonl"), "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in records)
+    embedded = []
+    monkeypatch.setattr(warmup, "embed_queries", lambda embeddings, queries: embedded.extend(queries))
+    monkeypatch.setattr(warmup, "prepare_answer", lambda request, vectorstore, context: ["messages"])
+    monkeypatch.setattr(warmup, "generate_answer", lambda messages: "Am Montag.")
+
+    class VectorStore:
+        embeddings = None
+
+    vectorstore = VectorStore()
+    warmup.warm_caches(vectorstore, Tenant("default"), directory=str(tmp_path))
+
+    assert embedded == ["Wann ist die Klausur?"]
+    cache = answer_cache(vectorstore)
+    assert len(cache) == 1
+    assert cache.get(chat_key(Query(message="Wann ist die Klausur?", course_id="12", usercontext="Kurs"))) == ("Course-Context", "Am Montag.")
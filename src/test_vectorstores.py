@@ -0,0 +1,27 @@
+import json
+import os
+
+from src.vectorstores.memmap import RECORDS_FILENAME, MemmapVectorStore
+
+
+def test_reopen_after_partial_record(tmp_path):
+    directory = str(tmp_path)
+    store = MemmapVectorStore(directory, None)
+    store.upsert(["a", "b"], [[1, 0, 0], [0, 1, 0]], [{"course_id": "1"}, {"course_id": "2"}], ["a", "b"])
+
+    # A crash while the next batch was logged: its vectors are written, its record is cut short
+    with open(os.path.join(directory, "vectors.bin"), "ab") as f:
+        f.write(b"\0" * 12)
+    with open(os.path.join(directory, RECORDS_FILENAME), "a", encoding="utf-8") as f:
+        f.write(json.dumps({"op": "put", "id": "lost", "text": "x", "metadata": {}})[:20])
+
+    resumed = MemmapVectorStore(directory, None)
+    assert resumed.count() == 2
+    resumed.upsert(["c"], [[0, 0, 1]], [{"course_id": "3"}], ["c"])
+
+    reopened = MemmapVectorStore(directory, None)
+    assert reopened.count() == 3
+    hits = reopened.search_by_vectors([[0, 0, 1], [1, 0, 0]], k=1)
+    assert [hits[0][0].id, hits[1][0].id] == ["c", "a"]
+    assert reopened.get_documents({"course_id": "3"})[0].page_content == "c"
+
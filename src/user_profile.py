@@ -0,0 +1,230 @@
+"""Learning profiles of the users asking, for questions routed to User-Context.
+
+The Moodle plugin sends the id of the logged-in user as user_id. A question
+routed to [User-Context] then gets a compact profile document of that user next
+to the retrieved documents, built from three web service calls:
+
+    core_enrol_get_users_courses            enrolled courses with progress, completion
+                                            and last access
+    core_user_get_users_by_field            name, description and interests
+    gradereport_overview_get_course_grades  course totals
+
+The token's web service user needs these functions; without the last two the
+profile only lists the courses.
+
+Profiles are cached per tenant, for at most USER_PROFILE_CACHE_SIZE users and
+USER_PROFILE_TTL_MINUTES. A cached profile older than USER_PROFILE_REFRESH_MINUTES
+is still used, and refreshed in the background for the next question, so only a
+user's first question (or the first after a long pause) waits for Moodle.
+Every web service call gives up after USER_PROFILE_TIMEOUT_SECONDS (default
+RETRIEVAL_BUDGET_SECONDS), so a hanging Moodle does not hold a stage or refresh
+thread after the request has moved on without the profile.
+
+user_id is taken as sent, so with USER_PROFILES enabled the API must only be
+reachable through the Moodle plugin.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+from langchain.docstore.document import Document
+
+from .cache import LRUCache
+from .deadline import RETRIEVAL_BUDGET
+from .log import log_event
+from .metrics import USER_PROFILE_FETCHES, record_cache
+from .scrape_moodle import moodle_api_call
+
+logger = logging.getLogger(__name__)
+
+USER_PROFILES = os.getenv("USER_PROFILES", "false").lower() in ("1", "true", "yes")
+USER_CONTEXT = "User-Context"
+USER_PROFILE_TIMEOUT = float(os.getenv("USER_PROFILE_TIMEOUT_SECONDS", str(RETRIEVAL_BUDGET)))
+# Courses listed in a profile, the most recently accessed first
+MAX_PROFILE_COURSES = 30
+MAX_DESCRIPTION_CHARS = 500
+
+TAG = re.compile(r"<[^>]+>")
+
+
+class MoodleServiceError(Exception):
+    pass
+
+
+def strip_html(text: Optional[str]) -> str:
+    return " ".join(TAG.sub(" ", text or "").split())
+
+
+def moodle_service_call(function_name: str, params: Dict, required: bool = True):
+    """moodle_api_call() that turns the error objects Moodle answers with into exceptions.
+
+    With required=False a failing call is logged and gives None.
+    """
+    data = moodle_api_call(function_name, params, timeout=USER_PROFILE_TIMEOUT)
+    if isinstance(data, dict) and "exception" in data:
+        if required:
+            raise MoodleServiceError(f"{function_name}: {data.get('errorcode')} {data.get('message')}")
+        log_event(logger, logging.WARNING, "user_profile.call_failed", function=function_name, error=data.get("errorcode"))
+        return None
+    return data
+
+
+class EnrolledCourse:
+    __slots__ = ("id", "name", "progress", "completed", "last_access", "grade")
+
+    def __init__(
+        self,
+        id: str,
+        name: str,
+        progress: Optional[float] = None,
+        completed: Optional[bool] = None,
+        last_access: Optional[int] = None,
+        grade: Optional[str] = None,
+    ):
+        self.id = id
+        self.name = name
+        self.progress = progress
+        self.completed = completed
+        self.last_access = last_access
+        self.grade = grade
+
+    def __str__(self):
+        details = []
+        if self.completed:
+            details.append("completed")
+        elif self.progress is not None:
+            details.append(f"{round(self.progress)}% done")
+        if self.grade not in (None, "", "-"):
+            details.append(f"grade {self.grade}")
+        if self.last_access:
+            details.append(f"last accessed {datetime.fromtimestamp(self.last_access, timezone.utc):%Y-%m-%d}")
+        return f"{self.name} (course {self.id})" + (f": {', '.join(details)}" if details else "")
+
+
+class UserProfile:
+    __slots__ = ("user_id", "name", "description", "interests", "courses", "fetched_at")
+
+    def __init__(
+        self,
+        user_id: str,
+        name: Optional[str] = None,
+        description: Optional[str] = None,
+        interests: Optional[str] = None,
+        courses: Optional[List[EnrolledCourse]] = None,
+    ):
+        self.user_id = user_id
+        self.name = name
+        self.description = description
+        self.interests = interests
+        self.courses = courses if courses is not None else []
+        self.fetched_at = time.monotonic()
+
+    def __str__(self):
+        lines = [f"Profile of the current user{f' {self.name}' if self.name else ''}"]
+        if self.description:
+            lines.append(f"About: {self.description[:MAX_DESCRIPTION_CHARS]}")
+        if self.interests:
+            lines.append(f"Interests: {self.interests}")
+        if not self.courses:
+            lines.append("Not enrolled in any course")
+            return "\n".join(lines)
+        courses = sorted(self.courses, key=lambda course: course.last_access or 0, reverse=True)
+        lines.append(f"Enrolled in {len(courses)} courses:")
+        lines.extend(f" - {course}" for course in courses[:MAX_PROFILE_COURSES])
+        return "\n".join(lines)
+
+    def to_document(self) -> Document:
+        return Document(page_content=str(self), metadata={"doc_type": "user_profile", "user_id": self.user_id})
+
+
+def fetch_profile(user_id: str) -> UserProfile:
+    enrolments = moodle_service_call("core_enrol_get_users_courses", {"userid": user_id})
+    users = moodle_service_call("core_user_get_users_by_field", {"field": "id", "values[0]": user_id}, required=False)
+    grades = moodle_service_call("gradereport_overview_get_course_grades", {"userid": user_id}, required=False)
+
+    user = users[0] if users else {}
+    course_grades = {str(grade.get("courseid")): grade.get("grade") for grade in (grades or {}).get("grades", [])}
+    courses = [
+        EnrolledCourse(
+            id=str(course.get("id")),
+            name=course.get("fullname") or course.get("shortname") or "",
+            progress=course.get("progress"),
+            completed=course.get("completed"),
+            last_access=course.get("lastaccess"),
+            grade=course_grades.get(str(course.get("id"))),
+        )
+        for course in enrolments
+    ]
+    return UserProfile(
+        user_id,
+        name=user.get("firstname"),
+        description=strip_html(user.get("description")),
+        interests=user.get("interests"),
+        courses=courses,
+    )
+
+
+class UserProfileStore:
+    def __init__(
+        self,
+        maxsize: int = int(os.getenv("USER_PROFILE_CACHE_SIZE", "1000")),
+        ttl: float = float(os.getenv("USER_PROFILE_TTL_MINUTES", "120")) * 60,
+        refresh_after: float = float(os.getenv("USER_PROFILE_REFRESH_MINUTES", "10")) * 60,
+        fetch: Callable[[str], UserProfile] = fetch_profile,
+        site: Callable = nullcontext,
+    ):
+        self.refresh_after = refresh_after
+        self.fetch = fetch
+        # Context for the web service calls, the tenant's Moodle site
+        self.site = site
+        self._profiles = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=int(os.getenv("USER_PROFILE_REFRESH_THREADS", "2")), thread_name_prefix="user-profile")
+
+    def get(self, user_id: str) -> UserProfile:
+        """The cached profile, fetched now if there is none."""
+        profile = self._profiles.get(user_id)
+        record_cache("user_profile", profile is not None)
+        if profile is None:
+            return self.load(user_id)
+        if time.monotonic() - profile.fetched_at > self.refresh_after:
+            self.refresh_in_background(user_id)
+        return profile
+
+    def load(self, user_id: str) -> UserProfile:
+        try:
+            with self.site():
+                profile = self.fetch(user_id)
+        except Exception:
+            USER_PROFILE_FETCHES.labels("error").inc()
+            raise
+        USER_PROFILE_FETCHES.labels("ok").inc()
+        self._profiles.set(user_id, profile)
+        return profile
+
+    def refresh_in_background(self, user_id: str):
+        with self._lock:
+            if user_id in self._refreshing:
+                return
+            self._refreshing.add(user_id)
+        self._executor.submit(self._refresh, user_id)
+
+    def _refresh(self, user_id: str):
+        try:
+            self.load(user_id)
+        except Exception as e:
+            # The stale profile is used until it expires
+            log_event(logger, logging.WARNING, "user_profile.refresh_failed", error=str(e))
+        finally:
+            with self._lock:
+                self._refreshing.discard(user_id)
+
+    def drop(self, user_id: str) -> bool:
+        return self._profiles.pop(user_id) is not None
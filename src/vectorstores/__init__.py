@@ -0,0 +1,58 @@
+"""Vectorstore backends of an index generation.
+
+    chroma  langchain's Chroma over a PersistentClient (default)
+    numpy   exact search over a memory-mapped matrix, see src.vectorstores.memmap
+    hnsw    the same storage with an hnswlib graph index, see src.vectorstores.hnsw
+
+VECTORSTORE_BACKEND only chooses the backend of new generations; a store that
+already exists is always opened with the backend it was built with, so switching
+takes effect with the next index refresh.
+
+The numpy and hnsw stores implement the part of the Chroma collection API that
+ingest writes with (upsert, update, delete, count) and the search_by_vectors /
+get_documents hooks of src.retrieval.
+"""
+import json
+import os
+from typing import Optional
+
+VECTORSTORE_BACKEND = os.getenv("VECTORSTORE_BACKEND", "chroma").lower()
+BACKENDS = ("chroma", "numpy", "hnsw")
+BACKEND_FILENAME = "vectorstore.json"
+CHROMA_FILENAME = "chroma.sqlite3"
+
+
+def stored_backend(directory: str) -> Optional[str]:
+    """The backend a store directory was built with, None for a new store."""
+    try:
+        with open(os.path.join(directory, BACKEND_FILENAME), "r", encoding="utf-8") as f:
+            return json.load(f)["backend"]
+    except FileNotFoundError:
+        pass
+    if os.path.exists(os.path.join(directory, CHROMA_FILENAME)):
+        return "chroma"
+    return None
+
+
+def open_backend(backend: str, directory: str, embedding):
+    """Open a numpy or hnsw store; Chroma is opened by src.setup.open_vectorstore."""
+    if backend == "numpy":
+        from .memmap import MemmapVectorStore
+
+        return MemmapVectorStore(directory, embedding)
+    if backend == "hnsw":
+        from .hnsw import HnswVectorStore
+
+        return HnswVectorStore(directory, embedding)
+    raise ValueError(f"Unknown vectorstore backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+
+
+def collection_of(vectorstore):
+    """The object ingest writes to: the Chroma collection, or the store itself."""
+    return getattr(vectorstore, "_collection", vectorstore)
+
+
+def finalize(vectorstore):
+    """Make a freshly ingested store ready for serving (builds and saves search indexes)."""
+    if hasattr(vectorstore, "finalize"):
+        vectorstore.finalize()
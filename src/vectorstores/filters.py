@@ -0,0 +1,120 @@
+"""Evaluation of Chroma `where` filters against a metadata dict.
+
+Supports what the routes and ingest use: `$and`, `$or`, the comparison operators
+and the `{"key": value}` shorthand for `$eq`. As in Chroma, a document without
+the key never matches a condition on it, not even `$ne`/`$nin`.
+
+matches() tests a single metadata dict; MetadataIndex evaluates a filter over a
+whole store at once from per-key posting lists.
+"""
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+_MISSING = object()
+
+_OPERATORS = {
+    "$eq": lambda value, operand: value == operand,
+    "$ne": lambda value, operand: value != operand,
+    "$in": lambda value, operand: value in operand,
+    "$nin": lambda value, operand: value not in operand,
+    "$gt": lambda value, operand: value > operand,
+    "$gte": lambda value, operand: value >= operand,
+    "$lt": lambda value, operand: value < operand,
+    "$lte": lambda value, operand: value <= operand,
+}
+
+
+def matches(metadata: dict, where: Optional[dict]) -> bool:
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == "$and":
+            if not all(matches(metadata, clause) for clause in condition):
+                return False
+        elif key == "$or":
+            if not any(matches(metadata, clause) for clause in condition):
+                return False
+        elif not _compare(metadata.get(key, _MISSING), condition):
+            return False
+    return True
+
+
+def _compare(value, condition) -> bool:
+    if value is _MISSING:
+        return False
+    if not isinstance(condition, dict):
+        condition = {"$eq": condition}
+    for operator, operand in condition.items():
+        try:
+            test = _OPERATORS[operator]
+        except KeyError:
+            raise ValueError(f"Unsupported filter operator {operator}")
+        if not test(value, operand):
+            return False
+    return True
+
+
+class MetadataIndex:
+    """Posting lists per metadata key, built on first use of the key.
+
+    The equality operators ($eq, $in and their negations) are answered from the
+    postings as boolean row masks; range operators test the values of the rows
+    that have the key.
+    """
+
+    def __init__(self, metadatas: Sequence[Optional[dict]]):
+        self.metadatas = metadatas
+        self.size = len(metadatas)
+        self._postings: Dict[str, Dict[object, np.ndarray]] = {}
+
+    def postings(self, key: str) -> Dict[object, np.ndarray]:
+        postings = self._postings.get(key)
+        if postings is None:
+            rows: Dict[object, list] = {}
+            for row, metadata in enumerate(self.metadatas):
+                if metadata is not None and key in metadata:
+                    rows.setdefault(metadata[key], []).append(row)
+            postings = self._postings[key] = {value: np.array(value_rows, dtype=np.int64) for value, value_rows in rows.items()}
+        return postings
+
+    def mask(self, where: Optional[dict]) -> np.ndarray:
+        mask = np.ones(self.size, dtype=bool)
+        for key, condition in (where or {}).items():
+            if key == "$and":
+                for clause in condition:
+                    mask &= self.mask(clause)
+            elif key == "$or":
+                any_clause = np.zeros(self.size, dtype=bool)
+                for clause in condition:
+                    any_clause |= self.mask(clause)
+                mask &= any_clause
+            else:
+                mask &= self._condition(key, condition)
+        return mask
+
+    def _condition(self, key: str, condition) -> np.ndarray:
+        postings = self.postings(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        mask = self._rows(postings, postings.keys())
+        for operator, operand in condition.items():
+            if operator in ("$eq", "$ne"):
+                selected = self._rows(postings, [operand])
+            elif operator in ("$in", "$nin"):
+                selected = self._rows(postings, operand)
+            elif operator in _OPERATORS:
+                test = _OPERATORS[operator]
+                selected = self._rows(postings, [value for value in postings if test(value, operand)])
+            else:
+                raise ValueError(f"Unsupported filter operator {operator}")
+            mask &= ~selected if operator in ("$ne", "$nin") else selected
+        return mask
+
+    def _rows(self, postings: Dict[object, np.ndarray], values) -> np.ndarray:
+        mask = np.zeros(self.size, dtype=bool)
+        for value in values:
+            rows = postings.get(value)
+            if rows is not None:
+                mask[rows] = True
+        return mask
@@ -0,0 +1,145 @@
+"""Approximate vector search with an hnswlib graph over the memory-mapped store.
+
+Vectors, documents and metadata are stored exactly as in src.vectorstores.memmap;
+the HNSW graph is an index on top of them, saved as hnsw.bin when ingest
+finishes (or built on first use). Filters are applied during the graph search.
+Filters that leave only a few documents (a single course) are searched exactly
+instead, which is both faster and exact.
+
+Tuning, all via environment variables:
+
+    HNSW_M                 graph degree; higher means better recall, more memory (16)
+    HNSW_EF_CONSTRUCTION   candidate list size while building (200)
+    HNSW_EF_SEARCH         candidate list size while searching, at least k (64)
+    HNSW_EXACT_MAX_ROWS    filters matching at most this many rows are searched exactly (2000)
+"""
+import json
+import logging
+import os
+from typing import List, Optional, Sequence
+
+import hnswlib
+import numpy as np
+
+from ..cache import LRUCache
+from ..retrieval import SearchHit
+from .memmap import MemmapVectorStore, normalize
+
+logger = logging.getLogger(__name__)
+
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+HNSW_EXACT_MAX_ROWS = int(os.getenv("HNSW_EXACT_MAX_ROWS", "2000"))
+INDEX_FILENAME = "hnsw.bin"
+INDEX_META_FILENAME = "hnsw.json"
+BUILD_BLOCK_ROWS = 10000
+
+
+class HnswVectorStore(MemmapVectorStore):
+    backend = "hnsw"
+    # The graph is read-only once built; forked workers share its pages
+    fork_safe = True
+
+    def __init__(
+        self,
+        directory: str,
+        embedding,
+        dtype: Optional[str] = None,
+        m: int = HNSW_M,
+        ef_construction: int = HNSW_EF_CONSTRUCTION,
+        ef_search: int = HNSW_EF_SEARCH,
+        exact_max_rows: int = HNSW_EXACT_MAX_ROWS,
+    ):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.exact_max_rows = exact_max_rows
+        self._index = None
+        self._masks = LRUCache(maxsize=256)
+        super().__init__(directory, embedding, dtype)
+        self._index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_META_FILENAME), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        if meta.get("rows") != len(self._ids) or meta.get("dead") != len(self._ids) - self.count():
+            # Written before the last upsert; rebuilt on first use
+            return None
+        index = hnswlib.Index(space="ip", dim=self.dim)
+        index.load_index(os.path.join(self.directory, INDEX_FILENAME), max_elements=len(self._ids))
+        self.m, self.ef_construction = meta.get("m", self.m), meta.get("ef_construction", self.ef_construction)
+        return index
+
+    def index(self):
+        if self._index is None and self._ids:
+            self._index = self._build_index()
+        return self._index
+
+    def _build_index(self):
+        matrix = self.matrix()
+        index = hnswlib.Index(space="ip", dim=self.dim)
+        index.init_index(max_elements=len(self._ids), M=self.m, ef_construction=self.ef_construction)
+        for start in range(0, len(self._ids), BUILD_BLOCK_ROWS):
+            end = min(start + BUILD_BLOCK_ROWS, len(self._ids))
+            index.add_items(np.asarray(matrix[start:end], dtype=np.float32), np.arange(start, end))
+        for row, id in enumerate(self._ids):
+            if id is None:
+                index.mark_deleted(row)
+        logger.info("Built HNSW index over %d vectors (M=%d, ef_construction=%d)", len(self._ids), self.m, self.ef_construction)
+        return index
+
+    def finalize(self):
+        """Build the graph and save it next to the vectors."""
+        index = self.index()
+        if index is None:
+            return
+        tmp_path = os.path.join(self.directory, INDEX_FILENAME + ".tmp")
+        index.save_index(tmp_path)
+        os.replace(tmp_path, os.path.join(self.directory, INDEX_FILENAME))
+        with open(os.path.join(self.directory, INDEX_META_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(
+                {"rows": len(self._ids), "dead": len(self._ids) - self.count(), "m": self.m, "ef_construction": self.ef_construction},
+                f,
+            )
+
+    def search_by_vectors(self, vectors: Sequence[Sequence[float]], k: int = 5, filter: Optional[dict] = None) -> List[List[SearchHit]]:
+        rows = self.select(filter)
+        if not rows.size:
+            return [[] for _ in vectors]
+        queries = normalize(vectors)
+        if rows.size <= max(self.exact_max_rows, k):
+            return self.exact_search(queries, rows, k)
+
+        index = self.index()
+        index.set_ef(max(self.ef_search, k))
+        try:
+            if rows.size == self.count():
+                labels, distances = index.knn_query(queries, k=k)
+            else:
+                mask = self._allowed(filter, rows)
+                # The filter is a Python callback, it needs the GIL on every call anyway
+                labels, distances = index.knn_query(queries, k=k, num_threads=1, filter=lambda label: bool(mask[label]))
+        except RuntimeError:
+            # Fewer than k reachable matches for a very selective filter
+            return self.exact_search(queries, rows, k)
+        # space=ip over normalized vectors: distance = 1 - cosine similarity
+        return [self.hits(query_labels, query_distances) for query_labels, query_distances in zip(labels, distances)]
+
+    def _allowed(self, filter: Optional[dict], rows: np.ndarray) -> np.ndarray:
+        key = json.dumps(filter, sort_keys=True)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = np.zeros(len(self._ids), dtype=bool)
+            mask[rows] = True
+            self._masks.set(key, mask)
+        return mask
+
+    def _changed(self):
+        super()._changed()
+        # Rebuilt from the vectors on the next search or finalize()
+        self._index = None
+        self._masks.clear()
@@ -0,0 +1,225 @@
+"""Exact vector search over a memory-mapped matrix.
+
+The store directory holds:
+
+    vectors.bin      normalized embeddings, one row per document (float32 or float16)
+    records.jsonl    append-only log of puts, metadata updates and deletes
+    vectorstore.json backend, dimension and dtype
+
+Rows are only ever appended; an upsert of an existing id or a delete marks the
+old row dead. The matrix is mapped read-only, so the forked gunicorn workers
+share one copy of it in the page cache instead of holding one each. Every
+search scores all rows matching the filter, which stays fast for small and
+medium sites (a few 100k documents) and is exact.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain.docstore.document import Document
+
+from ..cache import LRUCache
+from ..retrieval import SearchHit
+from . import BACKEND_FILENAME
+from .filters import MetadataIndex, matches
+
+logger = logging.getLogger(__name__)
+
+VECTORSTORE_DTYPE = os.getenv("VECTORSTORE_DTYPE", "float32")
+VECTORS_FILENAME = "vectors.bin"
+RECORDS_FILENAME = "records.jsonl"
+# Rows scored per matrix product; bounds the float32 copy of a float16 matrix.
+SCORE_BLOCK_ROWS = 65536
+
+
+def normalize(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if vectors.ndim == 1:
+        vectors = vectors[None, :]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+class MemmapVectorStore:
+    backend = "numpy"
+    # Only reads the mapped file, nothing to reopen after a fork
+    fork_safe = True
+
+    def __init__(self, directory: str, embedding, dtype: Optional[str] = None):
+        self.directory = directory
+        self.embeddings = embedding
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, BACKEND_FILENAME), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = {}
+        self.dtype = np.dtype(meta.get("dtype") or dtype or VECTORSTORE_DTYPE)
+        self.dim: Optional[int] = meta.get("dim")
+        self._ids: List[Optional[str]] = []
+        self._texts: List[str] = []
+        self._metadatas: List[dict] = []
+        self._rows: Dict[str, int] = {}
+        self._matrix = None
+        self._metadata_index = None
+        self._selections = LRUCache(maxsize=1024)
+        self._lock = threading.RLock()
+        self._load()
+
+    # --- reading ---
+
+    def _load(self):
+        path = os.path.join(self.directory, RECORDS_FILENAME)
+        if not os.path.exists(path):
+            return
+        complete = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # A write cut short by a crash, never acknowledged
+                    break
+                complete += len(line)
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning("Skipping a damaged record in %s", path)
+                    continue
+                self._apply(record)
+        if complete < os.path.getsize(path):
+            # Cut the partial line off, or the next append would continue it and be lost on reload
+            with open(path, "r+b") as f:
+                f.truncate(complete)
+
+    def _apply(self, record: dict):
+        op = record["op"]
+        if op == "put":
+            self._remove(record["id"])
+            self._rows[record["id"]] = len(self._ids)
+            self._ids.append(record["id"])
+            self._texts.append(record["text"])
+            self._metadatas.append(record["metadata"])
+        elif op == "update":
+            row = self._rows.get(record["id"])
+            if row is not None:
+                self._metadatas[row] = dict(self._metadatas[row], **record["metadata"])
+        elif op == "delete":
+            self._remove(record["id"])
+
+    def _remove(self, id: str):
+        row = self._rows.pop(id, None)
+        if row is not None:
+            self._ids[row] = None
+            self._texts[row] = ""
+
+    def count(self) -> int:
+        return len(self._rows)
+
+    def matrix(self) -> Optional[np.ndarray]:
+        if self._matrix is None and self._ids:
+            self._matrix = np.memmap(
+                os.path.join(self.directory, VECTORS_FILENAME), dtype=self.dtype, mode="r", shape=(len(self._ids), self.dim)
+            )
+        return self._matrix
+
+    def select(self, filter: Optional[dict]) -> np.ndarray:
+        """Rows of the live documents matching a filter, cached per filter."""
+        key = json.dumps(filter, sort_keys=True)
+        rows = self._selections.get(key)
+        if rows is None:
+            if self._metadata_index is None:
+                self._metadata_index = MetadataIndex([None if id is None else metadata for id, metadata in zip(self._ids, self._metadatas)])
+            rows = np.flatnonzero(self._metadata_index.mask(filter))
+            self._selections.set(key, rows)
+        return rows
+
+    def document(self, row: int) -> Document:
+        return Document(page_content=self._texts[row], metadata=dict(self._metadatas[row]))
+
+    def get_documents(self, where: Optional[dict]) -> List[Document]:
+        return [self.document(row) for row in self.select(where)]
+
+    def search_by_vectors(self, vectors: Sequence[Sequence[float]], k: int = 5, filter: Optional[dict] = None) -> List[List[SearchHit]]:
+        rows = self.select(filter)
+        if not rows.size:
+            return [[] for _ in vectors]
+        return self.exact_search(normalize(vectors), rows, k)
+
+    def exact_search(self, queries: np.ndarray, rows: np.ndarray, k: int) -> List[List[SearchHit]]:
+        matrix = self.matrix()
+        contiguous = rows.size == len(self._ids)
+        scores = np.empty((len(queries), rows.size), dtype=np.float32)
+        for start in range(0, rows.size, SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, rows.size)
+            # Slicing a mapped matrix reads it in place, fancy indexing copies the rows
+            block = matrix[start:end] if contiguous else matrix[rows[start:end]]
+            scores[:, start:end] = queries @ np.asarray(block, dtype=np.float32).T
+
+        k = min(k, rows.size)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for query_scores, candidates in zip(scores, top):
+            ranked = candidates[np.argsort(-query_scores[candidates])]
+            results.append(self.hits(rows[ranked], 1.0 - query_scores[ranked]))
+        return results
+
+    def hits(self, rows, distances) -> List[SearchHit]:
+        # Cosine distance, as Chroma reports it with hnsw:space=cosine
+        return [SearchHit(id=self._ids[row], document=self.document(row), distance=float(distance)) for row, distance in zip(rows, distances)]
+
+    # --- writing (ingest) ---
+
+    def upsert(self, ids: List[str], embeddings, metadatas: List[dict], documents: List[str]):
+        vectors = normalize(embeddings)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._write_meta()
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the store ({self.dim})")
+            # Vectors first: a crash before the log is written leaves unused bytes, not missing rows
+            with open(os.path.join(self.directory, VECTORS_FILENAME), "ab") as f:
+                f.truncate(len(self._ids) * self.dim * self.dtype.itemsize)
+                f.write(vectors.astype(self.dtype).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            self._log(
+                {"op": "put", "id": id, "text": text or "", "metadata": metadata or {}}
+                for id, text, metadata in zip(ids, documents, metadatas)
+            )
+
+    def update(self, ids: List[str], metadatas: List[dict]):
+        with self._lock:
+            self._log({"op": "update", "id": id, "metadata": metadata} for id, metadata in zip(ids, metadatas) if id in self._rows)
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[dict] = None):
+        with self._lock:
+            if ids is None:
+                ids = [self._ids[row] for row in self.select(where)]
+            elif where:
+                ids = [id for id in ids if id in self._rows and matches(self._metadatas[self._rows[id]], where)]
+            self._log({"op": "delete", "id": id} for id in ids if id in self._rows)
+
+    def _log(self, records):
+        records = list(records)
+        if not records:
+            return
+        with open(os.path.join(self.directory, RECORDS_FILENAME), "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for record in records:
+            self._apply(record)
+        self._changed()
+
+    def _changed(self):
+        self._matrix = None
+        self._metadata_index = None
+        self._selections.clear()
+
+    def _write_meta(self):
+        with open(os.path.join(self.directory, BACKEND_FILENAME), "w", encoding="utf-8") as f:
+            json.dump({"backend": self.backend, "dim": self.dim, "dtype": self.dtype.name}, f)
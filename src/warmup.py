@@ -0,0 +1,92 @@
+"""Warm the query embedding and answer caches from the query log.
+
+Whenever a worker opens a new index generation (after a refresh, and on start
+for Chroma stores, which every worker reopens), the most frequent stand-alone
+questions of the last QUERY_LOG_WARM_HOURS are taken from QUERY_LOG_DIR. Questions
+the log masked an e-mail address, URL or number in are left out:
+
+    QUERY_LOG_WARM_QUERIES  questions whose embeddings are computed up front (one batch)
+    QUERY_LOG_WARM_ANSWERS  questions answered up front into the answer cache
+
+Answers are generated one at a time in a background thread with the context
+they were routed to before, so warming adds at most one LLM call next to live
+traffic and no routing calls. Each call takes an answer slot at batch priority;
+when none frees up within BACKGROUND_ADMISSION_MAX_WAIT_SECONDS, warming stops.
+Every worker warms its own caches, and every tenant's index only with the
+questions asked of that tenant.
+"""
+import logging
+import os
+import threading
+import time
+
+from .admission import ANSWER_LIMITER, Overloaded
+from .log import log_event
+from .query_log import QUERY_LOG, masked, popular_queries, read_records
+from .retrieval import embed_queries
+from .routes.main_router import Query, answer_cache, chat_key, generate_answer, prepare_answer, store_answer
+
+logger = logging.getLogger(__name__)
+
+QUERY_LOG_WARM_QUERIES = int(os.getenv("QUERY_LOG_WARM_QUERIES", "500"))
+QUERY_LOG_WARM_ANSWERS = int(os.getenv("QUERY_LOG_WARM_ANSWERS", "20"))
+QUERY_LOG_WARM_HOURS = float(os.getenv("QUERY_LOG_WARM_HOURS", "168"))
+
+
+def warm_caches(vectorstore, tenant, default: bool = True, directory: str = None):
+    started = time.perf_counter()
+    records = [
+        record
+        for record in read_records([directory or QUERY_LOG.directory], since=time.time() - QUERY_LOG_WARM_HOURS * 3600)
+        # Records written before tenants were logged belong to the default tenant
+        if record.get("tenant", tenant.key if default else None) == tenant.key
+        # A masked question is not what was asked, its answer would be cached under the wrong key
+        and not masked(record)
+    ]
+    popular = popular_queries(records, max(QUERY_LOG_WARM_QUERIES, QUERY_LOG_WARM_ANSWERS))
+    if not popular:
+        return
+
+    embed_queries(vectorstore.embeddings, [record["message"] for record, _ in popular[:QUERY_LOG_WARM_QUERIES]])
+
+    answered = 0
+    cache = answer_cache(vectorstore, tenant.answer_cache_size)
+    for record, _ in popular[:QUERY_LOG_WARM_ANSWERS] if cache is not None else ():
+        request = Query(message=record["message"], course_id=record.get("course_id"), usercontext=record.get("usercontext"))
+        if cache.get(chat_key(request)) is not None:
+            continue
+        try:
+            messages = prepare_answer(request, vectorstore, record["context"])
+            with ANSWER_LIMITER.thread_slot():
+                answer = generate_answer(messages)
+            store_answer(request, vectorstore, tenant, record["context"], answer)
+            answered += 1
+        except Overloaded:
+            # Live traffic keeps the answer model busy, the remaining answers are left to it
+            break
+        except Exception:
+            logger.exception("Could not warm the answer to a logged question")
+    log_event(
+        logger,
+        logging.INFO,
+        "cache.warmed",
+        tenant=tenant.key,
+        records=len(records),
+        queries=min(len(popular), QUERY_LOG_WARM_QUERIES),
+        answers=answered,
+        seconds=round(time.perf_counter() - started, 2),
+    )
+
+
+def warm_caches_in_background(vectorstore, generation=None, tenant=None, default=True):
+    """IndexHandle.on_open hook, bound to a tenant."""
+    if not QUERY_LOG.enabled or not os.path.isdir(QUERY_LOG.directory):
+        return
+    threading.Thread(target=_warm_quietly, args=(vectorstore, tenant, default), name=f"cache-warmup-{tenant.key}", daemon=True).start()
+
+
+def _warm_quietly(vectorstore, tenant, default):
+    try:
+        warm_caches(vectorstore, tenant, default)
+    except Exception:
+        logger.exception("Cache warm-up failed")